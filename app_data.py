@@ -0,0 +1,99 @@
+"""
+Acceso a los datos compartidos por las páginas de la aplicación.
+
+El formulario (`code.py`) y las páginas de `pages/` se ejecutan en el mismo
+proceso: obtienen aquí las mismas fuentes, el mismo almacén de snapshot (con su
+refrescador y sus objetos derivados, como los índices) y lo cargan con las mismas
+reglas de cuota, de modo que abrir otra página no vuelve a descargar la planilla.
+"""
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+import metrics
+import quota
+import schema
+import snapshot
+import snapshot_cache
+import sources
+
+# Segundos que el snapshot compartido se considera vigente antes de refrescarlo
+REFRESH_SECONDS = 120
+# Segundos máximos que una carga interactiva espera turno en la cuota antes de avisar
+INTERACTIVE_MAX_WAIT = 20
+
+
+def init_sources():
+    """
+    Obtiene las fuentes de datos compartidas (una conexión por hoja y por proceso,
+    reutilizadas entre sesiones): las hojas de fuentes.toml o, sin ese archivo, la
+    planilla de los secretos.
+    """
+    try:
+        return sources.get_source_set(
+            st.secrets["gcp_service_account"],
+            st.secrets.get("spreadsheet_url"),
+            schema.CAMPOS_NUMERICOS
+        )
+    except Exception as e:
+        st.error(f"Error en la conexión: {str(e)}")
+        return None
+
+
+def get_snapshot_store():
+    """Retorna el almacén de snapshot compartido por todas las sesiones del proceso."""
+    fuentes = init_sources()
+    if not fuentes:
+        return None
+    return snapshot.get_store(
+        fuentes,
+        fuentes.fetch,
+        fuentes.layout(),
+        schema.CAMPOS_NUMERICOS,
+        ttl=REFRESH_SECONDS,
+        probe=fuentes.probe,
+        cache_path=snapshot_cache.cache_path(fuentes.cache_key()),
+        build=fuentes.build
+    )
+
+
+def get_session_id():
+    """Retorna el identificador de la sesión de Streamlit actual."""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "local"
+
+
+def get_author():
+    """Quién escribe, para el diario local: el correo del usuario si Streamlit lo informa; si no, la sesión."""
+    try:
+        email = st.experimental_user.email
+    except AttributeError:
+        email = None
+    return email or f"sesión {get_session_id()}"
+
+
+def load_snapshot(force=False):
+    """
+    Obtiene el snapshot compartido de la planilla (None si no hay datos). Solo
+    sincroniza si el snapshot expiró o si se fuerza la recarga; si la carga falla,
+    avisa y retorna el último snapshot disponible.
+    """
+    store = get_snapshot_store()
+    if not store:
+        return None
+
+    try:
+        with quota.priority(quota.INTERACTIVE, max_wait=INTERACTIVE_MAX_WAIT), \
+                metrics.timer("app_rerun_phase_seconds", phase="carga_datos"):
+            snap = store.refresh() if force else store.get()
+    except quota.QuotaExceeded as e:
+        st.warning(str(e))
+        snap = store.current()
+    except Exception as e:
+        st.error(f"Error al cargar datos: {str(e)}")
+        snap = store.current()
+    if snap is None:
+        return None
+
+    # Registrar la sesión como activa para mantener vivo el refrescador compartido
+    store.touch(get_session_id())
+    return snap
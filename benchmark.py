@@ -0,0 +1,341 @@
+"""
+Benchmark de las rutas principales de la aplicación sobre una planilla falsa.
+
+Mide, para planillas de 1k, 10k y 100k filas (`fake_sheets`), la carga del
+snapshot (descargándolo y, como tras un reinicio, desde la caché en disco), la
+carga de la misma cantidad de filas repartida en SOURCES hojas (descargadas en
+paralelo), la construcción del índice y de la página de resultados del selector,
+la búsqueda, los totales del panel de avance, la revisión de coordenadas, la
+preparación de una fila para mostrarla y el guardado (al encolar y hasta que
+la planilla lo confirma). Por cada etapa informa la mediana y el mínimo de varias
+repeticiones y el pico de memoria (tracemalloc, en una pasada aparte para no
+distorsionar los tiempos).
+
+Los resultados se escriben en JSON; con `--baseline` se comparan con una ejecución
+anterior y el programa termina con código 1 si alguna etapa empeoró más que la
+tolerancia.
+
+    python benchmark.py --sizes 1000 10000 --output resultados.json
+    python benchmark.py --baseline resultados.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import fake_sheets
+import progress
+import quota
+import rules
+import schema
+import search
+import snapshot
+import snapshot_cache
+import sources
+import spatial
+import write_queue
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_REPEAT = 3
+# Consultas representativas del buscador de la barra lateral
+QUERIES = ["nogal", "cuenta:1003", 'campo:"nuble 1"', "crimson sector 2", "fila:500", "sonda:9000"]
+# Hojas en que se reparten las filas en la etapa de carga de varias fuentes
+SOURCES = 4
+# Filas que se preparan para mostrar en la etapa de renderizado
+RENDER_ROWS = 1000
+# Empeoramiento relativo (y absoluto mínimo, en segundos) que se considera regresión
+TOLERANCE = 0.2
+MIN_REGRESSION_SECONDS = 0.005
+
+
+class Bench:
+    """Planilla falsa de un tamaño dado con su conexión, snapshot e índice."""
+
+    def __init__(self, n_rows, latency=0.0, error_rate=0.0):
+        self.n_rows = n_rows
+        self.worksheet = fake_sheets.FakeWorksheet(
+            fake_sheets.generate_rows(n_rows), latency=latency, error_rate=error_rate
+        )
+        # Sin límite de cuota efectivo: se mide el código, no la espera por cuota
+        limits = {kind: 10 ** 9 for kind in quota.DEFAULT_LIMITS}
+        self.limiter = quota.QuotaLimiter(limits)
+        self.client = fake_sheets.FakeConnection(self.worksheet, limiter=self.limiter)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.store = None
+        self.index = None
+        self.queue = None
+        # Caché en disco de arranque_desde_cache; se borra al terminar (`with bench.temp_dir`)
+        self.temp_dir = tempfile.TemporaryDirectory(prefix="benchmark-")
+
+    def new_store(self, cache_path=None):
+        client = self.client
+        return snapshot.SnapshotStore(
+            lambda: client.get_columns(schema.COLUMNAS.values()),
+            schema.COLUMNAS,
+            schema.CAMPOS_NUMERICOS,
+            probe=client.modified_time,
+            cache_path=cache_path
+        )
+
+    # --- Etapas: cada una retorna (preparación, medición) ---
+    def stage_load(self):
+        def setup():
+            self.store = self.new_store()
+        return setup, lambda: self.store.refresh()
+
+    def stage_cold_start(self):
+        # Primer acceso de un proceso nuevo que encuentra la caché de una ejecución anterior
+        path = os.path.join(self.temp_dir.name, "snapshot.arrow")
+        stores = []
+
+        def setup():
+            if not os.path.exists(path):
+                snapshot_cache.save(path, self.store.current().table, time.time(),
+                                    self.client.modified_time(), schema.COLUMNAS)
+            stores[:] = [self.new_store(cache_path=path)]
+        return setup, lambda: stores[0].get()
+
+    def stage_sources(self):
+        # Las mismas filas repartidas en varias hojas de planillas distintas
+        per_source = max(1, self.n_rows // SOURCES)
+        source_set = sources.SourceSet(
+            [
+                sources.Source(
+                    number, f"Hoja {number + 1}",
+                    fake_sheets.FakeConnection(
+                        fake_sheets.FakeWorksheet(fake_sheets.generate_rows(per_source, seed=number),
+                                                  latency=self.latency, error_rate=self.error_rate),
+                        limiter=self.limiter, spreadsheet_url=f"fake://planilla-{number}"
+                    ),
+                    dict(schema.COLUMNAS)
+                )
+                for number in range(SOURCES)
+            ],
+            schema.CAMPOS_NUMERICOS
+        )
+        stores = []
+
+        def setup():
+            stores[:] = [snapshot.SnapshotStore(
+                source_set.fetch, source_set.layout(), schema.CAMPOS_NUMERICOS,
+                probe=source_set.probe, build=source_set.build
+            )]
+        return setup, lambda: stores[0].refresh()
+
+    def stage_index(self):
+        def setup():
+            self.index = search.SearchIndex(search.row_label)
+        return setup, lambda: self.index.sync(self.store.current())
+
+    def first_page(self, query):
+        """Etiquetas de la primera página de resultados (lo que se envía al selector)."""
+        _, rows = search.page_of(self.index.ranked(query), 0)
+        return [self.index.label(row_number) for row_number in rows]
+
+    def stage_options(self):
+        def setup():
+            self.index = search.SearchIndex(search.row_label)
+            self.index.sync(self.store.current())
+        return setup, lambda: self.first_page("")
+
+    def stage_search(self):
+        def run():
+            for query in QUERIES:
+                self.first_page(query)
+        return None, run
+
+    def stage_progress(self):
+        # Totales del panel de avance desde cero, como al abrirlo tras cargar la planilla
+        indexes = []
+
+        def setup():
+            indexes[:] = [progress.ProgressIndex()]
+
+        def run():
+            indexes[0].sync(self.store.current())
+            indexes[0].by_cuenta()
+        return setup, run
+
+    def stage_coordinates(self):
+        # Grilla de coordenadas y revisión de duplicados y sondas fuera de su campo de toda la planilla
+        indexes = []
+
+        def setup():
+            indexes[:] = [spatial.SpatialIndex()]
+
+        def run():
+            indexes[0].sync(self.store.current())
+            indexes[0].duplicates()
+            indexes[0].outliers()
+        return setup, run
+
+    def stage_render(self):
+        rng = random.Random(0)
+        table = self.store.current().table
+        row_numbers = [rng.choice(table.row_numbers()) for _ in range(RENDER_ROWS)]
+
+        def run():
+            for row_number in row_numbers:
+                row_data = table.row(row_number)
+                self.index.label(row_number)
+                rules.split_comments(row_data['comentario'])
+        return None, run
+
+    def stage_save(self):
+        rng = random.Random(1)
+        table = self.store.current().table
+
+        def save():
+            row_number = rng.choice(table.row_numbers())
+            row_data = self.store.current().table.row(row_number)
+            valores = {campo: row_data[campo] for campo in rules.CAMPOS_FORMULARIO}
+            valores['superficie_ha'] = str(round(rng.uniform(1, 30), 2)).replace(".", ",")
+            valores['cultivo'] = "Nogal"
+            celdas, _, _ = rules.compute_row_changes(row_data, valores)
+            self.queue.enqueue({(row_number, campo): valor for campo, valor in celdas.items()})
+            self.index.sync(self.store.current())
+
+        def setup():
+            if self.queue is None:
+                self.queue = write_queue.WriteQueue(
+                    self.client.batch_update, schema.COLUMNAS, store=self.store, flush_interval=0
+                )
+        return setup, save
+
+    def stage_flush(self):
+        setup, save = self.stage_save()
+
+        def run():
+            save()
+            self.queue.flush(60)
+        return setup, run
+
+    STAGES = [
+        ("carga_snapshot", stage_load),
+        ("arranque_desde_cache", stage_cold_start),
+        ("carga_varias_fuentes", stage_sources),
+        ("indice_busqueda", stage_index),
+        ("pagina_resultados", stage_options),
+        ("busqueda", stage_search),
+        ("avance_por_cuenta", stage_progress),
+        ("revision_coordenadas", stage_coordinates),
+        ("render_fila", stage_render),
+        ("guardado", stage_save),
+        ("guardado_confirmado", stage_flush),
+    ]
+
+
+def measure(setup, run, repeat):
+    """Tiempos (segundos) de `repeat` ejecuciones de `run`, preparando antes de cada una."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def peak_memory(setup, run):
+    """Pico de memoria asignada (bytes) durante una ejecución de `run`."""
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmark(sizes, repeat=DEFAULT_REPEAT, latency=0.0, error_rate=0.0, memory=True, log=print):
+    """Ejecuta todas las etapas para cada tamaño y retorna la lista de resultados."""
+    results = []
+    for n_rows in sizes:
+        bench = Bench(n_rows, latency=latency, error_rate=error_rate)
+        with bench.temp_dir:
+            for name, stage in Bench.STAGES:
+                setup, run = stage(bench)
+                times = measure(setup, run, repeat)
+                result = {
+                    "filas": n_rows,
+                    "etapa": name,
+                    "mediana_s": round(statistics.median(times), 6),
+                    "minimo_s": round(min(times), 6),
+                    "repeticiones": repeat,
+                }
+                if memory:
+                    setup, run = stage(bench)
+                    result["pico_memoria_mb"] = round(peak_memory(setup, run) / 2 ** 20, 3)
+                results.append(result)
+                log(f"{n_rows:>7} filas  {name:<19} {result['mediana_s'] * 1000:10.1f} ms"
+                    + (f"  {result['pico_memoria_mb']:8.1f} MB" if memory else ""))
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Etapas que empeoraron respecto de una ejecución anterior: [(filas, etapa, antes, ahora)]."""
+    before = {(r["filas"], r["etapa"]): r["mediana_s"] for r in baseline["resultados"]}
+    regressions = []
+    for result in results:
+        previous = before.get((result["filas"], result["etapa"]))
+        now = result["mediana_s"]
+        if previous is not None and now > previous * (1 + tolerance) and now - previous > MIN_REGRESSION_SECONDS:
+            regressions.append((result["filas"], result["etapa"], previous, now))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de la aplicación sobre una planilla falsa.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="cantidades de filas")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="repeticiones por etapa")
+    parser.add_argument("--latency", type=float, default=0.0, help="latencia simulada por llamada a la API (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probabilidad de error 429 por llamada")
+    parser.add_argument("--no-memory", action="store_true", help="omite la medición de memoria")
+    parser.add_argument("--output", help="archivo JSON de resultados (por omisión, salida estándar)")
+    parser.add_argument("--baseline", help="resultados anteriores con los que comparar")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="empeoramiento relativo tolerado")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(
+        args.sizes, args.repeat, args.latency, args.error_rate,
+        memory=not args.no_memory, log=lambda m: print(m, file=sys.stderr)
+    )
+    report = {
+        "entorno": {
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "latencia_s": args.latency,
+            "tasa_error": args.error_rate,
+            "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "resultados": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for n_rows, stage, previous, now in regressions:
+            print(f"Regresión: {stage} con {n_rows} filas pasó de {previous * 1000:.1f} ms a {now * 1000:.1f} ms",
+                  file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
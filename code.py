@@ -1,20 +1,31 @@
 import streamlit as st
-import streamlit.components.v1 as components
-import gspread
-from google.oauth2 import service_account
-import re
+import functools
 import math
-import time
-import threading
 import pandas as pd
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
-def get_chile_timestamp():
+import completeness
+import consistency
+import journal
+import metrics
+import quota
+import rules
+import schema
+import search
+import sources
+import spatial
+import write_queue
+from app_data import INTERACTIVE_MAX_WAIT, get_author, get_snapshot_store, init_sources, load_snapshot
+from table import format_cell, row_fingerprint, split_row_id
+
+def get_chile_timestamp(timestamp=None):
     """
-    Retorna la fecha y hora actual en la zona horaria de Chile con el formato deseado.
+    Retorna la fecha y hora (actual o del timestamp indicado) en la zona horaria de Chile con el formato deseado.
     """
-    return datetime.now(ZoneInfo("America/Santiago")).strftime('%d-%m-%y %H:%M')
+    zona = ZoneInfo("America/Santiago")
+    fecha = datetime.fromtimestamp(timestamp, zona) if timestamp is not None else datetime.now(zona)
+    return fecha.strftime('%d-%m-%y %H:%M')
 
 # Configuración de la página
 st.set_page_config(
@@ -45,301 +56,746 @@ st.markdown(
 )
 
 # --- 1. Definición de mapeo de columnas ---
-# Mapeo de nombres de campo a letras de columnas
-COLUMNAS = {
-    'cuenta_id': 0,            # A
-    'cuenta_nombre': 1,        # B
-    'campo_id': 2,             # C
-    'campo_nombre': 3,         # D
-    'sonda_id': 11,            # L
-    'sonda_nombre': 10,        # K
-    'ubicacion_sonda': 12,     # M
-    'latitud_sonda': 13,       # N
-    'longitud_sonda': 14,      # O
-    'cultivo': 17,             # R
-    'variedad': 18,            # S
-    'ano_plantacion': 20,      # U
-    'plantas_ha': 22,          # W
-    'plantas_total': 23,       # X
-    'emisores_ha': 24,         # Y
-    'emisores_total': 25,      # Z
-    'superficie_ha': 31,       # AF
-    'superficie_m2': 32,       # AG
-    'caudal_teorico': 33,      # AH
-    'ppeq_mm_h': 34,           # AI
-    'comentario': 41,          # AP
-}
+# El mapeo vive en schema.py para que los scripts sin interfaz usen el mismo
+COLUMNAS = schema.COLUMNAS
+CAMPOS_NUMERICOS = schema.CAMPOS_NUMERICOS
 
 # --- 2. Inicialización del estado de la sesión ---
 if 'current_row_index' not in st.session_state:
-    st.session_state.current_row_index = 0
-if 'sheet_data' not in st.session_state:
-    st.session_state.sheet_data = []
+    st.session_state.current_row_index = None  # posición de la fila seleccionada en los resultados
+if 'page_start' not in st.session_state:
+    st.session_state.page_start = 0
+if 'snapshot_version' not in st.session_state:
+    st.session_state.snapshot_version = None
 if 'last_update_time' not in st.session_state:
     st.session_state.last_update_time = None
-if 'update_running' not in st.session_state:
-    st.session_state.update_running = False
 if 'search_term' not in st.session_state:
     st.session_state.search_term = ""
-if 'filtered_options' not in st.session_state:
-    st.session_state.filtered_options = []
+if 'filtered_rows' not in st.session_state:
+    st.session_state.filtered_rows = []
+if 'selected_row' not in st.session_state:
+    st.session_state.selected_row = None
 
 # --- 3. Funciones de Conexión y Carga de Datos ---
-def init_connection():
-    """Inicializa la conexión con Google Sheets."""
-    try:
-        credentials = service_account.Credentials.from_service_account_info(
-            st.secrets["gcp_service_account"],
-            scopes=[
-                'https://www.googleapis.com/auth/spreadsheets',
-                'https://www.googleapis.com/auth/drive'
-            ]
+# Las fuentes y el snapshot se comparten con las páginas de pages/ (app_data.py)
+def row_name(row_number):
+    """Número de fila para los mensajes (con la fuente, si hay varias)."""
+    return row_names([row_number])[0]
+
+def row_names(row_numbers):
+    """Números de fila para mensajes y tablas; obtiene las fuentes una sola vez para todas las filas."""
+    fuentes = init_sources()
+    return [fuentes.row_name(fila) if fuentes else str(fila) for fila in row_numbers]
+
+# --- 4. Edición masiva, vista de tabla y revisiones de consistencia y coordenadas ---
+# Filas que se muestran como máximo en las tablas de sondas cercanas y de la revisión de coordenadas
+NEAR_ROWS = 50
+CHECK_ROWS = 500
+# Etiquetas de los campos del formulario de edición
+ETIQUETAS_CAMPOS = {
+    'superficie_ha': "Superficie (ha)",
+    'caudal_teorico': "Caudal teórico (m3/h)",
+    'ppeq_mm_h': "PPeq [mm/h]",
+    'plantas_total': "N° plantas",
+    'emisores_total': "N° goteros",
+    'cultivo': "Cultivo",
+    'variedad': "Variedad",
+    'ano_plantacion': "Año plantación",
+    'ubicacion_sonda': "Ubicación de Sonda",
+}
+
+def build_bulk_preview(snap, celdas):
+    """Tabla de diferencias (fila, campo, valor actual y nuevo) de una edición masiva."""
+    celdas = sorted(celdas.items())
+    nombres = row_names([fila for (fila, _), _ in celdas])
+    return pd.DataFrame(
+        [
+            (nombre, campo, snap.table.value(fila, campo), format_cell(valor))
+            for nombre, ((fila, campo), valor) in zip(nombres, celdas)
+        ],
+        columns=["Fila", "Campo", "Valor actual", "Valor nuevo"]
+    )
+
+def show_bulk_editor(snap, row_numbers):
+    """
+    Formulario de edición masiva: aplica los mismos valores a todas las filas del filtro
+    actual con las reglas del guardado de una fila, muestra las diferencias y, al
+    confirmar, las envía por la cola de escritura en bloques de `batch_update`.
+    """
+    st.subheader("Edición masiva")
+    st.caption(
+        f"Los valores ingresados se aplicarán a las {len(row_numbers)} filas del filtro actual. "
+        "Los campos vacíos no se modifican y los campos derivados (coordenadas, superficie en m2, "
+        "densidades) se recalculan con los datos de cada fila."
+    )
+    if not st.session_state.search_term.strip():
+        st.warning("No hay término de búsqueda: los cambios afectarán a todas las filas de la planilla.")
+    
+    with st.form(key="bulk_form"):
+        entradas = {}
+        columnas_form = st.columns(3)
+        for i, campo in enumerate(rules.CAMPOS_FORMULARIO):
+            with columnas_form[i % 3]:
+                entradas[campo] = st.text_input(ETIQUETAS_CAMPOS[campo], key=f"bulk_{campo}")
+        comentarios = st.multiselect("Comentarios (selección rápida)", rules.COMENTARIOS_LISTA, key="bulk_comentarios")
+        comentarios_modo = st.radio(
+            "Aplicar comentarios",
+            [rules.COMENTARIOS_SIN_CAMBIOS, rules.COMENTARIOS_REEMPLAZAR, rules.COMENTARIOS_AGREGAR],
+            horizontal=True,
+            key="bulk_comentarios_modo"
         )
-        client = gspread.authorize(credentials)
-        return client
-    except Exception as e:
-        st.error(f"Error en la conexión: {str(e)}")
+        preview_button = st.form_submit_button("Previsualizar cambios")
+    
+    if preview_button:
+        valores = {campo: texto for campo, texto in entradas.items() if texto.strip()}
+        if not comentarios:
+            comentarios_modo = rules.COMENTARIOS_SIN_CAMBIOS
+        with metrics.timer("app_rerun_phase_seconds", phase="edicion_masiva"):
+            celdas, avisos = rules.bulk_changes(snap.table, row_numbers, valores, comentarios, comentarios_modo)
+        st.session_state.bulk_preview = {"celdas": celdas, "avisos": avisos, "version": snap.version}
+    
+    preview = st.session_state.get("bulk_preview")
+    if not preview:
+        return
+    celdas = preview["celdas"]
+    for fila, avisos in sorted(preview["avisos"].items()):
+        st.warning(f"Fila {row_name(fila)}: " + " ".join(avisos))
+    if not celdas:
+        st.info("No se detectaron cambios para guardar.")
+        return
+    
+    filas = {fila for fila, _ in celdas}
+    solicitudes = math.ceil(len(celdas) / write_queue.MAX_RANGES_PER_REQUEST)
+    st.write(f"**{len(celdas)} celdas en {len(filas)} filas** ({solicitudes} solicitud(es) a la planilla).")
+    st.dataframe(build_bulk_preview(snap, celdas), hide_index=True, use_container_width=True)
+    
+    if preview["version"] != snap.version:
+        st.info("Los datos cambiaron desde la previsualización; vuelve a previsualizar antes de aplicar.")
+        return
+    if st.button("Aplicar cambios", type="primary", key="bulk_apply"):
+        cola = get_write_queue()
+        if not cola:
+            st.error("No se pudo establecer conexión para guardar cambios.")
+            return
+        cola.enqueue(celdas, author=get_author())
+        st.session_state.bulk_preview = None
+        st.success(f"Cambios de {len(filas)} filas guardados (se enviarán a la planilla en segundo plano).")
+
+def grid_frame(snap, row_numbers):
+    """Tabla de la vista de tabla: fila, cuenta, campo y sonda (solo lectura) y los campos ingresados."""
+    tabla = rows_frame(snap, row_numbers)
+    datos = snap.table.take(list(row_numbers)).frame
+    for campo in rules.CAMPOS_INGRESADOS:
+        tabla[campo] = datos[campo].astype(str).to_numpy()
+    return tabla
+
+def grid_edits(base, edited_rows):
+    """
+    Celdas que el usuario cambió en la vista de tabla `{(fila, campo): texto}`, a partir
+    de las ediciones que informa el navegador (`edited_rows`: `{posición: {columna: valor}}`)
+    comparadas con la tabla que tenía a la vista.
+    """
+    ediciones = {}
+    for position, cambios in edited_rows.items():
+        fila = base["filas"][int(position)]
+        for campo, valor in cambios.items():
+            if campo not in rules.CAMPOS_INGRESADOS:
+                continue
+            texto = "" if valor is None else str(valor)
+            if texto.strip() != base["tabla"][campo].iat[int(position)].strip():
+                ediciones[(fila, campo)] = texto
+    return ediciones
+
+def show_grid_editor(snap, row_numbers):
+    """
+    Vista de tabla: edición de varias filas de la página de resultados a la vez. El
+    navegador lleva la cuenta de las celdas editadas y las envía recién al guardar; solo
+    esas celdas pasan por las reglas de guardado (con los campos derivados de cada fila)
+    y se envían juntas por la cola de escritura.
+    """
+    st.subheader("Vista de tabla")
+    st.caption(
+        f"Edita las {len(row_numbers)} filas de la página de resultados y guarda todo de una vez. "
+        "Solo se guardan las celdas modificadas; los campos derivados (coordenadas, superficie en m2, "
+        "densidades) se recalculan con los datos actuales de cada fila."
+    )
+    # La tabla a la vista se conserva entre reruns (aunque se actualice el snapshot) hasta guardar o cambiar de página
+    # (cada tabla nueva usa otra clave para que el editor no arrastre ediciones de la anterior)
+    base = st.session_state.get("grid_base")
+    if base is None or base["filas"] != row_numbers:
+        st.session_state.grid_generation = st.session_state.get("grid_generation", 0) + 1
+        base = st.session_state.grid_base = {
+            "filas": row_numbers,
+            "tabla": grid_frame(snap, row_numbers),
+            "clave": f"grid_editor_{st.session_state.grid_generation}",
+        }
+    column_config = {campo: st.column_config.TextColumn(etiqueta) for campo, etiqueta in ETIQUETAS_CAMPOS.items()}
+    column_config['comentario'] = st.column_config.TextColumn(
+        "Comentario", help="Comentarios separados por «, », p. ej. " + ", ".join(rules.COMENTARIOS_LISTA[:2])
+    )
+    with st.form(key="grid_form"):
+        st.data_editor(
+            base["tabla"],
+            key=base["clave"],
+            hide_index=True,
+            use_container_width=True,
+            num_rows="fixed",
+            disabled=["Fila", "Cuenta", "Campo", "Sonda"],
+            column_config=column_config,
+        )
+        guardar = st.form_submit_button("Guardar cambios de la tabla", type="primary")
+    if not guardar:
+        return
+    
+    with metrics.timer("app_rerun_phase_seconds", phase="vista_tabla"):
+        ediciones = grid_edits(base, st.session_state[base["clave"]]["edited_rows"])
+        celdas, avisos = rules.cell_changes(snap.table, ediciones)
+    for fila, avisos_fila in sorted(avisos.items()):
+        st.warning(f"Fila {row_name(fila)}: " + " ".join(avisos_fila))
+    if not celdas:
+        st.info("No se detectaron cambios para guardar.")
+        return
+    cola = get_write_queue()
+    if not cola:
+        st.error("No se pudo establecer conexión para guardar cambios.")
+        return
+    cola.enqueue(celdas, author=get_author())
+    metrics.increment("grid_saves_total")
+    # La próxima tabla parte de los datos ya guardados, sin las ediciones enviadas
+    st.session_state.grid_base = None
+    filas = {fila for fila, _ in celdas}
+    st.success(f"Cambios de {len(filas)} filas guardados ({len(celdas)} celdas; se enviarán a la planilla "
+               "en segundo plano).")
+    st.dataframe(build_bulk_preview(snap, celdas), hide_index=True, use_container_width=True)
+
+def show_consistency_check(snap):
+    """
+    Revisión de los campos derivados de toda la planilla (superficie en m2, densidades
+    y coordenadas): muestra cuántas celdas difieren de lo esperado y permite corregirlas.
+    """
+    if st.button("Revisar campos derivados", key="consistency_check"):
+        with metrics.timer("app_rerun_phase_seconds", phase="consistencia"):
+            celdas = consistency.derived_changes(snap.table)
+        st.session_state.consistency_result = {"celdas": celdas, "version": snap.version}
+    
+    resultado = st.session_state.get("consistency_result")
+    if not resultado:
+        return
+    celdas = resultado["celdas"]
+    if not celdas:
+        st.success("Los campos derivados de todas las filas son consistentes.")
+        return
+    filas = {fila for fila, _ in celdas}
+    st.write(f"**{len(celdas)} celdas a corregir en {len(filas)} filas:**")
+    for campo, cantidad in consistency.summarize(celdas).items():
+        st.write(f"- {campo}: {cantidad}")
+    if resultado["version"] != snap.version:
+        st.info("Los datos cambiaron desde la revisión; vuelve a revisar antes de corregir.")
+        return
+    if st.button("Corregir", type="primary", key="consistency_apply"):
+        cola = get_write_queue()
+        if not cola:
+            st.error("No se pudo establecer conexión para guardar cambios.")
+            return
+        cola.enqueue(celdas, author=get_author())
+        st.session_state.consistency_result = None
+        st.success(f"Correcciones de {len(filas)} filas guardadas (se enviarán a la planilla en segundo plano).")
+
+def rows_frame(snap, row_numbers):
+    """Tabla con la fila, cuenta, campo y sonda de las filas indicadas (en ese orden)."""
+    datos = snap.table.take(list(row_numbers)).frame
+    return pd.DataFrame({
+        "Fila": row_names(row_numbers),
+        "Cuenta": datos['cuenta_nombre'].astype(str).to_numpy(),
+        "Campo": datos['campo_nombre'].astype(str).to_numpy(),
+        "Sonda": datos['sonda_nombre'].astype(str).to_numpy(),
+    })
+
+def show_nearby_sondas(snap, row_number):
+    """Sondas ubicadas a menos del radio elegido de la sonda de la fila."""
+    index = get_spatial_index(snap)
+    if index.location(row_number) is None:
+        st.caption("La fila no tiene coordenadas.")
+        return
+    radio = st.number_input("Radio (m)", min_value=1, max_value=50000, value=200, step=50, key="near_radius")
+    cercanas = index.neighbours(row_number, radio)
+    if not cercanas:
+        st.caption(f"No hay otras sondas a menos de {radio} m.")
+        return
+    st.write(f"**{len(cercanas)} sondas a menos de {radio} m**"
+             + (f" (se muestran las {NEAR_ROWS} más cercanas)" if len(cercanas) > NEAR_ROWS else ""))
+    cercanas = cercanas[:NEAR_ROWS]
+    tabla = rows_frame(snap, [fila for fila, _ in cercanas])
+    tabla["Distancia (m)"] = [round(distancia, 1) for _, distancia in cercanas]
+    st.dataframe(tabla, hide_index=True, use_container_width=True)
+
+def show_coordinate_check(snap):
+    """
+    Revisión de las coordenadas de toda la planilla: sondas distintas en el mismo punto
+    y sondas lejos del resto de su campo.
+    """
+    if st.button("Revisar coordenadas", key="coordinate_check"):
+        st.session_state.coordinate_check_shown = True
+    if not st.session_state.get("coordinate_check_shown"):
+        return
+    index = get_spatial_index(snap)
+    with metrics.timer("app_rerun_phase_seconds", phase="coordenadas"):
+        duplicados = index.duplicates()
+        lejanas = index.outliers()
+    if duplicados.empty and lejanas.empty:
+        st.success("No se encontraron coordenadas duplicadas ni sondas fuera de su campo.")
+        return
+    if not duplicados.empty:
+        st.write(f"**{len(duplicados)} pares de sondas a menos de {spatial.DUPLICATE_M} m:**")
+        tabla = rows_frame(snap, duplicados['fila'].tolist()).add_suffix(" 1")
+        tabla = tabla.join(rows_frame(snap, duplicados['fila_2'].tolist()).add_suffix(" 2"))
+        tabla["Distancia (m)"] = duplicados['distancia_m'].round(1)
+        st.dataframe(tabla.head(CHECK_ROWS), hide_index=True, use_container_width=True)
+    if not lejanas.empty:
+        st.write(f"**{len(lejanas)} sondas a más de {spatial.OUTLIER_M / 1000:g} km del centro de su campo:**")
+        tabla = rows_frame(snap, lejanas['fila'].head(CHECK_ROWS).tolist())
+        tabla["Distancia (km)"] = (lejanas['distancia_m'].head(CHECK_ROWS) / 1000).round(2)
+        st.dataframe(tabla, hide_index=True, use_container_width=True)
+
+# --- 5. Funciones para la actualización periódica de datos ---
+def get_search_index(snap):
+    """Retorna el índice de búsqueda compartido, sincronizado con la versión del snapshot."""
+    store = get_snapshot_store()
+    index = store.derived("search", lambda: search.SearchIndex(search.row_label))
+    index.sync(snap)
+    return index
+
+def load_all_data(force=False):
+    """
+    Obtiene el snapshot compartido de la planilla y actualiza el estado de la sesión.
+    Solo sincroniza si el snapshot expiró o si se fuerza la recarga, y solo descarga
+    celdas si la planilla cambió desde la última sincronización.
+    """
+    snap = load_snapshot(force)
+    if snap is not None:
+        sync_session(snap)
+    return snap
+
+def sync_session(snap):
+    """Regenera los resultados de la búsqueda solo si cambió la versión del snapshot."""
+    if st.session_state.snapshot_version != snap.version:
+        st.session_state.snapshot_version = snap.version
+        st.session_state.last_update_time = get_chile_timestamp(snap.fetched_at)
+        with metrics.timer("app_rerun_phase_seconds", phase="opciones_filas"):
+            update_filtered_rows(snap, st.session_state.search_term)
+
+def memo_by_version(snap, key, compute):
+    """
+    Memoriza en la sesión un cálculo que solo depende de la versión del snapshot: los
+    reruns (completos o de un fragmento) no lo repiten mientras la planilla no cambie.
+    """
+    cache = st.session_state.get("version_cache")
+    if cache is None or cache["version"] != snap.version:
+        cache = st.session_state.version_cache = {"version": snap.version, "values": {}}
+    values = cache["values"]
+    if key not in values:
+        values[key] = compute()
+    return values[key]
+
+def current_row(row_number):
+    """Datos de la fila en el snapshot vigente (incluye las escrituras pendientes de la sesión)."""
+    snap = get_snapshot_store().current()
+    return memo_by_version(snap, ("fila", row_number), lambda: snap.table.row(row_number))
+
+def get_completeness_index(snap):
+    """Retorna el índice de filas pendientes compartido, sincronizado con la versión del snapshot."""
+    store = get_snapshot_store()
+    index = store.derived("completitud", completeness.CompletenessIndex)
+    index.sync(snap)
+    return index
+
+def get_spatial_index(snap):
+    """Retorna el índice espacial compartido, sincronizado con la versión del snapshot."""
+    store = get_snapshot_store()
+    index = store.derived("espacial", spatial.SpatialIndex)
+    index.sync(snap)
+    return index
+
+def get_operator():
+    """Retorna `(operador base 0, cantidad de operadores)` según el reparto elegido en la barra lateral."""
+    operators = st.session_state.get("operators", 1)
+    return min(st.session_state.get("operator", 1), operators) - 1, operators
+
+def pending_positions(snap):
+    """Posiciones de las filas pendientes del operador en los resultados actuales (una vez por versión y búsqueda)."""
+    operator, operators = get_operator()
+    return memo_by_version(
+        snap, ("pendientes", st.session_state.search_term, operator, operators),
+        lambda: get_completeness_index(snap).pending_positions(st.session_state.filtered_rows, operator, operators)
+    )
+
+def update_filtered_rows(snap, search_term, keep_page=True):
+    """
+    Recalcula las filas que cumplen la búsqueda, ordenadas por relevancia. La fila
+    seleccionada (identificada por su número de fila) no cambia: si sigue en los
+    resultados se conserva su posición y, con `keep_page`, se muestra su página.
+    """
+    rows = memo_by_version(snap, ("busqueda", search_term), lambda: get_search_index(snap).ranked(search_term))
+    st.session_state.filtered_rows = rows
+    selected = st.session_state.selected_row
+    position = rows.index(selected) if selected is not None and selected in rows else None
+    st.session_state.current_row_index = position
+    st.session_state.page_start = search.page_of(rows, position)[0] if keep_page and position is not None else 0
+
+def select_position(position):
+    """Selecciona la fila que ocupa la posición indicada en los resultados."""
+    rows = st.session_state.filtered_rows
+    st.session_state.current_row_index = position
+    st.session_state.selected_row = rows[position]
+    st.session_state.page_start = search.page_of(rows, position)[0]
+
+def select_row_on_page(page_start, page_labels):
+    """Callback del selector: selecciona la fila elegida en la página de resultados."""
+    if st.session_state.row_selector is not None:
+        select_position(page_start + page_labels.index(st.session_state.row_selector))
+
+def go_to_page(page_start):
+    """Callback de los botones de página: muestra otra página sin cambiar la fila seleccionada."""
+    st.session_state.page_start = page_start
+
+def get_write_queue():
+    """
+    Retorna la cola de escritura diferida compartida por todas las sesiones del proceso,
+    con su diario local (lo que quedó sin confirmar se reenvía al crearla).
+    """
+    fuentes = init_sources()
+    if not fuentes:
         return None
+    diario = journal.get_journal(journal.journal_path(fuentes.cache_key()))
+    return write_queue.get_queue(fuentes, None, None, store=get_snapshot_store(), route=fuentes.route,
+                                 journal=diario)
+
+def show_save_status(cola, row_number):
+    """Muestra el estado de guardado de la fila y las filas cuyas escrituras fallaron."""
+    estado = cola.status(row_number)
+    if estado is not None:
+        if estado.state in (write_queue.PENDING, write_queue.RETRYING):
+            st.info("Cambios de esta fila pendientes de envío a la planilla."
+                    + (f" {estado.message}" if estado.message else ""))
+        elif estado.state == write_queue.JOURNALED:
+            st.warning("No se pudo conectar con la planilla; los cambios de esta fila quedaron en el diario "
+                       f"local y se enviarán automáticamente cuando vuelva la conexión ({estado.message}).")
+        elif estado.state == write_queue.FAILED:
+            st.error(f"No se pudieron guardar los cambios de esta fila: {estado.message}")
+    fallidas = cola.failed_rows()
+    if fallidas:
+        st.warning("Filas con errores de guardado: " + ", ".join(row_names(sorted(fallidas))))
+    en_diario = cola.journaled_rows()
+    if en_diario:
+        st.info("Filas guardadas localmente, a la espera de conexión con la planilla: "
+                + ", ".join(row_names(sorted(en_diario))))
 
-def load_sheet(client):
-    """Carga la hoja de trabajo de Google Sheets."""
+def show_diagnostics():
+    """
+    Panel de diagnóstico oculto (se muestra con `?diagnostico=1` en la URL): latencias
+    de la API por método, duración de los reruns por fase, snapshot, cachés y cuota.
+    """
+    if not metrics.ENABLED:
+        st.sidebar.info("La instrumentación está desactivada (SHEETS_METRICS=0).")
+        return
+    resumen = metrics.summary()
+    with st.sidebar.expander("Diagnóstico", expanded=True):
+        aciertos = metrics.hit_rate("snapshot_requests_total")
+        if aciertos is not None:
+            st.write(f"**Aciertos de caché del snapshot:** {aciertos:.0%}")
+        indicadores = {
+            fila["metrica"]: fila["valor"] for fila in resumen["indicadores"]
+            if fila["metrica"].startswith("snapshot_")
+        }
+        if indicadores:
+            st.write(
+                f"**Snapshot:** {indicadores.get('snapshot_rows', 0)} filas, "
+                f"{indicadores.get('snapshot_bytes', 0) / 2 ** 20:.1f} MB, "
+                f"versión {indicadores.get('snapshot_version')}, "
+                f"{indicadores.get('snapshot_age_seconds', 0):.0f} s de antigüedad"
+            )
+        st.write("**Latencias (ms)**")
+        st.dataframe(pd.DataFrame(resumen["histogramas"]), hide_index=True, use_container_width=True)
+        st.write("**Contadores**")
+        st.dataframe(pd.DataFrame(resumen["contadores"]), hide_index=True, use_container_width=True)
+        st.write("**Cuota**")
+        st.json(quota.limiter.usage())
+        st.download_button("Descargar métricas (Prometheus)", metrics.prometheus_text(),
+                           file_name="metrics.prom", mime="text/plain")
+
+def read_remote_row(row_number):
+    """
+    Relee de la planilla solo la fila indicada (una petición) y la publica en el
+    snapshot. Retorna `{campo: texto}` con las escrituras locales pendientes de la
+    fila aplicadas encima, o None si no se pudo leer.
+    """
+    fuentes = init_sources()
+    store = get_snapshot_store()
+    if not fuentes or not store:
+        return None
     try:
-        return client.open_by_url(st.secrets["spreadsheet_url"]).sheet1
+        with quota.priority(quota.INTERACTIVE, max_wait=INTERACTIVE_MAX_WAIT):
+            remote = fuentes.get_row(row_number)
     except Exception as e:
-        st.error(f"Error al cargar la planilla: {str(e)}")
+        st.warning(f"No se pudo verificar la fila en la planilla antes de guardar ({str(e)}); "
+                   "se guardará sobre los datos locales.")
         return None
+    store.apply_remote({(row_number, campo): valor for campo, valor in remote.items()})
+    remote.update(store.pending(row_number))
+    return remote
 
-# --- 4. Función para convertir DMS a DD ---
-def dms_to_dd(dms):
-    """Convierte coordenadas en formato DMS (grados, minutos, segundos) a DD (grados decimales)."""
-    parts = re.split('[°\'"]+', dms)
-    degrees = float(parts[0])
-    minutes = float(parts[1])
-    seconds = float(parts[2])
-    direction = parts[3].strip()
-    dd = degrees + minutes / 60 + seconds / 3600
-    if direction in ['S', 'W']:
-        dd *= -1
-    return dd
+def save_row(cola, row_number, base_row, valores, resolution=None):
+    """
+    Guarda los valores del formulario de una fila con control de concurrencia optimista.
 
-# --- 5. Funciones para la actualización periódica de datos ---
-def load_all_data():
-    """Carga todos los datos de la planilla y actualiza el estado de la sesión."""
-    client = init_connection()
-    if not client:
-        return False
+    Antes de escribir relee la fila de la planilla y compara su huella con la de la
+    fila que el usuario tenía a la vista (`base_row`). Si nadie la modificó, se guarda
+    como siempre. Si cambió, los cambios del usuario se aplican sobre la versión de la
+    planilla y, si ambos modificaron el mismo campo, se pide elegir qué valor conservar
+    (`resolution` es `(fila de la planilla, campos en que se conserva su valor)`).
+    """
+    remote = read_remote_row(row_number)
+    fields = list(COLUMNAS)
+    if remote is None or row_fingerprint(remote, fields) == row_fingerprint(base_row, fields):
+        metrics.increment("row_saves_total", result="sin_conflicto" if remote is not None else "sin_verificar")
+        celdas, cambios_realizados, avisos = rules.compute_row_changes(base_row, valores)
+        fusionados = []
+    else:
+        conflictos = rules.conflicting_fields(base_row, remote, valores)
+        if resolution is not None and row_fingerprint(remote, fields) != row_fingerprint(resolution[0], fields):
+            # La fila volvió a cambiar mientras se resolvía el conflicto
+            resolution = None
+            st.warning("La fila volvió a cambiar en la planilla; revisa de nuevo los campos en conflicto.")
+        if conflictos and resolution is None:
+            metrics.increment("row_saves_total", result="conflicto")
+            st.session_state.save_conflict = {
+                "fila": row_number, "base": base_row, "remoto": remote,
+                "valores": valores, "conflictos": conflictos,
+            }
+            return
+        metrics.increment("row_saves_total", result="fusionado")
+        keep_remote = resolution[1] if resolution is not None else ()
+        celdas, cambios_realizados, avisos = rules.merge_row_changes(base_row, remote, valores, keep_remote)
+        fusionados = [
+            ETIQUETAS_CAMPOS.get(campo, campo) for campo in COLUMNAS
+            if campo not in celdas
+            and not rules.is_noop(base_row.get(campo) or '', remote.get(campo) or '', CAMPOS_NUMERICOS.get(campo))
+        ]
     
-    sheet = load_sheet(client)
-    if not sheet:
-        return False
+    with metrics.timer("app_rerun_phase_seconds", phase="guardado"):
+        batch_data = {(row_number, campo): valor for campo, valor in celdas.items()}
+        if batch_data:
+            # Se aplica de inmediato sobre el snapshot y se envía en segundo plano
+            store = get_snapshot_store()
+            pendiente = get_completeness_index(store.current()).is_pending(row_number)
+            cola.enqueue(batch_data, author=get_author())
+            if pendiente and not get_completeness_index(store.current()).is_pending(row_number):
+                metrics.increment("rows_completed_total")
+    # El próximo guardado parte de la fila ya guardada
+    st.session_state.edit_base = (row_number, current_row(row_number))
+    for aviso in avisos:
+        st.warning(aviso)
+    if fusionados:
+        st.info("Otra persona modificó esta fila mientras la editabas; se conservaron sus cambios en: "
+                + ", ".join(fusionados) + ".")
     
-    try:
-        # Cargar todos los datos de la hoja
-        all_data = sheet.get_all_values()
-        
-        # Actualizar el estado de la sesión
-        st.session_state.sheet_data = all_data
-        st.session_state.last_update_time = get_chile_timestamp()
-        
-        # Generar opciones de fila (omitiendo la fila de encabezados)
-        row_options = [
-            f"Fila {i} - Cuenta: {all_data[i-1][COLUMNAS['cuenta_nombre']]} (ID: {all_data[i-1][COLUMNAS['cuenta_id']]}) - Campo: {all_data[i-1][COLUMNAS['campo_nombre']]} (ID: {all_data[i-1][COLUMNAS['campo_id']]}) - Sonda: {all_data[i-1][COLUMNAS['sonda_nombre']]} (ID: {all_data[i-1][COLUMNAS['sonda_id']]})"
-            for i in range(2, len(all_data))
-        ]
-        
-        # Aplicar filtro si existe un término de búsqueda
-        if st.session_state.search_term:
-            st.session_state.filtered_options = [
-                row for row in row_options 
-                if st.session_state.search_term.lower() in row.lower()
-            ]
-        else:
-            st.session_state.filtered_options = row_options
-            
-        return True
-    except Exception as e:
-        st.error(f"Error al cargar datos: {str(e)}")
-        return False
-
-def background_update():
-    """Función para actualizar los datos en segundo plano."""
-    while st.session_state.update_running:
-        # Actualizar los datos
-        success = load_all_data()
-        if not success:
-            st.warning("Error en la actualización automática de datos.")
-        
-        # Esperar 120 segundos antes de la próxima actualización
-        time.sleep(120)
+    # Informar solo si se detectaron cambios
+    if batch_data:
+        st.success("Cambios guardados correctamente (se enviarán a la planilla en segundo plano):")
+        for cambio in cambios_realizados:
+            st.write(f"- {cambio}")
+    else:
+        st.info("No se detectaron cambios para guardar.")
 
-def start_background_update():
-    """Inicia el hilo de actualización en segundo plano."""
-    if not st.session_state.update_running:
-        st.session_state.update_running = True
-        update_thread = threading.Thread(target=background_update)
-        update_thread.daemon = True  # El hilo terminará cuando el programa principal termine
-        update_thread.start()
+def reset_edit_form(row_number):
+    """Descarta lo ingresado en el formulario de una fila para que vuelva a mostrar los datos de la planilla."""
+    prefixes = ("superficie_", "caudal_", "ppeq_", "plantas_", "emisores_", "cultivo_",
+                "variedad_", "ano_", "ubicacion_sonda_", "cb_")
+    for key in list(st.session_state.keys()):
+        if key.startswith(prefixes) and key.endswith(f"_{row_number}"):
+            del st.session_state[key]
+
+def show_save_conflict(cola, row_number):
+    """Pide elegir, campo por campo, entre el valor propio y el que otra persona guardó en la planilla."""
+    conflicto = st.session_state.get("save_conflict")
+    if not conflicto or conflicto["fila"] != row_number:
+        return
+    st.warning("Otra persona modificó esta fila mientras la editabas. Elige qué valor conservar en cada campo:")
+    elecciones = {}
+    for campo, (original, remoto, propio) in conflicto["conflictos"].items():
+        elecciones[campo] = st.radio(
+            ETIQUETAS_CAMPOS.get(campo, "Comentario"),
+            ["Mi valor", "Valor de la planilla"],
+            captions=[propio or "(vacío)", remoto or "(vacío)"],
+            horizontal=True,
+            key=f"conflicto_{row_number}_{campo}",
+            help=f"Valor original: {original or '(vacío)'}"
+        )
+    c1, c2 = st.columns(2)
+    with c1:
+        resolver = st.button("Guardar con esta selección", type="primary")
+    with c2:
+        descartar = st.button("Descartar mis cambios")
+    if resolver:
+        del st.session_state.save_conflict
+        keep_remote = [campo for campo, eleccion in elecciones.items() if eleccion == "Valor de la planilla"]
+        save_row(cola, row_number, conflicto["base"], conflicto["valores"], (conflicto["remoto"], keep_remote))
+    elif descartar:
+        del st.session_state.save_conflict
+        reset_edit_form(row_number)
+        st.rerun()
 
 # --- 6. Función de acceso seguro a datos ---
 def get_safe_value(row_data, col_key, default=''):
-    """Obtiene de forma segura un valor de la fila de datos por su clave del mapeo."""
-    col_idx = COLUMNAS.get(col_key)
-    if col_idx is None:
+    """Obtiene de forma segura un valor de la fila de datos (diccionario {campo: valor} del snapshot) por su clave del mapeo."""
+    if col_key not in COLUMNAS:
         return default
-    if len(row_data) > col_idx:
-        return row_data[col_idx]
-    return default
-
-# --- 7. Función para obtener la letra de columna a partir del índice ---
-def get_column_letter(col_idx):
-    """Convierte un índice numérico a letra de columna de Excel."""
-    result = ""
-    while col_idx >= 0:
-        remainder = col_idx % 26
-        result = chr(65 + remainder) + result
-        col_idx = col_idx // 26 - 1
-    return result
+    value = row_data.get(col_key)
+    return default if value is None else value
 
-# --- 8. Función Principal ---
-def main():
-    """Función principal que gestiona la interfaz de usuario y el flujo de datos."""
+# --- 7. Fragmentos de la interfaz ---
+# Cada fragmento se vuelve a ejecutar solo cuando cambia uno de sus widgets: el resto
+# de la página no se recalcula ni se reenvía al navegador. Lo que afecta a otra zona
+# (elegir otra fila) pide un rerun completo con st.rerun().
+def fragment(name):
+    """Declara un fragmento de Streamlit y mide la duración de cada ejecución."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            with metrics.timer("app_fragment_seconds", fragment=name):
+                return fn(*args, **kwargs)
+        return st.fragment(timed)
+    return decorate
+
+@fragment("seleccion")
+def show_row_selector():
+    """
+    Búsqueda y selección de fila en la barra lateral. Escribir en el buscador o cambiar
+    de página no modifica la fila en edición; al elegir una fila se recarga la página.
+    """
+    snap = get_snapshot_store().current()
+    sync_session(snap)
     
-    # Cargar datos si aún no se han cargado
-    if not st.session_state.sheet_data:
-        with st.spinner("Cargando datos de la planilla..."):
-            load_all_data()
+    st.subheader("Buscar Fila")
+    search_term = st.text_input(
+        "Buscar por término (Cuenta, Campo, Sonda...)", 
+        value=st.session_state.search_term,
+        key="search_input",
+        help="Sin distinguir mayúsculas ni tildes. Un número solo también busca ese número de fila, y se puede pegar "
+             "la etiqueta de una fila. Se puede acotar por campo: cuenta:123, campo:..., sonda:..., cultivo:..., "
+             "variedad:..., fuente:..., fila:..."
+    )
     
-    # Iniciar la actualización en segundo plano si aún no se ha iniciado
-    start_background_update()
+    # Actualizar término de búsqueda si cambió; una búsqueda nueva muestra los resultados más relevantes
+    if search_term != st.session_state.search_term:
+        st.session_state.search_term = search_term
+        with metrics.timer("app_rerun_phase_seconds", phase="busqueda"):
+            update_filtered_rows(snap, search_term, keep_page=False)
     
-    # Verificar si tenemos datos cargados
-    if not st.session_state.sheet_data:
-        st.error("No se pudieron cargar los datos. Por favor, recarga la página.")
+    filtered_rows = st.session_state.filtered_rows
+    if len(filtered_rows) == 0:
+        st.warning("No se encontraron filas que coincidan con el término de búsqueda.")
         return
     
-    all_rows = st.session_state.sheet_data
+    # Mostrar la hora de la última actualización (y si los datos son la copia guardada en disco)
+    if st.session_state.last_update_time:
+        verificando = " · verificando cambios en la planilla..." if get_snapshot_store().from_cache else ""
+        st.markdown(
+            f"<div class='last-update'>Última actualización: {st.session_state.last_update_time}{verificando}</div>",
+            unsafe_allow_html=True
+        )
     
-    # Barra lateral: búsqueda, selección y edición del comentario
-    with st.sidebar:
-        st.subheader("Buscar Fila")
-        search_term = st.text_input(
-            "Buscar por término (Cuenta, Campo, Sonda...)", 
-            value=st.session_state.search_term,
-            key="search_input"
+    # Solo se envía al navegador la página de resultados visible
+    page_start = min(st.session_state.page_start, len(filtered_rows) - 1)
+    page_start, page_rows = search.page_of(filtered_rows, page_start)
+    index = get_search_index(snap)
+    page_labels = memo_by_version(
+        snap, ("pagina", search_term, page_start),
+        lambda: [index.label(row_number) for row_number in page_rows]
+    )
+    position = st.session_state.current_row_index
+    on_page = position is not None and page_start <= position < page_start + len(page_rows)
+    st.session_state.row_selector = page_labels[position - page_start] if on_page else None
+    with metrics.timer("app_rerun_phase_seconds", phase="selector"):
+        st.selectbox(
+            "Selecciona una fila", 
+            page_labels,
+            key="row_selector",
+            placeholder="Elige una fila de los resultados",
+            on_change=select_row_on_page,
+            args=(page_start, page_labels)
         )
-        
-        # Actualizar término de búsqueda si cambió
-        if search_term != st.session_state.search_term:
-            st.session_state.search_term = search_term
-            # Regenerar opciones filtradas
-            row_options = [
-                f"Fila {i} - Cuenta: {all_rows[i-1][COLUMNAS['cuenta_nombre']]} (ID: {all_rows[i-1][COLUMNAS['cuenta_id']]}) - Campo: {all_rows[i-1][COLUMNAS['campo_nombre']]} (ID: {all_rows[i-1][COLUMNAS['campo_id']]}) - Sonda: {all_rows[i-1][COLUMNAS['sonda_nombre']]} (ID: {all_rows[i-1][COLUMNAS['sonda_id']]})"
-                for i in range(2, len(all_rows))
-            ]
-            if search_term:
-                st.session_state.filtered_options = [row for row in row_options if search_term.lower() in row.lower()]
-            else:
-                st.session_state.filtered_options = row_options
-        
-        filtered_options = st.session_state.filtered_options
-        
-        if len(filtered_options) > 0:
-            # Mostrar la hora de la última actualización
-            if st.session_state.last_update_time:
-                st.markdown(
-                    f"<div class='last-update'>Última actualización: {get_chile_timestamp()}</div>",
-                    unsafe_allow_html=True
-                )
-            
-            selected_row = st.selectbox(
-                "Selecciona una fila", 
-                filtered_options,
-                index=min(st.session_state.current_row_index, len(filtered_options) - 1),
-                key="row_selector"
-            )
-            st.session_state.current_row_index = filtered_options.index(selected_row)
-        else:
-            st.warning("No se encontraron filas que coincidan con el término de búsqueda.")
-            return
+    # La fila elegida se muestra en el resto de la página con un rerun completo
+    if st.session_state.selected_row != st.session_state.get("rendered_row"):
+        st.rerun()
     
-    # Obtener datos de la fila seleccionada
-    selected_row_index = int(selected_row.split(" ")[1])
-    row_data = all_rows[selected_row_index - 1]  # -1 porque los índices en la UI comienzan en 1
+    # Navegación entre páginas de resultados
+    page_end = page_start + len(page_rows)
+    st.caption(f"Resultados {page_start + 1}–{page_end} de {len(filtered_rows)}")
+    prev_col, next_col = st.columns(2)
+    with prev_col:
+        st.button("◀ Anterior", disabled=page_start == 0, use_container_width=True,
+                  on_click=go_to_page, args=(page_start - search.PAGE_SIZE,))
+    with next_col:
+        st.button("Siguiente ▶", disabled=page_end >= len(filtered_rows), use_container_width=True,
+                  on_click=go_to_page, args=(page_end,))
     
-    # Información de la fila y comentario editable en la barra lateral
-    with st.sidebar:
-        st.subheader("Información de la fila seleccionada")
-        st.write(f"**Cuenta:** {get_safe_value(row_data, 'cuenta_nombre')} [ID: {get_safe_value(row_data, 'cuenta_id')}]")
-        st.write(f"**Campo:** {get_safe_value(row_data, 'campo_nombre')} [ID: {get_safe_value(row_data, 'campo_id')}]")
-        st.write(f"**Sonda:** {get_safe_value(row_data, 'sonda_nombre')} [ID: {get_safe_value(row_data, 'sonda_id')}]")
-        
-        cuenta_id = get_safe_value(row_data, 'cuenta_id')
-        campo_id = get_safe_value(row_data, 'campo_id')
-        sonda_id = get_safe_value(row_data, 'sonda_id')
-        
-        st.markdown(
-            "[Ver Campo](https://www.dropcontrol.com/site/dashboard/campo.do"
-            f"?cuentaId={cuenta_id}&campoId={campo_id})"
-            " | "
-            "[Ver Sonda](https://www.dropcontrol.com/site/ha/suelo.do"
-            f"?cuentaId={cuenta_id}&campoId={campo_id}&sectorId={sonda_id})"
-             " | "
-            f"[Ver Admin](https://admin.dropcontrol.com/farms/zone?farm={campo_id}&zone={sonda_id})"
-        )
-        
-        sidebar_comment = st.text_area(
-            "**Comentario Actual:**", 
-            value=get_safe_value(row_data, 'comentario'), 
-            key=f"sidebar_comment_{selected_row_index}"  # Clave única
-        )
-        
-        # Botón para actualizar comentario desde la barra lateral
-        if st.button("Actualizar comentario"):
-            current_comment = get_safe_value(row_data, 'comentario')
-            if sidebar_comment != current_comment:
-                try:
-                    # Iniciamos una nueva conexión para actualizar el comentario
-                    client = init_connection()
-                    if client:
-                        sheet = load_sheet(client)
-                        if sheet:
-                            # Actualiza la celda del comentario
-                            col_letter = get_column_letter(COLUMNAS['comentario'])
-                            sheet.update(f"{col_letter}{selected_row_index}", [[sidebar_comment]])
-                            st.success("Comentario actualizado desde la barra lateral.")
-                            
-                            # Forzar recarga de datos
-                            load_all_data()
-                except Exception as e:
-                    st.error("Error actualizando comentario: " + str(e))
-            else:
-                st.info("No se detectaron cambios en el comentario.")
+    # Cola de trabajo: "Siguiente fila" salta a la próxima fila incompleta o inconsistente
+    if st.toggle("Saltar a filas pendientes", key="pending_mode",
+                 help="«Siguiente fila» pasa directo a la próxima fila de los resultados a la que le faltan datos "
+                      "o tiene campos derivados inconsistentes"):
+        with st.expander("Repartir entre operadores"):
+            operators = st.number_input("Operadores", min_value=1, max_value=50, step=1, key="operators")
+            if st.session_state.get("operator", 1) > operators:
+                st.session_state.operator = operators
+            st.number_input("Soy el operador", min_value=1, max_value=operators, step=1, key="operator",
+                            help="Cada operador recibe bloques de filas distintos, sin superponerse con los demás")
+        pendientes = len(pending_positions(snap))
+        st.caption(f"{pendientes} filas pendientes en los resultados"
+                   + (" para este operador" if get_operator()[1] > 1 else "")
+                   + f" ({get_completeness_index(snap).pending_count()} en toda la planilla)")
+
+@fragment("comentario")
+def show_comment_editor(selected_row_index):
+    """Comentario editable de la fila y estado de guardado (barra lateral)."""
+    row_data = current_row(selected_row_index)
+    sidebar_comment = st.text_area(
+        "**Comentario Actual:**", 
+        value=get_safe_value(row_data, 'comentario'), 
+        key=f"sidebar_comment_{selected_row_index}"  # Clave única
+    )
     
-    # Formulario de edición en la zona principal
-    st.subheader("Formulario de Edición")
+    # Estado de guardado de la fila (escrituras en segundo plano)
+    cola = get_write_queue()
+    if cola:
+        show_save_status(cola, selected_row_index)
     
-    # --- BOTÓN PARA ACCEDER A LA PLANILLA DE GOOGLE ---
-    SPREADSHEET_URL = st.secrets["spreadsheet_url"]
-    html_button = f"""
-    <div style="text-align: left; margin-bottom: 10px;">
-        <a href="{SPREADSHEET_URL}" target="_blank">
-            <button style="
-                background-color: #4CAF50;
-                color: white;
-                border: none;
-                padding: 6px 12px;
-                text-align: center;
-                text-decoration: none;
-                display: inline-block;
-                font-size: 14px;
-                border-radius: 5px;
-                cursor: pointer;">
-                Abrir Planilla de Google
-            </button>
-        </a>
-    </div>
-    """
-    components.html(html_button, height=50)
+    # Botón para actualizar comentario desde la barra lateral
+    if st.button("Actualizar comentario"):
+        current_comment = get_safe_value(row_data, 'comentario')
+        if sidebar_comment != current_comment:
+            # Encolar la actualización; el snapshot local refleja el comentario de inmediato
+            if cola:
+                cola.enqueue({(selected_row_index, 'comentario'): sidebar_comment}, author=get_author())
+                st.success("Comentario actualizado desde la barra lateral.")
+            else:
+                st.error("Error actualizando comentario: no se pudo establecer conexión.")
+        else:
+            st.info("No se detectaron cambios en el comentario.")
+
+@fragment("formulario")
+def show_edit_form(selected_row_index):
+    """Formulario de edición de la fila seleccionada."""
+    row_data = current_row(selected_row_index)
+    # Fila tal como se mostró en la ejecución anterior: es la que el usuario editó
+    previous = st.session_state.get("edit_base")
+    base_row = previous[1] if previous and previous[0] == selected_row_index else row_data
+    st.session_state.edit_base = (selected_row_index, row_data)
+    
+    # Lo que le falta a la fila según el índice de completitud
+    problemas = get_completeness_index(get_snapshot_store().current()).issues(selected_row_index)
+    if problemas:
+        st.caption(f"Fila pendiente: {completeness.describe(problemas)}.")
     
     # Inicio del formulario de edición
     form_key = f"edit_form_{selected_row_index}"  # Clave única para el formulario basada en la fila
@@ -394,16 +850,9 @@ def main():
             )
         with col3:
             st.markdown("**Comentarios (selección rápida):**")
-            comentarios_lista = [
-                "La cuenta no existe", "La sonda no existe o no está asociada",
-                "Sonda no georreferenciable", "La sonda no tiene sensores habilitados",
-                "La sonda no está operando", "No hay datos de cultivo",
-                "Datos de cultivo incompletos", "Datos de cultivo no son reales",
-                "Consultar datos faltantes"
-            ]
-            comentarios_actuales = get_safe_value(row_data, 'comentario').split(", ") if get_safe_value(row_data, 'comentario') else []
+            comentarios_actuales = rules.split_comments(get_safe_value(row_data, 'comentario'))
             comentarios_seleccionados = []
-            for i, comentario in enumerate(comentarios_lista):
+            for i, comentario in enumerate(rules.COMENTARIOS_LISTA):
                 is_checked = comentario in comentarios_actuales
                 if st.checkbox(comentario, value=is_checked, key=f"cb_{i}_{selected_row_index}"):
                     comentarios_seleccionados.append(comentario)
@@ -415,213 +864,157 @@ def main():
         with c2:
             next_button = st.form_submit_button(
                 label="Siguiente fila",
-                help="Ir a la siguiente fila en la lista filtrada"
+                help="Ir a la siguiente fila en la lista filtrada (o a la siguiente pendiente, si está activado en la barra lateral)"
             )
         
         # Procesar los envíos del formulario
         if submit_button or next_button:
             # Si se presiona "Siguiente fila", se salta el guardado y se avanza a la siguiente fila
-            if next_button:
-                if st.session_state.current_row_index < len(filtered_options) - 1:
-                    st.session_state.current_row_index += 1
+            # (o a la siguiente fila pendiente, según la cola de trabajo)
+            if next_button and st.session_state.get("pending_mode"):
+                snap = get_snapshot_store().current()
+                sync_session(snap)
+                position = st.session_state.current_row_index
+                next_position = completeness.next_position(pending_positions(snap), position)
+                if next_position is None:
+                    st.success("No quedan filas pendientes en la lista filtrada.")
+                elif next_position == position:
+                    st.info("Esta es la única fila pendiente de la lista filtrada.")
+                else:
+                    select_position(next_position)
+                    st.rerun()
+            elif next_button:
+                position = st.session_state.current_row_index
+                next_position = 0 if position is None else position + 1
+                if next_position < len(st.session_state.filtered_rows):
+                    select_position(next_position)
                     st.rerun()
                 else:
                     st.warning("Ya estás en la última fila de la lista filtrada.")
             else:
-                # Iniciar conexión para guardar cambios
-                client = init_connection()
-                if not client:
+                # Obtener la cola de escritura compartida para guardar cambios
+                cola = get_write_queue()
+                if not cola:
                     st.error("No se pudo establecer conexión para guardar cambios.")
                     return
                 
-                sheet = load_sheet(client)
-                if not sheet:
-                    st.error("No se pudo cargar la hoja para guardar cambios.")
-                    return
-                
-                cambios_realizados = []
-                batch_data = {}
-                
-                # --- Ubicación y conversión de coordenadas (DMS a DD) ---
-                current_ubicacion = get_safe_value(row_data, 'ubicacion_sonda')
-                if ubicacion_sonda.strip() != current_ubicacion.strip():
-                    if ubicacion_sonda.strip():
-                        lat_parts = ubicacion_sonda.split()
-                        if len(lat_parts) >= 2:
-                            try:
-                                latitud_dd = dms_to_dd(lat_parts[0])
-                                longitud_dd = dms_to_dd(lat_parts[1])
-                                latitud_sonda = f"{latitud_dd:.8f}".replace(".", ",")
-                                longitud_sonda = f"{longitud_dd:.8f}".replace(".", ",")
-                                batch_data[f"{get_column_letter(COLUMNAS['ubicacion_sonda'])}{selected_row_index}"] = ubicacion_sonda
-                                batch_data[f"{get_column_letter(COLUMNAS['latitud_sonda'])}{selected_row_index}"] = latitud_sonda
-                                batch_data[f"{get_column_letter(COLUMNAS['longitud_sonda'])}{selected_row_index}"] = longitud_sonda
-                                cambios_realizados.append("Ubicación sonda actualizada")
-                            except Exception as e:
-                                st.warning(f"Error al convertir la ubicación: {str(e)}; se mantendrá el valor anterior.")
-                    else:
-                        batch_data[f"{get_column_letter(COLUMNAS['ubicacion_sonda'])}{selected_row_index}"] = ""
-                        batch_data[f"{get_column_letter(COLUMNAS['latitud_sonda'])}{selected_row_index}"] = ""
-                        batch_data[f"{get_column_letter(COLUMNAS['longitud_sonda'])}{selected_row_index}"] = ""
-                        cambios_realizados.append("Ubicación sonda actualizada")
-                
-                # --- Actualización de textos ---
-                current_cultivo = get_safe_value(row_data, 'cultivo')
-                if cultivo.strip() != current_cultivo.strip():
-                    batch_data[f"{get_column_letter(COLUMNAS['cultivo'])}{selected_row_index}"] = cultivo
-                    cambios_realizados.append("Cultivo actualizado")
-                
-                current_variedad = get_safe_value(row_data, 'variedad')
-                if variedad.strip() != current_variedad.strip():
-                    batch_data[f"{get_column_letter(COLUMNAS['variedad'])}{selected_row_index}"] = variedad
-                    cambios_realizados.append("Variedad actualizada")
-                
-                # --- Procesar Año de plantación: eliminar comilla y convertir a número ---
-                current_ano = get_safe_value(row_data, 'ano_plantacion')
-                cleaned_ano = ano_plantacion.strip().lstrip("'")
-                if cleaned_ano:
-                    try:
-                        ano_val = int(cleaned_ano)
-                    except Exception:
-                        ano_val = cleaned_ano
-                else:
-                    ano_val = ""
-                if str(ano_val) != current_ano.strip().lstrip("'"):
-                    batch_data[f"{get_column_letter(COLUMNAS['ano_plantacion'])}{selected_row_index}"] = ano_val
-                    cambios_realizados.append("Año plantación actualizado")
-                
-                # --- Procesamiento de N° plantas y N° emisores (total) ---
-                current_plantas_total = get_safe_value(row_data, 'plantas_total')
-                current_emisores_total = get_safe_value(row_data, 'emisores_total')
-                
-                # Limpiar y procesar valores de entrada
-                plantas_cleaned = plantas_total.strip().lstrip("'").replace(",", "")
-                emisores_cleaned = emisores_total.strip().lstrip("'").replace(",", "")
-                
-                # Actualizar plantas total si cambió
-                if plantas_cleaned != current_plantas_total.strip():
-                    batch_data[f"{get_column_letter(COLUMNAS['plantas_total'])}{selected_row_index}"] = plantas_cleaned if plantas_cleaned else ""
-                    cambios_realizados.append("N° plantas actualizado")
-                
-                # Actualizar emisores total si cambió
-                if emisores_cleaned != current_emisores_total.strip():
-                    batch_data[f"{get_column_letter(COLUMNAS['emisores_total'])}{selected_row_index}"] = emisores_cleaned if emisores_cleaned else ""
-                    cambios_realizados.append("N° emisores actualizado")
-                
-                # --- Procesamiento de Superficie (ha) y Superficie (m2) ---
-                current_superficie = get_safe_value(row_data, 'superficie_ha')
-                cleaned_superficie = superficie_ha.strip().lstrip("'").replace(",", ".")
-                try:
-                    superficie_val = float(cleaned_superficie) if cleaned_superficie else ""
-                except Exception:
-                    superficie_val = cleaned_superficie
-                
-                row_data_superficie = current_superficie.strip().lstrip("'").replace(",", ".")
-                try:
-                    current_superficie_val = float(row_data_superficie) if row_data_superficie else ""
-                except Exception:
-                    current_superficie_val = row_data_superficie
-                
-                if superficie_val != current_superficie_val:
-                    if superficie_val != "":
-                        try:
-                            superficie_m2 = float(superficie_val) * 10000
-                            batch_data[f"{get_column_letter(COLUMNAS['superficie_ha'])}{selected_row_index}"] = superficie_val
-                            batch_data[f"{get_column_letter(COLUMNAS['superficie_m2'])}{selected_row_index}"] = superficie_m2
-                            cambios_realizados.append("Superficie actualizada")
-                        except Exception as e:
-                            st.warning(f"Error al procesar superficie: {str(e)}; se mantendrá el valor anterior.")
-                    else:
-                        batch_data[f"{get_column_letter(COLUMNAS['superficie_ha'])}{selected_row_index}"] = ""
-                        batch_data[f"{get_column_letter(COLUMNAS['superficie_m2'])}{selected_row_index}"] = ""
-                        cambios_realizados.append("Superficie actualizada")
-                
-                # --- Cálculo de densidades para N° plantas/ha y N° emisores/ha ---
-                # Solo calculamos densidades si tenemos superficie y los valores correspondientes
-                if (plantas_cleaned or emisores_cleaned) and superficie_val not in ["", None, 0]:
-                    try:
-                        # Calcular densidad de plantas/ha si tenemos datos de plantas
-                        if plantas_cleaned:
-                            plantas_int = int(plantas_cleaned)
-                            densidad_plantas = math.ceil(plantas_int / float(superficie_val))
-                            batch_data[f"{get_column_letter(COLUMNAS['plantas_ha'])}{selected_row_index}"] = densidad_plantas
-                            cambios_realizados.append("Densidad plantas/ha actualizada")
-                        
-                        # Calcular densidad de emisores/ha si tenemos datos de emisores
-                        if emisores_cleaned:
-                            emisores_int = int(emisores_cleaned)
-                            densidad_emisores = math.ceil(emisores_int / float(superficie_val))
-                            batch_data[f"{get_column_letter(COLUMNAS['emisores_ha'])}{selected_row_index}"] = densidad_emisores
-                            cambios_realizados.append("Densidad emisores/ha actualizada")
-                            
-                    except Exception as e:
-                        st.warning(f"Error al calcular densidades: {str(e)}")
-                else:
-                    # Si no tenemos superficie o valores, limpiamos los campos de densidad
-                    if not superficie_val or superficie_val in ["", None, 0]:
-                        batch_data[f"{get_column_letter(COLUMNAS['plantas_ha'])}{selected_row_index}"] = ""
-                        batch_data[f"{get_column_letter(COLUMNAS['emisores_ha'])}{selected_row_index}"] = ""
-                        cambios_realizados.append("Densidades limpiadas (falta superficie)")
-                
-                # --- Actualización de Caudal teórico (m3/h) ---
-                current_caudal = get_safe_value(row_data, 'caudal_teorico')
-                cleaned_caudal = caudal_teorico.strip().lstrip("'").replace(",", ".")
-                try:
-                    caudal_val = float(cleaned_caudal) if cleaned_caudal else ""
-                except Exception:
-                    caudal_val = cleaned_caudal
-                
-                row_data_caudal = current_caudal.strip().lstrip("'").replace(",", ".")
-                try:
-                    current_caudal_val = float(row_data_caudal) if row_data_caudal else ""
-                except Exception:
-                    current_caudal_val = row_data_caudal
-                
-                if caudal_val != current_caudal_val:
-                    batch_data[f"{get_column_letter(COLUMNAS['caudal_teorico'])}{selected_row_index}"] = caudal_val
-                    cambios_realizados.append("Caudal teórico actualizado")
-                
-                # --- Actualización de PPeq [mm/h] ---
-                current_ppeq = get_safe_value(row_data, 'ppeq_mm_h')
-                cleaned_ppeq = ppeq_mm_h.strip().lstrip("'").replace(",", ".")
-                try:
-                    ppeq_val = float(cleaned_ppeq) if cleaned_ppeq else ""
-                except Exception:
-                    ppeq_val = cleaned_ppeq
-                
-                row_data_ppeq = current_ppeq.strip().lstrip("'").replace(",", ".")
-                try:
-                    current_ppeq_val = float(row_data_ppeq) if row_data_ppeq else ""
-                except Exception:
-                    current_ppeq_val = row_data_ppeq
-                
-                if ppeq_val != current_ppeq_val:
-                    batch_data[f"{get_column_letter(COLUMNAS['ppeq_mm_h'])}{selected_row_index}"] = ppeq_val
-                    cambios_realizados.append("PPeq actualizado")
-                
-                # --- Actualización de comentarios vía checkboxes ---
-                if comentarios_seleccionados:
-                    nuevo_comentario = ", ".join(comentarios_seleccionados)
-                    current_comment = row_data[41] if len(row_data) > 41 else ""
-                    if nuevo_comentario != current_comment.strip():
-                        batch_data[f"AP{selected_row_index}"] = nuevo_comentario
-                        cambios_realizados.append("Comentarios actualizados (checkboxes)")
-                
-                # Actualizar solo si se detectaron cambios
-                if batch_data:
-                    try:
-                        sheet.batch_update([{"range": k, "values": [[v]]} for k, v in batch_data.items()])
-                        st.success("Cambios guardados correctamente:")
-                        for cambio in cambios_realizados:
-                            st.write(f"- {cambio}")
-                        
-                        # Forzar una recarga de datos después de guardar cambios
-                        load_all_data()
-                    except Exception as e:
-                        st.error(f"Error al guardar cambios: {str(e)}")
-                else:
-                    st.info("No se detectaron cambios para guardar.")
+                valores = {
+                    'superficie_ha': superficie_ha,
+                    'caudal_teorico': caudal_teorico,
+                    'ppeq_mm_h': ppeq_mm_h,
+                    'plantas_total': plantas_total,
+                    'emisores_total': emisores_total,
+                    'cultivo': cultivo,
+                    'variedad': variedad,
+                    'ano_plantacion': ano_plantacion,
+                    'ubicacion_sonda': ubicacion_sonda,
+                    'comentarios': comentarios_seleccionados,
+                }
+                st.session_state.pop("save_conflict", None)
+                save_row(cola, selected_row_index, base_row, valores)
+    
+    # Resolución de conflictos con cambios de otra persona (fuera del formulario)
+    cola = get_write_queue()
+    if cola:
+        show_save_conflict(cola, selected_row_index)
+
+# --- 8. Función Principal ---
+def main():
+    """Función principal que gestiona la interfaz de usuario y el flujo de datos."""
+    
+    # Obtener el snapshot compartido (se descarga solo si no existe o expiró)
+    if st.session_state.snapshot_version is None:
+        with st.spinner("Cargando datos de la planilla..."):
+            snap = load_all_data()
+    else:
+        snap = load_all_data()
+    
+    # Verificar si tenemos datos cargados
+    if not snap or not len(snap.table):
+        st.error("No se pudieron cargar los datos. Por favor, recarga la página.")
+        return
+    
+    # Al inicio (o si la fila seleccionada ya no existe) se selecciona el primer resultado
+    selected = st.session_state.selected_row
+    if (selected is None or selected not in snap.table) and st.session_state.filtered_rows:
+        select_position(0)
+    
+    # Fila que se muestra en esta ejecución (el selector pide un rerun completo si cambia)
+    selected_row_index = st.session_state.selected_row
+    st.session_state.rendered_row = selected_row_index
+    
+    # Barra lateral: búsqueda y selección de fila
+    with st.sidebar:
+        show_row_selector()
+    
+    if selected_row_index is None or selected_row_index not in snap.table:
+        return
+    
+    # Obtener datos de la fila seleccionada
+    row_data = current_row(selected_row_index)
+    
+    # Información de la fila y comentario editable en la barra lateral
+    with st.sidebar:
+        st.subheader("Información de la fila seleccionada")
+        if row_data.get(sources.SOURCE_FIELD):
+            st.write(f"**Fuente:** {row_data[sources.SOURCE_FIELD]} (fila {split_row_id(selected_row_index)[1]})")
+        st.write(f"**Cuenta:** {get_safe_value(row_data, 'cuenta_nombre')} [ID: {get_safe_value(row_data, 'cuenta_id')}]")
+        st.write(f"**Campo:** {get_safe_value(row_data, 'campo_nombre')} [ID: {get_safe_value(row_data, 'campo_id')}]")
+        st.write(f"**Sonda:** {get_safe_value(row_data, 'sonda_nombre')} [ID: {get_safe_value(row_data, 'sonda_id')}]")
+        
+        cuenta_id = get_safe_value(row_data, 'cuenta_id')
+        campo_id = get_safe_value(row_data, 'campo_id')
+        sonda_id = get_safe_value(row_data, 'sonda_id')
+        
+        st.markdown(
+            "[Ver Campo](https://www.dropcontrol.com/site/dashboard/campo.do"
+            f"?cuentaId={cuenta_id}&campoId={campo_id})"
+            " | "
+            "[Ver Sonda](https://www.dropcontrol.com/site/ha/suelo.do"
+            f"?cuentaId={cuenta_id}&campoId={campo_id}&sectorId={sonda_id})"
+             " | "
+            f"[Ver Admin](https://admin.dropcontrol.com/farms/zone?farm={campo_id}&zone={sonda_id})"
+        )
+        
+        show_comment_editor(selected_row_index)
+        
+        with st.expander("Sondas cercanas"):
+            show_nearby_sondas(snap, selected_row_index)
+        
+        # Revisión de los campos derivados de toda la planilla
+        with st.expander("Consistencia de campos derivados"):
+            show_consistency_check(snap)
+        
+        # Revisión de las coordenadas de toda la planilla
+        with st.expander("Coordenadas duplicadas o fuera de su campo"):
+            show_coordinate_check(snap)
+    
+    # Vista de tabla de la página de resultados en lugar del formulario de una fila
+    if st.toggle("Vista de tabla", key="grid_mode", help="Edita varias filas de la página de resultados a la vez"):
+        page_start = min(st.session_state.page_start, len(st.session_state.filtered_rows) - 1)
+        show_grid_editor(snap, search.page_of(st.session_state.filtered_rows, page_start)[1])
+        return
+    
+    # Edición masiva de todas las filas filtradas en lugar del formulario de una fila
+    if st.toggle("Edición masiva", key="bulk_mode", help="Aplica los mismos cambios a todas las filas del filtro actual"):
+        show_bulk_editor(snap, sorted(st.session_state.filtered_rows))
+        return
+    
+    # Formulario de edición en la zona principal
+    st.subheader("Formulario de Edición")
+    
+    # --- BOTÓN PARA ACCEDER A LA PLANILLA DE GOOGLE ---
+    fuentes = init_sources()
+    SPREADSHEET_URL = fuentes.source_of(selected_row_index).url if fuentes else st.secrets["spreadsheet_url"]
+    # Enlace nativo: no carga streamlit.components ni crea un iframe en cada rerun
+    st.link_button("Abrir Planilla de Google", SPREADSHEET_URL)
+    
+    show_edit_form(selected_row_index)
 
 # Punto de entrada de la aplicación
 if __name__ == "__main__":
-    main()
+    metrics.start_dumper()
+    with metrics.timer("app_rerun_seconds"):
+        main()
+    if st.query_params.get("diagnostico") == "1":
+        show_diagnostics()
@@ -0,0 +1,150 @@
+"""
+Índice de completitud: qué filas necesitan trabajo y por qué.
+
+Una fila está pendiente si le falta alguno de los datos que se completan desde
+el formulario (superficie, caudal, PPeq, plantas, goteros, cultivo, variedad,
+año de plantación, coordenadas) o si sus campos derivados no coinciden con lo
+esperado (`consistency.derived_changes`). Los problemas de cada fila se guardan
+como una máscara de bits.
+
+Como el índice de búsqueda, se calcula una vez por versión del snapshot en una
+pasada vectorizada y se comparte entre sesiones; cuando el snapshot informa qué
+filas cambiaron (p. ej. al guardar), solo se recalculan esas filas. Las posiciones
+de las filas pendientes dentro de unos resultados se calculan una vez y, sobre
+ellas, la siguiente pendiente se encuentra con una búsqueda binaria en lugar de
+avanzar fila por fila.
+
+La cola se puede repartir entre varios operadores sin que se superpongan: cada
+bloque de OPERATOR_BLOCK filas consecutivas (que suelen ser de la misma cuenta y
+campo) corresponde a un solo operador.
+"""
+import bisect
+import threading
+
+import numpy as np
+
+import consistency
+import metrics
+
+# Datos que se completan desde el formulario: (campo, descripción)
+REQUIRED = [
+    ('superficie_ha', "superficie"),
+    ('caudal_teorico', "caudal"),
+    ('ppeq_mm_h', "PPeq"),
+    ('plantas_total', "N° plantas"),
+    ('emisores_total', "N° goteros"),
+    ('cultivo', "cultivo"),
+    ('variedad', "variedad"),
+    ('ano_plantacion', "año de plantación"),
+]
+# Bits de la máscara de problemas
+COORDINATES = 1 << len(REQUIRED)
+DERIVED = COORDINATES << 1
+# Filas consecutivas que se asignan juntas a un mismo operador
+OPERATOR_BLOCK = 20
+
+
+def row_issues(table):
+    """Máscara de problemas de cada fila de la tabla (arreglo alineado con sus filas; 0 si está completa)."""
+    masks = np.zeros(len(table), dtype=np.int32)
+    for bit, (field, _) in enumerate(REQUIRED):
+        if field in table.numeric:
+            missing = np.isnan(table.numeric[field].to_numpy())
+        else:
+            missing = consistency.is_blank(table, field)
+        masks |= missing.astype(np.int32) << bit
+    masks |= missing_coordinates(table).astype(np.int32) * COORDINATES
+    derived = {row_number for row_number, _ in consistency.derived_changes(table)}
+    if derived:
+        masks |= np.isin(table.row_number_array(), list(derived)).astype(np.int32) * DERIVED
+    return masks
+
+
+def missing_coordinates(table):
+    """Filas sin ubicación o sin coordenadas en grados decimales."""
+    return (
+        consistency.is_blank(table, 'ubicacion_sonda')
+        | np.isnan(table.numeric['latitud_sonda'].to_numpy())
+        | np.isnan(table.numeric['longitud_sonda'].to_numpy())
+    )
+
+
+def describe(mask):
+    """Descripción de los problemas de una máscara, p. ej. "falta superficie, cultivo; campos derivados inconsistentes"."""
+    missing = [name for bit, (_, name) in enumerate(REQUIRED) if mask & (1 << bit)]
+    if mask & COORDINATES:
+        missing.append("coordenadas")
+    parts = ["falta " + ", ".join(missing)] if missing else []
+    if mask & DERIVED:
+        parts.append("campos derivados inconsistentes")
+    return "; ".join(parts)
+
+
+def assigned(row_number, operator, operators):
+    """Indica si la fila corresponde al operador `operator` (base 0) de `operators`."""
+    return operators <= 1 or (row_number // OPERATOR_BLOCK) % operators == operator
+
+
+class CompletenessIndex:
+    """Filas pendientes del snapshot y sus problemas, sincronizado por versión."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self._issues = {}
+
+    def sync(self, snap):
+        """Pone el índice al día con el snapshot, recalculando solo las filas que cambiaron si es posible."""
+        with self._lock:
+            if self.version is not None and snap.version <= self.version:
+                return
+            table = snap.table
+            changed = snap.changes_since(self.version)
+            if changed is not None:
+                metrics.increment("completeness_index_syncs_total", mode="incremental")
+                present = [row_number for row_number in changed if row_number in table]
+                for row_number in changed:
+                    self._issues.pop(row_number, None)
+                if present:
+                    for row_number, mask in zip(present, row_issues(table.take(present)).tolist()):
+                        if mask:
+                            self._issues[row_number] = mask
+            else:
+                metrics.increment("completeness_index_syncs_total", mode="full")
+                with metrics.timer("completeness_index_build_seconds"):
+                    masks = row_issues(table)
+                    pending = np.flatnonzero(masks)
+                    row_numbers = table.row_number_array()[pending].tolist()
+                    self._issues = dict(zip(row_numbers, masks[pending].tolist()))
+            self.version = snap.version
+
+    def issues(self, row_number):
+        """Máscara de problemas de la fila (0 si está completa)."""
+        return self._issues.get(row_number, 0)
+
+    def is_pending(self, row_number):
+        return row_number in self._issues
+
+    def pending_count(self):
+        """Cantidad de filas pendientes en todo el snapshot."""
+        return len(self._issues)
+
+    def pending_positions(self, rows, operator=0, operators=1):
+        """Posiciones (ordenadas) de las filas pendientes del operador dentro de una lista de resultados."""
+        with self._lock:
+            issues = self._issues
+            return [
+                position for position, row_number in enumerate(rows)
+                if row_number in issues and assigned(row_number, operator, operators)
+            ]
+
+
+def next_position(positions, position):
+    """Siguiente posición pendiente después de `position` (o la primera, al llegar al final); None si no hay."""
+    if not positions:
+        return None
+    i = bisect.bisect_right(positions, -1 if position is None else position)
+    return positions[i] if i < len(positions) else positions[0]
+
+
+metrics.registry.describe("completeness_index_build_seconds", "Construcción completa del índice de filas pendientes.")
@@ -0,0 +1,245 @@
+"""
+Conexión compartida con Google Sheets.
+
+Streamlit vuelve a ejecutar `code.py` en cada interacción, por lo que cualquier
+objeto creado ahí se pierde en el siguiente rerun. Este módulo se importa una sola
+vez por proceso y mantiene un único cliente autenticado (con su pool de conexiones
+HTTP y renovación automática del token) y un único handle por hoja de cada planilla.
+Todas las peticiones pasan por el limitador de cuota compartido (`quota.limiter`).
+
+gspread y google-auth se importan recién al crear el primer cliente: la interfaz
+puede mostrar la copia del snapshot en disco sin cargarlos ni autenticarse, y las
+credenciales de cada cuenta de servicio se interpretan una sola vez por proceso
+(`get_client`), aunque se lean varias planillas con ellas.
+"""
+import threading
+import tomllib
+
+import metrics
+import quota
+from table import a1
+
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+# Conexiones HTTP reutilizables por cliente (sesiones de Streamlit + hilos de fondo)
+POOL_SIZE = 16
+
+# Archivo de secretos de Streamlit, leído también por los scripts sin interfaz
+SECRETS_PATH = ".streamlit/secrets.toml"
+
+
+def load_secrets(path=SECRETS_PATH):
+    """Lee los secretos (cuenta de servicio y URL de la planilla) fuera de Streamlit."""
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+# Mensajes de un 400 que indican una hoja inexistente: el rango nombra una hoja
+# renombrada o borrada, o el id de la hoja ya no existe. Otros 400 (valores o
+# rangos mal formados) no se arreglan reabriendo la hoja.
+MISSING_SHEET_MESSAGES = ("unable to parse range", "no grid with id")
+
+
+def is_stale_handle_error(error):
+    """Indica si el error sugiere que el handle de la hoja quedó obsoleto (hoja renombrada, borrada, etc.)."""
+    import gspread
+    if isinstance(error, (gspread.exceptions.WorksheetNotFound, gspread.exceptions.SpreadsheetNotFound)):
+        return True
+    status = quota.error_status(error)
+    if status == 404:
+        return True
+    if status == 400:
+        message = str(error).lower()
+        return any(text in message for text in MISSING_SHEET_MESSAGES)
+    return False
+
+
+def contiguous_ranges(col_indices):
+    """Agrupa índices de columna (base 0) en tramos contiguos [(inicio, fin)], ambos inclusive."""
+    groups = []
+    for col_idx in sorted(set(col_indices)):
+        if groups and col_idx == groups[-1][1] + 1:
+            groups[-1][1] = col_idx
+        else:
+            groups.append([col_idx, col_idx])
+    return [tuple(group) for group in groups]
+
+
+def column_range(start, end):
+    """Rango A1 abierto hacia abajo que cubre las columnas `start`..`end` (base 0), p. ej. 'A1:D'."""
+    return f"{a1(1, start + 1)}:{a1(1, end + 1)[:-1]}"
+
+
+class SheetConnection:
+    """Cliente de gspread y hoja de trabajo compartidos por todas las sesiones e hilos del proceso."""
+
+    def __init__(self, credentials_info, spreadsheet_url, limiter=None, worksheet_name=None):
+        self.credentials_info = dict(credentials_info)
+        self.spreadsheet_url = spreadsheet_url
+        self.worksheet_name = worksheet_name
+        self.limiter = limiter or quota.limiter
+        self._lock = threading.RLock()
+        self._client = None
+        self._spreadsheet = None
+        self._worksheet = None
+
+    @property
+    def client(self):
+        """Cliente autenticado de la cuenta de servicio (compartido con las demás planillas de la cuenta)."""
+        with self._lock:
+            if self._client is None:
+                self._client = get_client(self.credentials_info)
+            return self._client
+
+    def spreadsheet(self):
+        """Retorna el handle de la planilla, abriéndola solo la primera vez."""
+        with self._lock:
+            if self._spreadsheet is None:
+                client = self.client
+                self._spreadsheet = quota.call(
+                    self.limiter, 'read',
+                    lambda: client.open_by_url(self.spreadsheet_url),
+                    name='open_by_url'
+                )
+            return self._spreadsheet
+
+    def worksheet(self):
+        """Retorna el handle de la hoja (`worksheet_name` o la primera), abriéndola solo la primera vez."""
+        with self._lock:
+            if self._worksheet is None:
+                spreadsheet = self.spreadsheet()
+                if self.worksheet_name:
+                    self._worksheet = quota.call(
+                        self.limiter, 'read', lambda: spreadsheet.worksheet(self.worksheet_name), name='worksheet'
+                    )
+                else:
+                    self._worksheet = quota.call(self.limiter, 'read', lambda: spreadsheet.sheet1, name='sheet1')
+            return self._worksheet
+
+    def invalidate(self):
+        """Descarta los handles de planilla y hoja para que se reabran en la próxima llamada."""
+        with self._lock:
+            self._spreadsheet = None
+            self._worksheet = None
+
+    def call(self, fn, kind='read', name=None):
+        """
+        Ejecuta `fn(worksheet)` dentro de la cuota de la categoría `kind`, reintentando
+        errores transitorios; si el handle quedó obsoleto, reabre la hoja y reintenta una vez.
+        """
+        try:
+            worksheet = self.worksheet()
+            return quota.call(self.limiter, kind, lambda: fn(worksheet), name=name)
+        except Exception as e:
+            if not is_stale_handle_error(e):
+                raise
+            self.invalidate()
+            worksheet = self.worksheet()
+            return quota.call(self.limiter, kind, lambda: fn(worksheet), name=name)
+
+    def modified_time(self):
+        """Retorna la hora de última modificación de la planilla según Drive (petición de metadatos, sin celdas)."""
+        return self.call(lambda ws: ws.spreadsheet.get_lastUpdateTime(), kind='drive', name='get_lastUpdateTime')
+
+    def get_all_values(self):
+        """Descarga todos los valores de la hoja."""
+        return self.call(lambda ws: ws.get_all_values(), name='get_all_values')
+
+    def get_columns(self, col_indices):
+        """
+        Descarga solo las columnas indicadas (base 0) en una única petición `batch_get`
+        y reconstruye filas con el mismo ancho e índices que `get_all_values()`;
+        las columnas no solicitadas quedan como cadenas vacías.
+        """
+        groups = contiguous_ranges(col_indices)
+        ranges = [column_range(start, end) for start, end in groups]
+        results = self.call(lambda ws: ws.batch_get(ranges), name='batch_get')
+        width = groups[-1][1] + 1 if groups else 0
+        n_rows = max((len(values) for values in results), default=0)
+        rows = [[''] * width for _ in range(n_rows)]
+        for (start, _), values in zip(groups, results):
+            for row, cells in zip(rows, values):
+                row[start:start + len(cells)] = cells
+        return rows
+
+    def get_row(self, row_number, col_indices):
+        """
+        Lee solo las celdas indicadas (base 0) de una fila, en una única petición
+        `batch_get`. Retorna `{índice de columna: texto}` (cadena vacía si la celda está vacía).
+        """
+        groups = contiguous_ranges(col_indices)
+        ranges = [
+            f"{a1(row_number, start + 1)}:{a1(row_number, end + 1)}"
+            for start, end in groups
+        ]
+        results = self.call(lambda ws: ws.batch_get(ranges), name='batch_get')
+        values = {}
+        for (start, end), result in zip(groups, results):
+            cells = result[0] if result else []
+            for col_idx in range(start, end + 1):
+                values[col_idx] = cells[col_idx - start] if col_idx - start < len(cells) else ''
+        return values
+
+    def update(self, range_name, values):
+        """Actualiza un rango de la hoja."""
+        return self.call(lambda ws: ws.update(range_name, values), kind='write', name='update')
+
+    def batch_update(self, data):
+        """Envía varias actualizaciones de rangos en una sola petición."""
+        return self.call(lambda ws: ws.batch_update(data), kind='write', name='batch_update')
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(credentials_info):
+    """
+    Retorna el cliente autenticado del proceso para la cuenta de servicio; se crea
+    una sola vez y google-auth renueva el token cuando expira.
+    """
+    key = credentials_info.get("client_email")
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            import gspread
+            from google.oauth2 import service_account
+            from requests.adapters import HTTPAdapter
+            with metrics.timer("sheets_oauth_seconds"):
+                credentials = service_account.Credentials.from_service_account_info(
+                    credentials_info,
+                    scopes=SCOPES
+                )
+                client = gspread.authorize(credentials)
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            client.session.mount("https://", adapter)
+            _clients[key] = client
+        return client
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(credentials_info, spreadsheet_url, worksheet_name=None):
+    """Retorna la conexión compartida del proceso para la cuenta de servicio, planilla y hoja indicadas."""
+    key = (credentials_info.get("client_email"), spreadsheet_url, worksheet_name)
+    with _connections_lock:
+        conn = _connections.get(key)
+        if conn is None:
+            conn = SheetConnection(credentials_info, spreadsheet_url, worksheet_name=worksheet_name)
+            _connections[key] = conn
+        return conn
+
+
+def set_connection(credentials_info, spreadsheet_url, conn, worksheet_name=None):
+    """
+    Registra una conexión ya creada para la cuenta, planilla y hoja indicadas (p. ej.
+    una `fake_sheets.FakeConnection` en las pruebas de carga de la interfaz).
+    """
+    key = (credentials_info.get("client_email"), spreadsheet_url, worksheet_name)
+    with _connections_lock:
+        _connections[key] = conn
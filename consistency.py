@@ -0,0 +1,180 @@
+"""
+Revisión de consistencia de los campos derivados de toda la planilla.
+
+Los campos derivados (superficie en m2, densidades por hectárea y coordenadas en
+grados decimales) solo se recalculan al guardar una fila desde la aplicación;
+las filas editadas directamente en la planilla quedan desfasadas. Esta revisión
+los recalcula para todas las filas en una pasada vectorizada sobre la tabla
+columnar, con las mismas reglas de `rules.compute_row_changes`, y retorna solo
+las celdas que difieren de lo guardado.
+
+Se puede ejecutar desde la interfaz o sin ella:
+
+    python consistency.py             # informa las diferencias
+    python consistency.py --apply     # además las escribe en la planilla
+"""
+import argparse
+import math
+import re
+import sys
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+import connection
+import schema
+import write_queue
+from table import SheetTable
+
+# Campos derivados que revisa la consistencia, en el orden en que se informan
+CAMPOS_DERIVADOS = ['superficie_m2', 'plantas_ha', 'emisores_ha', 'latitud_sonda', 'longitud_sonda']
+
+# Una coordenada DMS, p. ej. 33°26'15.5"S, con las mismas partes que `rules.dms_to_dd`
+_DMS = r'''([^°'"\s]*)[°'"]+([^°'"\s]*)[°'"]+([^°'"\s]*)[°'"]+([^°'"\s]*)\S*'''
+_UBICACION = re.compile(rf'^\s*{_DMS}\s+{_DMS}')
+_INTEGER = re.compile(r'^[+-]?\d+$')
+
+# Tolerancias al comparar con lo guardado (la planilla redondea al mostrar)
+M2_RTOL = 1e-9
+COORD_ATOL = 5e-9
+
+
+def per_value(table, field, fn):
+    """Aplica `fn` a cada valor distinto de una columna y retorna el resultado por fila."""
+    codes, uniques = pd.factorize(table.frame[field])
+    results = [fn(value) for value in uniques]
+    out = np.empty(len(results) + 1, dtype=object)
+    out[:-1] = results
+    out[-1] = fn('')
+    return out[codes]
+
+
+def is_blank(table, field):
+    """Filas cuyo valor está vacío (sin contar espacios ni la comilla inicial)."""
+    return per_value(table, field, lambda v: not str(v).strip().lstrip("'")).astype(bool)
+
+
+def _parse_int(value):
+    text = str(value).strip().lstrip("'").replace(",", "")
+    return float(text) if _INTEGER.match(text) else math.nan
+
+
+def parse_ubicaciones(table):
+    """
+    Convierte la ubicación DMS de todas las filas a grados decimales.
+    Retorna `(latitud, longitud)` como arreglos float64 (NaN si la ubicación no se puede interpretar).
+    """
+    parts = table.frame['ubicacion_sonda'].astype(object).fillna('').astype(str).str.extract(_UBICACION)
+    numbers = parts[[0, 1, 2, 4, 5, 6]].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    signs = []
+    for direction in (parts[3], parts[7]):
+        direction = direction.fillna('').str.strip()
+        signs.append(np.where(direction.isin(['S', 'W']), -1.0, 1.0))
+    latitud = (numbers[:, 0] + numbers[:, 1] / 60 + numbers[:, 2] / 3600) * signs[0]
+    longitud = (numbers[:, 3] + numbers[:, 4] / 60 + numbers[:, 5] / 3600) * signs[1]
+    return latitud, longitud
+
+
+def derived_changes(table):
+    """
+    Recalcula los campos derivados de toda la tabla y retorna las celdas
+    `{(fila, campo): valor}` cuyo valor guardado difiere del esperado.
+
+    Como al guardar una fila: sin superficie (o con superficie 0) se limpian las
+    densidades; sin ubicación se limpian las coordenadas; y los valores que no se
+    pueden interpretar dejan el campo derivado como está.
+    """
+    def number(field):
+        return table.numeric[field].to_numpy()
+
+    superficie = number('superficie_ha')
+    superficie_blank = is_blank(table, 'superficie_ha')
+    sin_superficie = superficie_blank | (superficie == 0)
+    con_superficie = ~np.isnan(superficie) & (superficie != 0)
+
+    expected = {}
+
+    # Superficie (m2) = ha × 10000
+    m2 = np.round(superficie * 10000, 6)
+    stored = number('superficie_m2')
+    mismatch = ~np.isnan(superficie) & ~np.isclose(m2, stored, rtol=M2_RTOL, atol=0)
+    expected['superficie_m2'] = (mismatch, m2, superficie_blank & ~is_blank(table, 'superficie_m2'))
+
+    # Densidades por hectárea = ceil(total / ha)
+    for total_field, density_field in (('plantas_total', 'plantas_ha'), ('emisores_total', 'emisores_ha')):
+        total = per_value(table, total_field, _parse_int).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            density = np.ceil(total / superficie)
+        valid = con_superficie & ~np.isnan(total)
+        mismatch = valid & (density != number(density_field))
+        clear = sin_superficie & ~is_blank(table, density_field)
+        expected[density_field] = (mismatch, density, clear)
+
+    # Coordenadas en grados decimales desde la ubicación DMS
+    ubicacion_blank = is_blank(table, 'ubicacion_sonda')
+    for field, coords in zip(('latitud_sonda', 'longitud_sonda'), parse_ubicaciones(table)):
+        valid = ~np.isnan(coords)
+        mismatch = valid & ~np.isclose(coords, number(field), rtol=0, atol=COORD_ATOL)
+        clear = ubicacion_blank & ~is_blank(table, field)
+        expected[field] = (mismatch, coords, clear)
+
+    cells = {}
+    row_numbers = table.row_number_array()
+    for field in CAMPOS_DERIVADOS:
+        mismatch, values, clear = expected[field]
+        for position in np.flatnonzero(mismatch).tolist():
+            cells[(int(row_numbers[position]), field)] = _cell_value(field, values[position])
+        for position in np.flatnonzero(clear).tolist():
+            cells[(int(row_numbers[position]), field)] = ""
+    return dict(sorted(cells.items()))
+
+
+def _cell_value(field, value):
+    """Valor a escribir con el mismo formato que el guardado de una fila."""
+    if field in ('plantas_ha', 'emisores_ha'):
+        return int(value)
+    if field in ('latitud_sonda', 'longitud_sonda'):
+        return f"{value:.8f}".replace(".", ",")
+    return float(value)
+
+
+def summarize(cells):
+    """Cantidad de celdas a corregir por campo derivado."""
+    counts = Counter(field for _, field in cells)
+    return {field: counts[field] for field in CAMPOS_DERIVADOS if counts[field]}
+
+
+def main(argv=None):
+    """Ejecuta la revisión sin interfaz con las credenciales de `.streamlit/secrets.toml`."""
+    parser = argparse.ArgumentParser(description="Revisa y corrige los campos derivados de toda la planilla.")
+    parser.add_argument("--apply", action="store_true", help="escribe las correcciones en la planilla")
+    parser.add_argument("--secrets", default=connection.SECRETS_PATH, help="archivo de secretos de Streamlit")
+    args = parser.parse_args(argv)
+
+    secrets = connection.load_secrets(args.secrets)
+    client = connection.get_connection(secrets["gcp_service_account"], secrets["spreadsheet_url"])
+    table = SheetTable.from_rows(
+        client.get_columns(schema.COLUMNAS.values()), schema.COLUMNAS, schema.CAMPOS_NUMERICOS
+    )
+    cells = derived_changes(table)
+    rows = {row_number for row_number, _ in cells}
+    print(f"{len(table)} filas revisadas: {len(cells)} celdas a corregir en {len(rows)} filas.")
+    for field, count in summarize(cells).items():
+        print(f"  {field}: {count}")
+    if not cells or not args.apply:
+        return 0
+
+    cola = write_queue.WriteQueue(client.batch_update, schema.COLUMNAS)
+    cola.enqueue(cells)
+    cola.flush()
+    failed = cola.failed_rows()
+    if failed:
+        print(f"No se pudieron guardar {len(failed)} filas: " + ", ".join(str(row) for row in sorted(failed)))
+        return 1
+    print("Correcciones guardadas.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
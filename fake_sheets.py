@@ -0,0 +1,234 @@
+"""
+Planilla falsa en memoria para pruebas de rendimiento y de carga.
+
+`FakeWorksheet` imita la parte de `gspread.Worksheet` que usa la aplicación
+(`get_all_values`, `batch_get`, `update`, `batch_update` y la hora de
+modificación de la planilla) con latencia configurable y errores de cuota
+(HTTP 429) simulados. `FakeConnection` es una `connection.SheetConnection` que
+usa esa hoja en lugar de Google Sheets, de modo que todo lo demás (limitador de
+cuota, reintentos, snapshot, cola de escritura) se ejecuta igual que en producción.
+"""
+import json
+import math
+import random
+import threading
+import time
+
+import requests
+from gspread.exceptions import APIError
+from gspread.utils import a1_range_to_grid_range, a1_to_rowcol
+
+import connection
+import rules
+import schema
+from table import format_cell
+
+CULTIVOS = {
+    "Uva de mesa": ["Thompson Seedless", "Crimson", "Red Globe", "Autumn Royal"],
+    "Nogal": ["Chandler", "Serr", "Howard"],
+    "Cerezo": ["Lapins", "Santina", "Regina", "Bing"],
+    "Palto": ["Hass", "Edranol"],
+    "Arándano": ["Legacy", "Duke", "Brigitta"],
+    "Manzano": ["Gala", "Fuji", "Pink Lady"],
+}
+REGIONES = ["Ñuble", "Maule", "O'Higgins", "Valparaíso", "Biobío", "Araucanía", "Metropolitana"]
+
+
+def quota_error(status=429, message="Quota exceeded for quota metric 'Read requests'"):
+    """Error de la API con el código HTTP indicado, igual al que lanza gspread."""
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps(
+        {"error": {"code": status, "message": message, "status": "RESOURCE_EXHAUSTED"}}
+    ).encode()
+    return APIError(response)
+
+
+def _dms(value, positive, negative):
+    hemisphere = negative if value < 0 else positive
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = round((value - degrees - minutes / 60) * 3600, 1)
+    return f"{degrees}°{minutes}'{seconds}\"{hemisphere}"
+
+
+def generate_rows(n_rows, seed=0):
+    """
+    Genera una planilla con `n_rows` filas de datos (más la fila de encabezados) con
+    el mismo formato que la real: columnas según COLUMNAS, coma decimal, cuentas y
+    campos repetidos, sondas únicas y algunas celdas vacías.
+    """
+    rng = random.Random(seed)
+    width = max(schema.COLUMNAS.values()) + 1
+    rows = [[''] * width]
+    for field, col_idx in schema.COLUMNAS.items():
+        rows[0][col_idx] = field
+    n_cuentas = max(1, n_rows // 200)
+    n_campos = max(1, n_rows // 20)
+    for i in range(n_rows):
+        row = [''] * width
+        cuenta = rng.randrange(n_cuentas)
+        campo = rng.randrange(n_campos)
+        cultivo = rng.choice(list(CULTIVOS))
+        values = {
+            'cuenta_id': str(1000 + cuenta),
+            'cuenta_nombre': f"Agrícola {REGIONES[cuenta % len(REGIONES)]} {cuenta}",
+            'campo_id': str(50000 + campo),
+            'campo_nombre': f"Campo {REGIONES[campo % len(REGIONES)]} {campo}",
+            'sonda_id': str(900000 + i),
+            'sonda_nombre': f"Sonda {i % 40 + 1} Sector {rng.randrange(1, 30)}",
+            'cultivo': cultivo,
+            'variedad': rng.choice(CULTIVOS[cultivo]),
+            'ano_plantacion': str(rng.randrange(1990, 2024)),
+        }
+        if rng.random() < 0.8:
+            lat, lon = -rng.uniform(30, 40), -rng.uniform(70, 73)
+            lat_dms, lon_dms = _dms(lat, 'N', 'S'), _dms(lon, 'E', 'W')
+            values['ubicacion_sonda'] = f"{lat_dms} {lon_dms}"
+            values['latitud_sonda'] = f"{rules.dms_to_dd(lat_dms):.8f}".replace(".", ",")
+            values['longitud_sonda'] = f"{rules.dms_to_dd(lon_dms):.8f}".replace(".", ",")
+        if rng.random() < 0.9:
+            superficie = round(rng.uniform(0.5, 40), 2)
+            plantas = rng.randrange(500, 60000)
+            emisores = plantas * rng.randrange(1, 4)
+            values.update({
+                'superficie_ha': str(superficie).replace(".", ","),
+                'superficie_m2': str(round(superficie * 10000)),
+                'plantas_total': str(plantas),
+                'plantas_ha': str(math.ceil(plantas / superficie)),
+                'emisores_total': str(emisores),
+                'emisores_ha': str(math.ceil(emisores / superficie)),
+                'caudal_teorico': str(round(rng.uniform(5, 200), 1)).replace(".", ","),
+                'ppeq_mm_h': str(round(rng.uniform(0.5, 5), 2)).replace(".", ","),
+            })
+        if rng.random() < 0.2:
+            values['comentario'] = "Datos de cultivo incompletos"
+        for field, value in values.items():
+            row[schema.COLUMNAS[field]] = value
+        rows.append(row)
+    return rows
+
+
+class FakeSpreadsheet:
+    """Planilla falsa: solo expone la hoja y la hora de modificación."""
+
+    def __init__(self, worksheet):
+        self.sheet1 = worksheet
+
+    def get_lastUpdateTime(self):
+        return self.sheet1.call('get_lastUpdateTime', lambda: self.sheet1.modified)
+
+
+class FakeWorksheet:
+    """
+    Hoja en memoria con la interfaz de `gspread.Worksheet` que usa la aplicación.
+
+    Cada llamada espera `latency` segundos (más un jitter de hasta `jitter`) y falla
+    con un error 429 con probabilidad `error_rate`; `fail_next(n)` fuerza los
+    siguientes `n` errores. `calls` cuenta las llamadas por método.
+    """
+
+    def __init__(self, rows, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.rows = [list(row) for row in rows]
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.spreadsheet = FakeSpreadsheet(self)
+        self.modified = "revision-0"
+        self.calls = {}
+        self._revision = 0
+        self._forced_errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def fail_next(self, n=1):
+        """Hace que las siguientes `n` llamadas fallen con un error de cuota."""
+        with self._lock:
+            self._forced_errors += n
+
+    def call(self, method, fn):
+        """Cuenta la llamada, simula la latencia y, según corresponda, un error de cuota."""
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            fail = self._forced_errors > 0 or self._rng.random() < self.error_rate
+            if self._forced_errors > 0:
+                self._forced_errors -= 1
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise quota_error()
+        with self._lock:
+            return fn()
+
+    def _touch(self):
+        self._revision += 1
+        self.modified = f"revision-{self._revision}"
+
+    # --- Lectura ---
+    def get_all_values(self):
+        return self.call('get_all_values', lambda: [list(row) for row in self.rows])
+
+    def batch_get(self, ranges):
+        def read():
+            return [self._read_range(range_name) for range_name in ranges]
+        return self.call('batch_get', read)
+
+    def _read_range(self, range_name):
+        grid = a1_range_to_grid_range(range_name)
+        start_row = grid.get('startRowIndex', 0)
+        end_row = grid.get('endRowIndex', len(self.rows))
+        start_col = grid.get('startColumnIndex', 0)
+        end_col = grid.get('endColumnIndex')
+        values = []
+        for row in self.rows[start_row:end_row]:
+            cells = row[start_col:end_col]
+            # Como la API, se omiten las celdas vacías al final de cada fila
+            while cells and cells[-1] == '':
+                cells = cells[:-1]
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    # --- Escritura ---
+    def update(self, range_name, values):
+        def write():
+            self._write_range(range_name, values)
+            self._touch()
+        return self.call('update', write)
+
+    def batch_update(self, data):
+        def write():
+            for item in data:
+                self._write_range(item["range"], item["values"])
+            self._touch()
+        return self.call('batch_update', write)
+
+    def _write_range(self, range_name, values):
+        row_number, col_number = a1_to_rowcol(range_name.split(":")[0])
+        for i, row_values in enumerate(values):
+            target = row_number - 1 + i
+            while len(self.rows) <= target:
+                self.rows.append([''] * len(self.rows[0]))
+            row = self.rows[target]
+            for j, value in enumerate(row_values):
+                col = col_number - 1 + j
+                if len(row) <= col:
+                    row.extend([''] * (col + 1 - len(row)))
+                row[col] = '' if value is None else format_cell(value)
+
+
+class FakeConnection(connection.SheetConnection):
+    """Conexión que usa una `FakeWorksheet` en lugar de Google Sheets (mismo limitador y reintentos)."""
+
+    def __init__(self, worksheet, limiter=None, spreadsheet_url="fake://planilla"):
+        super().__init__({}, spreadsheet_url, limiter=limiter)
+        self.fake = worksheet
+
+    def spreadsheet(self):
+        return self.fake.spreadsheet
+
+    def worksheet(self):
+        return self.fake
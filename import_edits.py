@@ -0,0 +1,198 @@
+"""
+Importación por lotes de ediciones desde un archivo CSV o JSONL, sin interfaz.
+
+Cada registro identifica una fila por `sonda_id` o por `fila` (número de fila de
+la planilla) e indica los campos a cambiar con los nombres de COLUMNAS
+(superficie_ha, cultivo, ubicacion_sonda, comentario...). Los campos ausentes o
+vacíos no se modifican. Se aplican las mismas validaciones y campos derivados
+que al guardar una fila desde la aplicación (`rules.edit_changes`).
+
+El archivo se lee registro a registro y las celdas se envían en bloques de
+`batch_update` del tamaño admitido por la API, a través del limitador de cuota.
+Tras cada bloque confirmado se guarda un punto de control con la cantidad de
+registros procesados; si la ejecución se interrumpe, la siguiente continúa desde
+ahí (`--restart` la obliga a empezar de nuevo).
+
+    python import_edits.py ediciones.csv [--dry-run] [--restart]
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+import connection
+import rules
+import schema
+import write_queue
+from table import SheetTable, format_cell
+
+# Campos que se pueden importar (los del formulario y el comentario)
+CAMPOS_IMPORTABLES = set(rules.CAMPOS_FORMULARIO) | {'comentario'}
+# Claves admitidas para identificar la fila
+CLAVES = ('sonda_id', 'fila')
+
+
+def read_records(path):
+    """Lee los registros del archivo uno a uno (JSONL si la extensión es .jsonl/.ndjson, CSV en otro caso)."""
+    if os.path.splitext(path)[1].lower() in ('.jsonl', '.ndjson'):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            yield from csv.DictReader(f)
+
+
+def checkpoint_path(path):
+    """Archivo de punto de control asociado a un archivo de ediciones."""
+    return path + ".checkpoint.json"
+
+
+def load_checkpoint(path, input_path):
+    """Registros ya procesados según el punto de control (0 si no existe o es de otro archivo)."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return 0
+    if data.get("archivo") != os.path.abspath(input_path):
+        return 0
+    return int(data.get("registros", 0))
+
+
+def save_checkpoint(path, input_path, records):
+    """Guarda de forma atómica la cantidad de registros cuyas ediciones ya se enviaron."""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"archivo": os.path.abspath(input_path), "registros": records}, f)
+    os.replace(tmp, path)
+
+
+def sonda_rows(table):
+    """Índice `{sonda_id: [filas]}` de la tabla."""
+    rows = {}
+    for row_number, sonda_id in zip(table.row_numbers(), table.frame['sonda_id']):
+        sonda_id = str(sonda_id).strip()
+        if sonda_id:
+            rows.setdefault(sonda_id, []).append(row_number)
+    return rows
+
+
+def locate(record, table, by_sonda):
+    """Retorna `(fila, error)` para el registro; fila es None si no se pudo identificar."""
+    fila = str(record.get('fila') or '').strip()
+    if fila:
+        if not fila.isdigit() or int(fila) not in table:
+            return None, f"la fila {fila} no existe"
+        return int(fila), None
+    sonda_id = str(record.get('sonda_id') or '').strip()
+    if not sonda_id:
+        return None, "falta sonda_id o fila"
+    rows = by_sonda.get(sonda_id, [])
+    if len(rows) != 1:
+        return None, f"sonda_id {sonda_id} " + ("no existe" if not rows else f"está repetida en las filas {rows}")
+    return rows[0], None
+
+
+def run_import(client, path, checkpoint=None, dry_run=False, chunk_size=write_queue.MAX_RANGES_PER_REQUEST, log=print):
+    """
+    Aplica las ediciones del archivo sobre la planilla. Retorna un resumen con los
+    registros leídos, filas y celdas modificadas y registros omitidos.
+    """
+    checkpoint = checkpoint or checkpoint_path(path)
+    table = SheetTable.from_rows(
+        client.get_columns(schema.COLUMNAS.values()), schema.COLUMNAS, schema.CAMPOS_NUMERICOS
+    )
+    by_sonda = sonda_rows(table)
+    start = 0 if dry_run else load_checkpoint(checkpoint, path)
+    if start:
+        log(f"Reanudando desde el registro {start + 1}.")
+
+    # Valores ya escritos (o por escribir) en esta ejecución, para que un registro
+    # posterior sobre la misma fila parta de ellos
+    written = {}
+    pending = {}
+    ignored = set()
+    summary = {"registros": 0, "filas": set(), "celdas": 0, "omitidos": 0}
+
+    def flush(records):
+        if pending and not dry_run:
+            client.batch_update(write_queue.cells_to_ranges(pending, schema.COLUMNAS))
+        summary["celdas"] += len(pending)
+        pending.clear()
+        if not dry_run:
+            save_checkpoint(checkpoint, path, records)
+
+    records = 0
+    for number, record in enumerate(read_records(path), 1):
+        records = number
+        if number <= start:
+            continue
+        summary["registros"] += 1
+        row_number, error = locate(record, table, by_sonda)
+        unknown = sorted(set(record) - CAMPOS_IMPORTABLES - set(CLAVES) - ignored)
+        if unknown:
+            log(f"Se ignoran los campos desconocidos: {', '.join(unknown)}.")
+            ignored.update(unknown)
+        if row_number is None:
+            log(f"Registro {number}: {error}; se omite.")
+            summary["omitidos"] += 1
+            continue
+
+        valores = {
+            field: str(value) for field, value in record.items()
+            if field in rules.CAMPOS_FORMULARIO and value is not None and str(value).strip()
+        }
+        comentario = str(record.get('comentario') or '').strip()
+        row_data = table.row(row_number)
+        row_data.update(written.get(row_number, {}))
+        celdas, avisos = rules.edit_changes(
+            row_data, valores, schema.CAMPOS_NUMERICOS,
+            rules.split_comments(comentario),
+            rules.COMENTARIOS_REEMPLAZAR if comentario else rules.COMENTARIOS_SIN_CAMBIOS
+        )
+        for aviso in avisos:
+            log(f"Registro {number} (fila {row_number}): {aviso}")
+        for field, value in celdas.items():
+            pending[(row_number, field)] = value
+            written.setdefault(row_number, {})[field] = format_cell(value)
+        if celdas:
+            summary["filas"].add(row_number)
+        if len(pending) >= chunk_size:
+            flush(number)
+
+    flush(records)
+    if not dry_run and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    summary["filas"] = len(summary["filas"])
+    return summary
+
+
+def main(argv=None):
+    """Ejecuta la importación con las credenciales de `.streamlit/secrets.toml`."""
+    parser = argparse.ArgumentParser(description="Importa ediciones de filas desde un archivo CSV o JSONL.")
+    parser.add_argument("archivo", help="archivo CSV o JSONL con columnas sonda_id o fila y los campos a cambiar")
+    parser.add_argument("--dry-run", action="store_true", help="calcula los cambios sin escribir en la planilla")
+    parser.add_argument("--restart", action="store_true", help="ignora el punto de control y empieza desde el inicio")
+    parser.add_argument("--checkpoint", help="archivo de punto de control (por omisión, <archivo>.checkpoint.json)")
+    parser.add_argument("--secrets", default=connection.SECRETS_PATH, help="archivo de secretos de Streamlit")
+    args = parser.parse_args(argv)
+
+    checkpoint = args.checkpoint or checkpoint_path(args.archivo)
+    if args.restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    secrets = connection.load_secrets(args.secrets)
+    client = connection.get_connection(secrets["gcp_service_account"], secrets["spreadsheet_url"])
+    summary = run_import(client, args.archivo, checkpoint, dry_run=args.dry_run, log=lambda m: print(m, file=sys.stderr))
+    accion = "a modificar" if args.dry_run else "modificadas"
+    print(
+        f"{summary['registros']} registros procesados: {summary['celdas']} celdas {accion} "
+        f"en {summary['filas']} filas; {summary['omitidos']} registros omitidos."
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
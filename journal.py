@@ -0,0 +1,345 @@
+"""
+Diario local de escrituras (write-ahead) de la cola de escritura.
+
+Cada conjunto de celdas que se encola (`WriteQueue.enqueue`) se agrega primero a
+un archivo JSONL de solo agregado, con la hora y quién lo escribió, y recién
+entonces se envía a la planilla. El hilo de envío hace `fsync` una vez por envío
+(antes de llamar a `batch_update`), no una vez por guardado, así que guardar no
+espera al disco y todo lo enviado ya quedó escrito.
+
+Cuando la planilla confirma un envío se agrega una línea de confirmación con las
+celdas confirmadas y la entrada de la que provenía cada valor. Una entrada está
+completa cuando cada una de sus celdas se envió con su valor o con uno escrito
+después (la cola combina las escrituras repetidas a una misma celda y solo envía
+la última); al releer el diario, las celdas ya confirmadas de una entrada
+incompleta no se vuelven a enviar. Las celdas que la
+planilla rechaza con un error permanente (p. ej. un rango inválido) se registran
+como rechazadas con su error y tampoco se reenvían.
+
+Al iniciar, las entradas sin confirmar (p. ej. escritas durante una caída de la
+red o antes de reiniciar el servidor) se reenvían en orden, combinadas: de cada
+celda solo viaja el último valor. Cada COMPACT_ENTRIES entradas confirmadas (y
+al iniciar) el diario se reescribe de forma atómica solo con lo pendiente; lo
+confirmado pasa a un historial de solo agregado que registra qué se cambió,
+quién y cuándo.
+
+Formato de las líneas:
+
+    {"tipo": "escritura", "id": 7, "hora": 1700000000.0, "autor": "...", "celdas": [[fila, campo, valor], ...]}
+    {"tipo": "confirmacion", "celdas": [[fila, campo, id], ...], "hora": 1700000001.2}
+    {"tipo": "rechazo", "celdas": [[fila, campo, id], ...], "error": "...", "hora": 1700000001.2}
+
+El diario compactado empieza con `{"tipo": "inicio", "siguiente_id": 8}`, para que
+los ids no se repitan en el historial aunque no quede nada pendiente.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Directorio del diario (vacío para desactivarlo)
+JOURNAL_DIR = os.environ.get("SHEETS_JOURNAL_DIR", ".cache")
+# Entradas confirmadas tras las cuales el diario se reescribe solo con lo pendiente
+COMPACT_ENTRIES = 1000
+
+WRITE = "escritura"
+ACK = "confirmacion"
+REJECT = "rechazo"
+START = "inicio"
+
+
+def journal_path(spreadsheet_url, directory=None):
+    """Archivo del diario asociado a una planilla (None si el diario está desactivado)."""
+    directory = JOURNAL_DIR if directory is None else directory
+    if not directory:
+        return None
+    digest = hashlib.sha1(spreadsheet_url.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(directory, f"diario-{digest}.jsonl")
+
+
+def history_path(path):
+    """Historial de escrituras confirmadas que acompaña al diario."""
+    return os.path.splitext(path)[0] + "-historial.jsonl"
+
+
+def _dumps(record):
+    return json.dumps(record, ensure_ascii=False, default=str, separators=(",", ":")) + "\n"
+
+
+def _rejected(entry):
+    return [[row_number, field, error] for (row_number, field), error in entry["rechazadas"].items()]
+
+
+class Journal:
+    """Diario JSONL de escrituras `{(fila, campo): valor}` pendientes de confirmación."""
+
+    def __init__(self, path, compact_entries=COMPACT_ENTRIES):
+        self.path = path
+        self.compact_entries = compact_entries
+        self._lock = threading.Lock()
+        self._file = None
+        self._dirty = False
+        self._next_id = 1
+        # Entradas sin confirmar: id -> {"hora", "autor", "celdas": {(fila, campo): valor}, "restantes": set}
+        self._open = {}
+        # Por celda, ids de las entradas sin confirmar que la escriben (en orden)
+        self._by_key = {}
+        # Entradas confirmadas que aún no pasaron al historial
+        self._done = []
+        self._load()
+        self.compact()
+
+    # --- Lectura al iniciar ---
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with metrics.timer("journal_seconds", operation="load"), open(self.path, encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Una línea a medias al final es una escritura interrumpida que nunca se envió
+                    logger.warning("Línea %d ilegible en el diario %s; se ignora.", number, self.path)
+                    continue
+                if record.get("tipo") == WRITE:
+                    cells = {(row_number, field): value for row_number, field, value in record["celdas"]}
+                    self._add(record["id"], record.get("hora"), record.get("autor"), cells)
+                    for row_number, field, error in record.get("rechazadas", ()):
+                        self._open[record["id"]].setdefault("rechazadas", {})[(row_number, field)] = error
+                    self._next_id = max(self._next_id, record["id"] + 1)
+                elif record.get("tipo") == REJECT:
+                    origins = {(row_number, field): entry_id for row_number, field, entry_id in record["celdas"]}
+                    self._mark_rejected(origins, record.get("error"))
+                    for entry_id in self._resolve(origins):
+                        self._done.append((entry_id, self._open.pop(entry_id), record.get("hora")))
+                elif record.get("tipo") == START:
+                    self._next_id = max(self._next_id, record["siguiente_id"])
+                elif record.get("tipo") == ACK and "celdas" in record:
+                    origins = {(row_number, field): entry_id for row_number, field, entry_id in record["celdas"]}
+                    for entry_id in self._resolve(origins):
+                        self._done.append((entry_id, self._open.pop(entry_id), record.get("hora")))
+                elif record.get("tipo") == ACK:
+                    # Formato anterior: solo los ids de las entradas completas
+                    for entry_id in record["ids"]:
+                        entry = self._open.pop(entry_id, None)
+                        if entry is not None:
+                            self._forget(entry_id, entry)
+                            self._done.append((entry_id, entry, record.get("hora")))
+
+    def _add(self, entry_id, hora, autor, cells):
+        self._open[entry_id] = {"hora": hora, "autor": autor, "celdas": cells, "restantes": set(cells)}
+        for key in cells:
+            self._by_key.setdefault(key, []).append(entry_id)
+
+    def _forget(self, entry_id, entry):
+        for key in entry["restantes"]:
+            ids = self._by_key.get(key)
+            if ids and entry_id in ids:
+                ids.remove(entry_id)
+                if not ids:
+                    del self._by_key[key]
+
+    # --- Escritura ---
+    def _ensure_open(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+
+    def append(self, cells, author=None):
+        """
+        Agrega una entrada con las celdas y retorna su id. Queda en el búfer del
+        archivo hasta el próximo `sync()`.
+        """
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            hora = time.time()
+            self._ensure_open()
+            self._file.write(_dumps({
+                "tipo": WRITE, "id": entry_id, "hora": hora, "autor": author,
+                "celdas": [[row_number, field, value] for (row_number, field), value in cells.items()],
+            }))
+            self._dirty = True
+            self._add(entry_id, hora, author, dict(cells))
+            metrics.increment("journal_entries_total", result="escrita")
+            return entry_id
+
+    def sync(self):
+        """Lleva al disco (`fsync`) lo agregado desde la última llamada; una sola vez por envío."""
+        with self._lock:
+            if not self._dirty:
+                return
+            with metrics.timer("journal_seconds", operation="fsync"):
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def _resolve(self, origins):
+        """
+        Da por resueltas las celdas `{(fila, campo): id}` en la entrada `id` y en las
+        anteriores que escribían la misma celda; retorna las entradas que quedaron completas.
+        """
+        completed = []
+        for key, origin in origins.items():
+            ids = self._by_key.get(key)
+            if not ids:
+                continue
+            resolved = [entry_id for entry_id in ids if entry_id <= origin]
+            remaining = [entry_id for entry_id in ids if entry_id > origin]
+            if remaining:
+                self._by_key[key] = remaining
+            else:
+                del self._by_key[key]
+            for entry_id in resolved:
+                entry = self._open[entry_id]
+                entry["restantes"].discard(key)
+                if not entry["restantes"]:
+                    completed.append(entry_id)
+        return completed
+
+    def _mark_rejected(self, origins, error):
+        for key, origin in origins.items():
+            entry = self._open.get(origin)
+            if entry is not None and key in entry["restantes"]:
+                entry.setdefault("rechazadas", {})[key] = error
+
+    def reject(self, origins, error):
+        """
+        Registra celdas que la planilla rechazó con un error permanente `{(fila, campo): id}`:
+        se resuelven como en `acknowledge` (no se vuelven a enviar) y quedan anotadas con el error.
+        """
+        error = str(error)
+        with self._lock:
+            self._mark_rejected(origins, error)
+            completed = self._resolve(origins)
+            hora = time.time()
+            for entry_id in completed:
+                self._done.append((entry_id, self._open.pop(entry_id), hora))
+            self._ensure_open()
+            self._file.write(_dumps({
+                "tipo": REJECT, "celdas": [[row_number, field, origin] for (row_number, field), origin in origins.items()],
+                "error": error, "hora": hora,
+            }))
+            self._dirty = True
+            metrics.increment("journal_entries_total", len(completed), result="rechazada")
+            compact = len(self._done) >= self.compact_entries
+        if compact:
+            self.compact()
+
+    def acknowledge(self, origins):
+        """
+        Registra celdas confirmadas por la planilla `{(fila, campo): id}`, donde `id`
+        es la entrada cuyo valor se envió: quedan resueltas esa entrada y las
+        anteriores que escribían la misma celda.
+        """
+        with self._lock:
+            completed = self._resolve(origins)
+            hora = time.time()
+            for entry_id in completed:
+                self._done.append((entry_id, self._open.pop(entry_id), hora))
+            self._ensure_open()
+            # Se registran todas las celdas, no solo las entradas completas: una entrada
+            # anterior a medio confirmar no debe reenviar al reiniciar un valor ya reemplazado.
+            # Sin fsync: perder una confirmación solo hace que la celda se reenvíe con el mismo valor
+            self._file.write(_dumps({
+                "tipo": ACK, "celdas": [[row_number, field, origin] for (row_number, field), origin in origins.items()],
+                "hora": hora,
+            }))
+            self._dirty = True
+            metrics.increment("journal_entries_total", len(completed), result="confirmada")
+            compact = len(self._done) >= self.compact_entries
+        if compact:
+            self.compact()
+
+    # --- Reenvío ---
+    def pending(self):
+        """
+        Celdas sin confirmar combinadas en orden de escritura: `{(fila, campo): (valor, id)}`
+        con el último valor de cada celda y la entrada de la que proviene.
+        """
+        with self._lock:
+            cells = {}
+            for entry_id in sorted(self._open):
+                entry = self._open[entry_id]
+                for key in entry["restantes"]:
+                    cells[key] = (entry["celdas"][key], entry_id)
+            return cells
+
+    def pending_entries(self):
+        """Cantidad de entradas sin confirmar."""
+        return len(self._open)
+
+    def compact(self):
+        """
+        Pasa las entradas confirmadas al historial y reescribe el diario de forma
+        atómica solo con las celdas pendientes de cada entrada.
+        """
+        with self._lock:
+            if not self._done:
+                return
+            with metrics.timer("journal_seconds", operation="compact"):
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(history_path(self.path), "a", encoding="utf-8") as history:
+                    for entry_id, entry, confirmada in self._done:
+                        record = {
+                            "id": entry_id, "hora": entry["hora"], "autor": entry["autor"], "confirmada": confirmada,
+                            "celdas": [[row_number, field, value]
+                                       for (row_number, field), value in entry["celdas"].items()],
+                        }
+                        if entry.get("rechazadas"):
+                            record["rechazadas"] = _rejected(entry)
+                        history.write(_dumps(record))
+                    history.flush()
+                    os.fsync(history.fileno())
+                temporary = self.path + ".tmp"
+                with open(temporary, "w", encoding="utf-8") as f:
+                    f.write(_dumps({"tipo": START, "siguiente_id": self._next_id}))
+                    for entry_id in sorted(self._open):
+                        entry = self._open[entry_id]
+                        record = {
+                            "tipo": WRITE, "id": entry_id, "hora": entry["hora"], "autor": entry["autor"],
+                            "celdas": [[row_number, field, entry["celdas"][(row_number, field)]]
+                                       for row_number, field in sorted(entry["restantes"], key=str)],
+                        }
+                        if entry.get("rechazadas"):
+                            record["rechazadas"] = _rejected(entry)
+                        f.write(_dumps(record))
+                    f.flush()
+                    os.fsync(f.fileno())
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                os.replace(temporary, self.path)
+                self._dirty = False
+                self._done = []
+
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def get_journal(path):
+    """
+    Retorna el diario del proceso para el archivo indicado, abriéndolo (y leyendo
+    lo pendiente) una sola vez. None si el diario está desactivado o no se pudo abrir.
+    """
+    if not path:
+        return None
+    with _journals_lock:
+        if path not in _journals:
+            try:
+                _journals[path] = Journal(path)
+            except OSError as e:
+                logger.warning("No se pudo abrir el diario local %s; las escrituras no quedarán registradas: %s", path, e)
+                _journals[path] = None
+        return _journals[path]
+
+
+metrics.registry.describe("journal_seconds", "Operaciones del diario local de escrituras (fsync, compactación, lectura).")
+metrics.registry.describe("journal_entries_total", "Entradas del diario local escritas y confirmadas.")
@@ -0,0 +1,266 @@
+"""
+Prueba de carga de la interfaz con varias sesiones simultáneas.
+
+Ejecuta `code.py` con el probador de aplicaciones de Streamlit
+(`streamlit.testing.v1.AppTest`) contra una planilla falsa en memoria
+(`fake_sheets`), con N sesiones simuladas en hilos paralelos que buscan, eligen
+filas, guardan y pasan a la siguiente fila. Como en un servidor real, todas las
+sesiones comparten el proceso: el snapshot, los índices, la cola de escritura y
+el limitador de cuota.
+
+Por cada cantidad de sesiones informa la latencia p50/p99 de los reruns, los
+hilos vivos, la memoria residente (RSS) y su crecimiento respecto del inicio, y
+la tasa de peticiones a la planilla. Sirve para dimensionar servidores y para
+detectar recursos que crecen por sesión (hilos o copias de datos que no se
+liberan). La latencia incluye el costo del probador (serializar y leer los
+elementos), no la red hasta el navegador.
+
+El probador no admite ejecuciones simultáneas (cada una instala y retira el
+runtime global de Streamlit), así que los reruns de las sesiones se turnan: la
+latencia informada incluye la espera de turno, como en un servidor de un solo
+núcleo donde el GIL también los intercala. Los hilos de fondo (refrescador del
+snapshot, cola de escritura) sí corren en paralelo.
+
+    python load_test.py --sessions 1 5 10 20 --actions 30 --rows 10000
+    python load_test.py --sessions 10 --latency 0.2 --output carga.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest
+
+import connection
+import fake_sheets
+import quota
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code.py")
+DEFAULT_SESSIONS = [1, 5, 10, 20]
+DEFAULT_ACTIONS = 30
+DEFAULT_ROWS = 10000
+# Segundos máximos de un rerun antes de darlo por fallido
+RERUN_TIMEOUT = 60
+# Acciones de cada sesión simulada y su peso relativo
+ACTIONS = [("buscar", 2), ("elegir", 3), ("guardar", 2), ("siguiente", 3)]
+# Consultas que usan las sesiones simuladas
+QUERIES = ["nogal", "cuenta:1003", "crimson", "sector 2", "maule", "sonda:9000", ""]
+# Credenciales y planilla ficticias con que se registra la planilla falsa
+CREDENTIALS = {"client_email": "prueba-de-carga@example.com"}
+SPREADSHEET_URL = "fake://prueba-de-carga"
+
+# Turno de ejecución de los reruns (ver docstring del módulo)
+_run_lock = threading.Lock()
+
+
+def rss_bytes():
+    """Memoria residente actual del proceso (máxima histórica si el sistema no informa la actual)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def percentile(values, q):
+    """Percentil `q` (0-100) por el método del rango más cercano."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+def install_backend(n_rows, latency=0.0, error_rate=0.0):
+    """
+    Registra la planilla falsa como la conexión del proceso y los secretos que la
+    apuntan; retorna la hoja falsa para contar sus peticiones.
+    """
+    worksheet = fake_sheets.FakeWorksheet(fake_sheets.generate_rows(n_rows), latency=latency, error_rate=error_rate)
+    conn = fake_sheets.FakeConnection(worksheet, quota.limiter, SPREADSHEET_URL)
+    connection.set_connection(CREDENTIALS, SPREADSHEET_URL, conn)
+    # Secretos fijos para todo el proceso: el probador los reemplaza por ejecución si
+    # se le pasan, y eso no es seguro con varias sesiones en paralelo
+    secrets = Secrets([])
+    secrets._secrets = {"gcp_service_account": CREDENTIALS, "spreadsheet_url": SPREADSHEET_URL}
+    st.secrets = secrets
+    return worksheet
+
+
+class Session:
+    """Un operador simulado: una sesión de la aplicación y sus tiempos de rerun."""
+
+    def __init__(self, number, seed=0):
+        self.number = number
+        self.rng = random.Random(seed * 1000 + number)
+        self.app = AppTest.from_file(APP_PATH, default_timeout=RERUN_TIMEOUT)
+        self.times = []
+        self.errors = 0
+
+    def _timed(self, action, refresh=False):
+        start = time.perf_counter()
+        try:
+            with _run_lock:
+                action()
+                elapsed = time.perf_counter() - start
+                if refresh:
+                    self._refresh()
+            if self.app.exception:
+                self.errors += 1
+        except Exception:
+            elapsed = time.perf_counter() - start
+            self.errors += 1
+        self.times.append(elapsed)
+
+    def _refresh(self):
+        """
+        Vuelve a leer la pantalla tras un st.rerun() pedido desde un fragmento: el
+        probador deja en el árbol los widgets de la ejecución anterior junto con los
+        nuevos, y el siguiente rerun fallaría al leer su estado. La ejecución sin
+        cambios de widgets (fuera de la medición) equivale a lo que ya muestra el
+        navegador.
+        """
+        self.app._run()
+
+    # --- Acciones ---
+    def start(self):
+        self._timed(self.app.run)
+
+    def buscar(self):
+        query = self.rng.choice(QUERIES)
+        self._timed(lambda: self.app.text_input(key="search_input").input(query).run())
+
+    def elegir(self):
+        options = self.app.selectbox(key="row_selector").options
+        if options:
+            label = self.rng.choice(options)
+            self._timed(lambda: self.app.selectbox(key="row_selector").select(label).run())
+
+    def guardar(self):
+        # El formulario de la fila elegida (tras "Siguiente fila" el árbol también trae el de la anterior)
+        field = self.app.text_input(key=f"superficie_{self.app.session_state.selected_row}")
+        value = str(round(self.rng.uniform(1, 30), 2)).replace(".", ",")
+
+        def save():
+            field.input(value)
+            self._button("Guardar cambios").click().run()
+        self._timed(save, refresh=True)
+
+    def siguiente(self):
+        self._timed(lambda: self._button("Siguiente fila").click().run(), refresh=True)
+
+    def _button(self, label):
+        return next(button for button in self.app.button if button.label == label)
+
+    def run(self, n_actions):
+        """Arranca la sesión y ejecuta `n_actions` acciones al azar según sus pesos."""
+        self.start()
+        names, weights = zip(*ACTIONS)
+        for _ in range(n_actions):
+            try:
+                getattr(self, self.rng.choices(names, weights)[0])()
+            except (KeyError, StopIteration, IndexError):
+                # El elemento no está en esta ejecución (p. ej. búsqueda sin resultados)
+                self.errors += 1
+        return self
+
+
+def run_level(n_sessions, n_actions, worksheet, baseline_rss, seed=0):
+    """Ejecuta `n_sessions` sesiones en paralelo y retorna el resultado del nivel."""
+    calls_before = sum(worksheet.calls.values())
+    threads_before = threading.active_count()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_sessions, thread_name_prefix="sesion") as pool:
+        sessions = list(pool.map(lambda number: Session(number, seed).run(n_actions), range(n_sessions)))
+    elapsed = time.perf_counter() - start
+    # Hilos que quedan vivos después de las sesiones (refrescador, cola de escritura...)
+    threads_after = threading.active_count()
+    times = [t for session in sessions for t in session.times]
+    errors = sum(session.errors for session in sessions)
+    calls = sum(worksheet.calls.values()) - calls_before
+    del sessions
+    gc.collect()
+    rss = rss_bytes()
+    return {
+        "sesiones": n_sessions,
+        "reruns": len(times),
+        "errores": errors,
+        "p50_ms": round(1000 * percentile(times, 50), 1),
+        "p99_ms": round(1000 * percentile(times, 99), 1),
+        "promedio_ms": round(1000 * statistics.fmean(times), 1) if times else 0.0,
+        "reruns_s": round(len(times) / elapsed, 2) if elapsed else 0.0,
+        "hilos_antes": threads_before,
+        "hilos_despues": threads_after,
+        "rss_mb": round(rss / 2 ** 20, 1),
+        "crecimiento_rss_mb": round((rss - baseline_rss) / 2 ** 20, 1),
+        "peticiones": calls,
+        "peticiones_s": round(calls / elapsed, 2) if elapsed else 0.0,
+        "duracion_s": round(elapsed, 2),
+    }
+
+
+def run_load_test(levels, n_actions=DEFAULT_ACTIONS, n_rows=DEFAULT_ROWS, latency=0.0, error_rate=0.0, seed=0,
+                  log=print):
+    """Ejecuta un nivel por cada cantidad de sesiones y retorna la lista de resultados."""
+    worksheet = install_backend(n_rows, latency, error_rate)
+    baseline_rss = rss_bytes()
+    results = []
+    for n_sessions in levels:
+        result = run_level(n_sessions, n_actions, worksheet, baseline_rss, seed)
+        results.append(result)
+        log(f"{n_sessions:>4} sesiones  p50 {result['p50_ms']:8.1f} ms  p99 {result['p99_ms']:8.1f} ms  "
+            f"hilos {result['hilos_despues']:>4}  RSS {result['rss_mb']:8.1f} MB (+{result['crecimiento_rss_mb']:.1f})  "
+            f"{result['peticiones_s']:6.2f} peticiones/s")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga de la interfaz con sesiones simultáneas.")
+    parser.add_argument("--sessions", type=int, nargs="+", default=DEFAULT_SESSIONS, help="cantidades de sesiones")
+    parser.add_argument("--actions", type=int, default=DEFAULT_ACTIONS, help="acciones por sesión")
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help="filas de la planilla falsa")
+    parser.add_argument("--latency", type=float, default=0.0, help="latencia simulada por llamada a la API (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probabilidad de error 429 por llamada")
+    parser.add_argument("--seed", type=int, default=0, help="semilla de las acciones simuladas")
+    parser.add_argument("--output", help="archivo JSON de resultados (por omisión, salida estándar)")
+    args = parser.parse_args(argv)
+
+    # Sin caché ni diario en disco ni fuentes configuradas: se prueba solo la planilla falsa
+    os.environ["SHEETS_CACHE_DIR"] = ""
+    os.environ["SHEETS_JOURNAL_DIR"] = ""
+    os.environ["SHEETS_SOURCES"] = ""
+    results = run_load_test(args.sessions, args.actions, args.rows, args.latency, args.error_rate, args.seed,
+                            log=lambda m: print(m, file=sys.stderr))
+    report = {
+        "entorno": {
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "filas": args.rows,
+            "acciones_por_sesion": args.actions,
+            "latencia_s": args.latency,
+            "tasa_error": args.error_rate,
+            "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "resultados": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
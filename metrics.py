@@ -0,0 +1,298 @@
+"""
+Instrumentación de la aplicación: histogramas de latencia, contadores e indicadores.
+
+Registra la latencia de cada llamada a la API de Sheets (por método y categoría
+de cuota), la duración de cada rerun de Streamlit desglosada por fase, el tamaño
+del snapshot, los aciertos de caché y el uso de la cuota. Los datos se consultan
+en el panel de diagnóstico oculto de la barra lateral (`?diagnostico=1`), como
+texto en formato Prometheus (`prometheus_text()`, o el archivo indicado en
+`SHEETS_METRICS_FILE`, reescrito cada minuto) y como logs JSON en el logger
+`metrics` cuando está en nivel INFO.
+
+Con `SHEETS_METRICS=0` la instrumentación queda desactivada: `timer()` retorna un
+contexto vacío compartido y el resto de las funciones retorna de inmediato.
+"""
+import bisect
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("metrics")
+
+ENABLED = os.environ.get("SHEETS_METRICS", "1") != "0"
+# Archivo de texto Prometheus (p. ej. para el textfile collector de node_exporter)
+DUMP_PATH = os.environ.get("SHEETS_METRICS_FILE")
+DUMP_INTERVAL = 60
+
+# Límites superiores (segundos) de los buckets de los histogramas de latencia
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class Histogram:
+    """Histograma acumulativo con buckets fijos, al estilo de Prometheus."""
+
+    __slots__ = ("counts", "count", "total", "maximum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def quantile(self, q):
+        """Cuantil aproximado: límite superior del bucket que lo contiene."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS + (self.maximum,), self.counts):
+            seen += n
+            if seen >= target:
+                return min(bound, self.maximum)
+        return self.maximum
+
+
+class Registry:
+    """Métricas del proceso, compartidas por todas las sesiones e hilos."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._collectors = []
+        self._help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def describe(self, name, text):
+        """Texto de ayuda de una métrica para el formato Prometheus."""
+        self._help[name] = text
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def register_collector(self, collector):
+        """Registra una función que actualiza indicadores justo antes de exportarlos."""
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def collect(self):
+        """Copia consistente de todas las métricas: (histogramas, contadores, indicadores)."""
+        for collector in list(self._collectors):
+            try:
+                collector()
+            except Exception as e:
+                logger.warning("Error al recolectar métricas: %s", e)
+        with self._lock:
+            histograms = {}
+            for key, h in self._histograms.items():
+                copy = Histogram()
+                copy.counts, copy.count, copy.total, copy.maximum = list(h.counts), h.count, h.total, h.maximum
+                histograms[key] = copy
+            return histograms, dict(self._counters), dict(self._gauges)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._gauges.clear()
+
+
+registry = Registry()
+
+
+# --- API del módulo (sin costo cuando la instrumentación está desactivada) ---
+def observe(name, value, **labels):
+    """Registra una observación (en segundos) en un histograma."""
+    if ENABLED:
+        registry.observe(name, value, **labels)
+
+
+def increment(name, amount=1, **labels):
+    """Incrementa un contador."""
+    if ENABLED:
+        registry.increment(name, amount, **labels)
+
+
+def set_gauge(name, value, **labels):
+    """Fija el valor actual de un indicador."""
+    if ENABLED:
+        registry.set_gauge(name, value, **labels)
+
+
+class _Timer:
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        registry.observe(self.name, elapsed, **self.labels)
+        if logger.isEnabledFor(logging.INFO):
+            log_event(self.name, segundos=round(elapsed, 6), error=exc_type.__name__ if exc_type else None,
+                      **self.labels)
+        return False
+
+
+def timer(name, **labels):
+    """Contexto que mide su duración en el histograma `name`."""
+    if not ENABLED:
+        return _NULL_CONTEXT
+    return _Timer(name, labels)
+
+
+def log_event(event, **fields):
+    """Emite un log estructurado en JSON (una línea por evento) en el logger `metrics`."""
+    if ENABLED and logger.isEnabledFor(logging.INFO):
+        fields = {k: v for k, v in fields.items() if v is not None}
+        logger.info(json.dumps({"evento": event, "ts": round(time.time(), 3), **fields}, ensure_ascii=False))
+
+
+# --- Exportación ---
+def _escape_label(value):
+    # Los valores pueden venir de la configuración (p. ej. nombres de fuentes en fuentes.toml)
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in items) + "}"
+
+
+def prometheus_text():
+    """Todas las métricas en el formato de texto de Prometheus."""
+    histograms, counters, gauges = registry.collect()
+    lines = []
+    described = set()
+
+    def header(name, kind):
+        if name not in described:
+            described.add(name)
+            if name in registry._help:
+                lines.append(f"# HELP {name} {registry._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), h in sorted(histograms.items()):
+        header(name, "histogram")
+        cumulative = 0
+        for bound, n in zip(BUCKETS, h.counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {h.count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {h.total:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {h.count}")
+    for (name, labels), value in sorted(counters.items()):
+        header(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), value in sorted(gauges.items()):
+        header(name, "gauge")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    """Resumen de las métricas para el panel de diagnóstico y el volcado JSON."""
+    histograms, counters, gauges = registry.collect()
+    return {
+        "histogramas": [
+            {
+                "metrica": name, **dict(labels),
+                "llamadas": h.count,
+                "promedio_ms": round(1000 * h.total / h.count, 1) if h.count else 0.0,
+                "p50_ms": round(1000 * h.quantile(0.5), 1),
+                "p95_ms": round(1000 * h.quantile(0.95), 1),
+                "max_ms": round(1000 * h.maximum, 1),
+            }
+            for (name, labels), h in sorted(histograms.items())
+        ],
+        "contadores": [{"metrica": name, **dict(labels), "valor": value} for (name, labels), value in sorted(counters.items())],
+        "indicadores": [{"metrica": name, **dict(labels), "valor": value} for (name, labels), value in sorted(gauges.items())],
+    }
+
+
+def hit_rate(name, hit="hit"):
+    """Proporción de eventos `name` con result=hit (None si no hay eventos)."""
+    _, counters, _ = registry.collect()
+    total = hits = 0
+    for (metric, labels), value in counters.items():
+        if metric == name:
+            total += value
+            if dict(labels).get("result") == hit:
+                hits += value
+    return hits / total if total else None
+
+
+_dumper = None
+_dumper_lock = threading.Lock()
+
+
+def _run_dumper():
+    while True:
+        time.sleep(DUMP_INTERVAL)
+        try:
+            tmp = DUMP_PATH + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(prometheus_text())
+            os.replace(tmp, DUMP_PATH)
+        except Exception as e:
+            logger.warning("No se pudo escribir el archivo de métricas: %s", e)
+
+
+def start_dumper():
+    """Arranca (una vez por proceso) el volcado periódico a `SHEETS_METRICS_FILE`, si está configurado."""
+    global _dumper
+    if not ENABLED or not DUMP_PATH:
+        return
+    with _dumper_lock:
+        if _dumper is None:
+            _dumper = threading.Thread(target=_run_dumper, daemon=True)
+            _dumper.start()
+
+
+registry.describe("sheets_api_call_seconds", "Latencia de cada intento de llamada a la API de Sheets/Drive.")
+registry.describe("sheets_api_errors_total", "Llamadas a la API que fallaron, por código HTTP.")
+registry.describe("sheets_quota_wait_seconds", "Espera por turno en el limitador de cuota.")
+registry.describe("app_rerun_seconds", "Duración total de cada rerun de Streamlit.")
+registry.describe("app_rerun_phase_seconds", "Duración de cada fase del rerun.")
+registry.describe("snapshot_requests_total", "Accesos al snapshot: hit (vigente), stale (copia en disco en revalidación), not_modified (revisión sin cambios) o fetch.")
+registry.describe("app_fragment_seconds", "Duración de cada ejecución de un fragmento de la interfaz.")
+registry.describe("rows_completed_total", "Filas pendientes que quedaron completas al guardarlas (filas procesadas).")
+registry.describe("grid_saves_total", "Guardados desde la vista de tabla (varias filas en un solo envío).")
+registry.describe("row_saves_total", "Guardados de una fila según la verificación previa: sin_conflicto, fusionado, conflicto o sin_verificar.")
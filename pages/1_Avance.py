@@ -0,0 +1,91 @@
+"""
+Panel de avance de la limpieza de datos por cuenta y campo.
+
+Muestra, para toda la planilla, cada cuenta y cada campo, qué proporción de las
+sondas ya tiene coordenadas, cultivo, superficie y caudal, y cuántas llevan cada
+comentario de selección rápida. Los totales (`progress.ProgressIndex`) se
+comparten entre sesiones y se actualizan con cada versión del snapshot: abrir el
+panel no recorre la planilla mientras no cambie.
+"""
+import pandas as pd
+import streamlit as st
+
+import progress
+import rules
+from app_data import get_snapshot_store, load_snapshot
+
+st.set_page_config(
+    page_title="Avance de la planilla",
+    page_icon="📊",
+    layout="wide"
+)
+
+# Opción del selector de cuentas que muestra los campos de todas
+TODAS_LAS_CUENTAS = "Todas las cuentas"
+# Columnas de las tablas de avance
+ETIQUETAS_INDICES = {
+    'cuenta_id': "ID cuenta", 'cuenta_nombre': "Cuenta",
+    'campo_id': "ID campo", 'campo_nombre': "Campo",
+    'sondas': "Sondas",
+}
+
+
+def get_progress_index(snap):
+    """Retorna los totales de avance compartidos, sincronizados con la versión del snapshot."""
+    index = get_snapshot_store().derived("avance", progress.ProgressIndex)
+    index.sync(snap)
+    return index
+
+
+def progress_table(totals):
+    """Tabla de avance: sondas, porcentaje con cada dato y cantidad con cada comentario."""
+    porcentajes = progress.shares(totals)[[name for name, _ in progress.DATA]] * 100
+    tabla = pd.concat([totals[['sondas']], porcentajes, totals[rules.COMENTARIOS_LISTA]], axis=1)
+    return tabla.reset_index().rename(columns=ETIQUETAS_INDICES)
+
+
+def show_progress_table(totals):
+    column_config = {
+        name: st.column_config.ProgressColumn(descripcion, format="%.0f%%", min_value=0, max_value=100)
+        for name, descripcion in progress.DATA
+    }
+    st.dataframe(progress_table(totals), hide_index=True, use_container_width=True, column_config=column_config)
+
+
+def main():
+    st.title("Avance de la limpieza de datos")
+    with st.spinner("Cargando datos de la planilla..."):
+        snap = load_snapshot()
+    if not snap or not len(snap.table):
+        st.error("No se pudieron cargar los datos. Por favor, recarga la página.")
+        return
+    index = get_progress_index(snap)
+
+    # Toda la planilla
+    total = index.overall()
+    sondas = int(total['sondas'])
+    st.caption(f"{sondas} sondas · versión {snap.version} de los datos")
+    columnas = st.columns(len(progress.DATA))
+    for columna, (name, descripcion) in zip(columnas, progress.DATA):
+        con_dato = int(total[name])
+        columna.metric(descripcion, f"{con_dato / sondas:.0%}" if sondas else "-",
+                       help=f"{con_dato} de {sondas} sondas")
+
+    with st.expander("Comentarios de selección rápida"):
+        comentarios = total[rules.COMENTARIOS_LISTA].astype(int)
+        st.dataframe(
+            comentarios.rename("Sondas").rename_axis("Comentario").reset_index(),
+            hide_index=True, use_container_width=True
+        )
+
+    st.subheader("Por cuenta")
+    por_cuenta = index.by_cuenta()
+    show_progress_table(por_cuenta)
+
+    st.subheader("Por campo")
+    cuentas = {f"{nombre} [ID: {cuenta_id}]": cuenta_id for cuenta_id, nombre in por_cuenta.index}
+    elegida = st.selectbox("Cuenta", [TODAS_LAS_CUENTAS] + list(cuentas), key="avance_cuenta")
+    show_progress_table(index.by_campo(cuentas.get(elegida)))
+
+
+main()
@@ -0,0 +1,178 @@
+"""
+Avance de la limpieza de datos por cuenta y campo.
+
+Para cada cuenta y campo cuenta las sondas, cuántas tienen coordenadas, cultivo,
+superficie y caudal, y cuántas llevan cada comentario de selección rápida
+(`rules.COMENTARIOS_LISTA`). Los indicadores de cada fila se calculan en una
+pasada vectorizada sobre la tabla columnar y se suman con un group-by de pandas.
+
+Como el índice de búsqueda y el de completitud, se calcula una vez por versión
+del snapshot y se comparte entre sesiones. Cuando el snapshot informa qué filas
+cambiaron (p. ej. al guardar una fila), se restan de sus grupos los indicadores
+anteriores de esas filas y se suman los nuevos, sin volver a agrupar toda la
+planilla. Los totales por cuenta y por campo que muestra el panel de avance se
+arman una vez por versión a partir de esas sumas.
+"""
+import threading
+
+import numpy as np
+import pandas as pd
+
+import completeness
+import consistency
+import metrics
+import rules
+
+# Campos que identifican la cuenta y el campo de cada fila
+CUENTA_FIELDS = ['cuenta_id', 'cuenta_nombre']
+CAMPO_FIELDS = ['campo_id', 'campo_nombre']
+GROUP_FIELDS = CUENTA_FIELDS + CAMPO_FIELDS
+# Datos cuyo avance se informa: (columna, descripción)
+DATA = [
+    ('coordenadas', "Con coordenadas"),
+    ('cultivo', "Con cultivo"),
+    ('superficie', "Con superficie"),
+    ('caudal', "Con caudal"),
+]
+# Columnas de los indicadores: total de sondas, datos presentes y comentarios de selección rápida
+COLUMNS = ['sondas'] + [name for name, _ in DATA] + rules.COMENTARIOS_LISTA
+
+
+def _comment_bits(comment):
+    """Máscara de los comentarios de selección rápida presentes en un comentario."""
+    parts = rules.split_comments(str(comment))
+    return sum(1 << bit for bit, text in enumerate(rules.COMENTARIOS_LISTA) if text in parts)
+
+
+def row_indicators(table):
+    """
+    Indicadores (0/1) de cada fila, una columna por cada una de COLUMNS, junto con
+    la cuenta y el campo de la fila; indexados por número de fila.
+    """
+    columns = {field: table.frame[field].astype(str).to_numpy(dtype=object) for field in GROUP_FIELDS}
+    columns['sondas'] = np.ones(len(table), dtype=np.int64)
+    columns['coordenadas'] = ~completeness.missing_coordinates(table)
+    columns['cultivo'] = ~consistency.is_blank(table, 'cultivo')
+    columns['superficie'] = ~np.isnan(table.numeric['superficie_ha'].to_numpy())
+    columns['caudal'] = ~np.isnan(table.numeric['caudal_teorico'].to_numpy())
+    bits = consistency.per_value(table, 'comentario', _comment_bits).astype(np.int64)
+    for bit, text in enumerate(rules.COMENTARIOS_LISTA):
+        columns[text] = (bits >> bit) & 1
+    frame = pd.DataFrame(columns, index=table.frame.index)
+    frame[COLUMNS] = frame[COLUMNS].astype(np.int64)
+    return frame
+
+
+def shares(totals):
+    """Proporción (0 a 1) de sondas de cada grupo con cada indicador."""
+    return totals[COLUMNS[1:]].div(totals['sondas'].where(totals['sondas'] > 0), axis=0).fillna(0.0)
+
+
+class ProgressIndex:
+    """Totales de los indicadores por cuenta y campo, sincronizados por versión del snapshot."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        # Grupos (cuenta y campo) en orden de aparición y su posición
+        self._keys = []
+        self._codes = {}
+        # Sumas de los indicadores de cada grupo (una fila por grupo, una columna por indicador)
+        self._totals = None
+        # Por fila: número de fila, grupo e indicadores, para restarlos cuando la fila cambia
+        self._row_index = None
+        self._row_groups = None
+        self._row_values = None
+        self._views = {}
+
+    def sync(self, snap):
+        """Pone los totales al día con el snapshot, corrigiendo solo los grupos de las filas que cambiaron si es posible."""
+        with self._lock:
+            if self.version is not None and snap.version <= self.version:
+                return
+            table = snap.table
+            changed = snap.changes_since(self.version)
+            if not (changed is not None and self._update(table, changed)):
+                metrics.increment("progress_index_syncs_total", mode="full")
+                with metrics.timer("progress_index_build_seconds"):
+                    self._build(table)
+            self._views = {}
+            self.version = snap.version
+
+    def _build(self, table):
+        rows = row_indicators(table)
+        groups = rows.groupby(GROUP_FIELDS, sort=False)
+        sums = groups[COLUMNS].sum()
+        keys = list(sums.index)
+        self._keys = keys
+        self._codes = {key: code for code, key in enumerate(keys)}
+        self._totals = sums.to_numpy()
+        self._row_index = rows.index
+        self._row_groups = groups.ngroup().to_numpy()
+        self._row_values = rows[COLUMNS].to_numpy()
+
+    def _update(self, table, changed_rows):
+        """Corrige los totales con las filas que cambiaron; False si cambió el conjunto de filas (requiere recalcular)."""
+        changed = sorted(changed_rows)
+        positions = self._row_index.get_indexer(changed)
+        if (positions < 0).any() or not all(row_number in table for row_number in changed):
+            return False
+        metrics.increment("progress_index_syncs_total", mode="incremental")
+        np.subtract.at(self._totals, self._row_groups[positions], self._row_values[positions])
+        rows = row_indicators(table.take(changed))
+        groups = []
+        for key in rows[GROUP_FIELDS].itertuples(index=False, name=None):
+            code = self._codes.get(key)
+            if code is None:
+                code = self._codes[key] = len(self._keys)
+                self._keys.append(key)
+            groups.append(code)
+        if len(self._keys) > len(self._totals):
+            self._totals = np.vstack([
+                self._totals, np.zeros((len(self._keys) - len(self._totals), len(COLUMNS)), dtype=np.int64)
+            ])
+        values = rows[COLUMNS].to_numpy()
+        np.add.at(self._totals, groups, values)
+        self._row_groups[positions] = groups
+        self._row_values[positions] = values
+        return True
+
+    def _view(self, key, compute):
+        with self._lock:
+            view = self._views.get(key)
+            if view is None:
+                view = self._views[key] = compute()
+            return view
+
+    def _groups(self):
+        """Totales por cuenta y campo (sin los grupos que quedaron sin sondas)."""
+        def compute():
+            index = pd.MultiIndex.from_tuples(self._keys, names=GROUP_FIELDS)
+            totals = pd.DataFrame(self._totals[:len(self._keys)], index=index, columns=COLUMNS)
+            return totals[totals['sondas'] > 0]
+        return self._view("grupos", compute)
+
+    def overall(self):
+        """Totales de toda la planilla (una serie con COLUMNS)."""
+        return self._view("total", lambda: pd.Series(self._totals.sum(axis=0), index=COLUMNS))
+
+    def by_cuenta(self):
+        """Totales por cuenta, ordenados por nombre de cuenta."""
+        totals = self._groups()
+        return self._view(
+            "cuenta", lambda: totals.groupby(level=CUENTA_FIELDS).sum().sort_index(level='cuenta_nombre')
+        )
+
+    def by_campo(self, cuenta_id=None):
+        """Totales por campo, de todas las cuentas o solo de la indicada, ordenados por cuenta y campo."""
+        totals = self._groups()
+
+        def compute():
+            selected = totals
+            if cuenta_id is not None:
+                selected = totals[totals.index.get_level_values('cuenta_id') == cuenta_id]
+            return selected.sort_index(level=['cuenta_nombre', 'campo_nombre'])
+        return self._view(("campo", cuenta_id), compute)
+
+
+metrics.registry.describe("progress_index_build_seconds", "Cálculo completo de los totales de avance por cuenta y campo.")
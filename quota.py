@@ -0,0 +1,228 @@
+"""
+Limitador de cuota compartido para las llamadas a la API de Google Sheets.
+
+Google limita las peticiones por minuto de cada usuario (la cuenta de servicio)
+por separado para lectura y escritura. Todas las llamadas del proceso pasan por
+un único limitador de tipo token bucket por categoría, que reparte los tokens
+por prioridad (las acciones interactivas antes que los refrescos de fondo),
+reintenta los errores 429/5xx con espera exponencial y jitter, y avisa con
+`QuotaExceeded` cuando la espera estimada supera lo que el llamador acepta.
+"""
+import contextlib
+import heapq
+import itertools
+import random
+import threading
+import time
+
+import metrics
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Peticiones por minuto por categoría (cuota por usuario de Sheets; Drive es más holgada)
+DEFAULT_LIMITS = {
+    'read': 60,
+    'write': 60,
+    'drive': 600,
+}
+PERIOD = 60.0
+
+# Reintentos ante errores transitorios y espera base/máxima entre ellos (segundos)
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 64.0
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+KIND_LABELS = {
+    'read': 'lectura',
+    'write': 'escritura',
+    'drive': 'metadatos',
+}
+
+
+class QuotaExceeded(Exception):
+    """La cuota está saturada y la espera estimada supera el máximo aceptado por el llamador."""
+
+    def __init__(self, kind, wait):
+        self.kind = kind
+        self.wait = wait
+        super().__init__(
+            f"La planilla está recibiendo demasiadas solicitudes de {KIND_LABELS.get(kind, kind)}; "
+            f"intenta de nuevo en unos {max(1, round(wait))} s."
+        )
+
+
+class _Bucket:
+    """Token bucket de una categoría con su cola de espera por prioridad."""
+
+    def __init__(self, per_period, period):
+        self.capacity = float(per_period)
+        self.rate = per_period / period
+        self.tokens = float(per_period)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiters = []
+        self.granted = 0
+        self.throttled = 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def estimated_wait(self, now, ahead):
+        """Segundos hasta que haya token para un llamador con `ahead` llamadores delante."""
+        missing = ahead + 1 - self.tokens
+        return max(self.blocked_until - now, missing / self.rate if missing > 0 else 0.0)
+
+
+_context = threading.local()
+
+
+@contextlib.contextmanager
+def priority(level, max_wait=None):
+    """Fija la prioridad (y la espera máxima aceptada) de las llamadas hechas por el hilo actual."""
+    previous = getattr(_context, "value", None)
+    _context.value = (level, max_wait)
+    try:
+        yield
+    finally:
+        _context.value = previous
+
+
+def current_priority():
+    """Prioridad y espera máxima vigentes en el hilo actual (interactiva y sin límite por omisión)."""
+    return getattr(_context, "value", None) or (INTERACTIVE, None)
+
+
+class QuotaLimiter:
+    """Limitador de proceso con un token bucket por categoría de llamada."""
+
+    def __init__(self, limits=None, period=PERIOD):
+        self._cond = threading.Condition()
+        self._buckets = {kind: _Bucket(n, period) for kind, n in (limits or DEFAULT_LIMITS).items()}
+        self._sequence = itertools.count()
+
+    def acquire(self, kind, level=None, max_wait=None):
+        """
+        Toma un token de la categoría, esperando su turno según la prioridad.
+        Lanza `QuotaExceeded` si la espera estimada supera `max_wait`.
+        """
+        if level is None:
+            level, context_wait = current_priority()
+            max_wait = context_wait if max_wait is None else max_wait
+        bucket = self._buckets[kind]
+        ticket = (level, next(self._sequence))
+        with self._cond:
+            heapq.heappush(bucket.waiters, ticket)
+            try:
+                checked = False
+                while True:
+                    now = time.monotonic()
+                    bucket.refill(now)
+                    if bucket.waiters[0] == ticket and bucket.tokens >= 1 and now >= bucket.blocked_until:
+                        bucket.tokens -= 1
+                        bucket.granted += 1
+                        heapq.heappop(bucket.waiters)
+                        return
+                    ahead = sum(1 for waiter in bucket.waiters if waiter < ticket)
+                    wait = bucket.estimated_wait(now, ahead)
+                    if not checked:
+                        checked = True
+                        bucket.throttled += 1
+                        if max_wait is not None and wait > max_wait:
+                            raise QuotaExceeded(kind, wait)
+                    self._cond.wait(max(wait, 0.01) if bucket.waiters[0] == ticket else None)
+            except BaseException:
+                if ticket in bucket.waiters:
+                    bucket.waiters.remove(ticket)
+                    heapq.heapify(bucket.waiters)
+                raise
+            finally:
+                self._cond.notify_all()
+
+    def penalize(self, kind, delay):
+        """Detiene la categoría durante `delay` segundos tras un rechazo por cuota del servidor."""
+        with self._cond:
+            bucket = self._buckets[kind]
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + delay)
+            bucket.tokens = min(bucket.tokens, 0.0)
+
+    def usage(self):
+        """Estado de cada categoría: tokens disponibles, llamadores en espera y totales concedidos/demorados."""
+        with self._cond:
+            now = time.monotonic()
+            result = {}
+            for kind, bucket in self._buckets.items():
+                bucket.refill(now)
+                result[kind] = {
+                    'disponibles': round(bucket.tokens, 1),
+                    'limite_por_minuto': round(bucket.rate * 60),
+                    'en_espera': len(bucket.waiters),
+                    'concedidas': bucket.granted,
+                    'demoradas': bucket.throttled,
+                }
+            return result
+
+
+# requests y gspread se importan recién al clasificar un error (ya están cargados si
+# hubo llamadas a la API): importarlos con el módulo alarga el arranque de la aplicación
+def error_status(error):
+    """Código HTTP de un error de la API (None si no proviene de una respuesta)."""
+    from gspread.exceptions import APIError
+    if isinstance(error, APIError):
+        return getattr(error.response, "status_code", None)
+    return None
+
+
+def is_retryable(error):
+    """Indica si el error es transitorio (cuota, error del servidor o de red)."""
+    import requests
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return error_status(error) in RETRYABLE_STATUS
+
+
+def backoff_delay(attempt):
+    """Espera exponencial con jitter completo para el intento indicado (1, 2, ...)."""
+    return random.uniform(0, min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX))
+
+
+def call(limiter, kind, fn, retries=MAX_RETRIES, name=None):
+    """
+    Ejecuta `fn()` respetando la cuota y reintentando errores transitorios con espera
+    exponencial. `name` identifica la llamada en las métricas (p. ej. 'batch_get').
+    """
+    name = name or kind
+    attempt = 0
+    while True:
+        with metrics.timer("sheets_quota_wait_seconds", kind=kind):
+            limiter.acquire(kind)
+        try:
+            with metrics.timer("sheets_api_call_seconds", method=name, kind=kind):
+                return fn()
+        except Exception as e:
+            metrics.increment("sheets_api_errors_total", method=name, status=error_status(e) or type(e).__name__)
+            attempt += 1
+            if attempt > retries or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt)
+            if error_status(e) == 429:
+                limiter.penalize(kind, delay)
+            time.sleep(delay)
+
+
+# Limitador único del proceso: la cuota es por cuenta de servicio, no por sesión
+limiter = QuotaLimiter()
+
+
+def _collect_usage():
+    for kind, usage in limiter.usage().items():
+        metrics.set_gauge("sheets_quota_available_tokens", usage['disponibles'], kind=kind)
+        metrics.set_gauge("sheets_quota_waiting", usage['en_espera'], kind=kind)
+        metrics.set_gauge("sheets_quota_granted_total", usage['concedidas'], kind=kind)
+        metrics.set_gauge("sheets_quota_throttled_total", usage['demoradas'], kind=kind)
+
+
+metrics.registry.register_collector(_collect_usage)
@@ -0,0 +1,328 @@
+"""
+Reglas de guardado de una fila.
+
+Traducen los valores ingresados en el formulario a las celdas que hay que
+escribir: detección de cambios respecto de la fila actual y campos derivados
+(coordenadas en grados decimales desde la ubicación DMS, superficie en m2 y
+densidades por hectárea). Las usan el guardado de una fila, la edición masiva
+(los mismos valores en todas las filas filtradas), la vista de tabla (solo las
+celdas editadas) y la importación por lotes.
+"""
+import math
+import re
+
+from table import format_cell, parse_number
+
+# Comentarios de selección rápida (se guardan separados por ", ")
+COMENTARIOS_LISTA = [
+    "La cuenta no existe", "La sonda no existe o no está asociada",
+    "Sonda no georreferenciable", "La sonda no tiene sensores habilitados",
+    "La sonda no está operando", "No hay datos de cultivo",
+    "Datos de cultivo incompletos", "Datos de cultivo no son reales",
+    "Consultar datos faltantes"
+]
+
+# Campos del formulario de edición (además de los comentarios)
+CAMPOS_FORMULARIO = [
+    'superficie_ha', 'caudal_teorico', 'ppeq_mm_h', 'plantas_total', 'emisores_total',
+    'cultivo', 'variedad', 'ano_plantacion', 'ubicacion_sonda',
+]
+
+# Campos que ingresa el usuario al guardar una fila (el resto se deriva de ellos)
+CAMPOS_INGRESADOS = CAMPOS_FORMULARIO + ['comentario']
+
+# Formas de aplicar los comentarios en la edición masiva
+COMENTARIOS_SIN_CAMBIOS = "Sin cambios"
+COMENTARIOS_REEMPLAZAR = "Reemplazar"
+COMENTARIOS_AGREGAR = "Agregar a los actuales"
+
+
+def dms_to_dd(dms):
+    """Convierte coordenadas en formato DMS (grados, minutos, segundos) a DD (grados decimales)."""
+    parts = re.split('[°\'"]+', dms)
+    degrees = float(parts[0])
+    minutes = float(parts[1])
+    seconds = float(parts[2])
+    direction = parts[3].strip()
+    dd = degrees + minutes / 60 + seconds / 3600
+    if direction in ['S', 'W']:
+        dd *= -1
+    return dd
+
+
+def split_comments(comment):
+    """Separa el comentario de una fila en sus partes."""
+    return comment.split(", ") if comment else []
+
+
+def _to_float(text):
+    """Interpreta un número con coma decimal; retorna "" si está vacío y el texto si no es numérico."""
+    cleaned = text.strip().lstrip("'").replace(",", ".")
+    try:
+        return float(cleaned) if cleaned else ""
+    except Exception:
+        return cleaned
+
+
+def compute_row_changes(row_data, valores):
+    """
+    Calcula las celdas a escribir en una fila a partir de los valores del formulario.
+
+    `row_data` es la fila actual `{campo: texto}` y `valores` los textos ingresados
+    para cada campo de CAMPOS_FORMULARIO más 'comentarios' (lista de comentarios
+    seleccionados). Retorna `(celdas, cambios, avisos)`: las celdas `{campo: valor}`,
+    la descripción de los cambios realizados y los avisos de valores que no se
+    pudieron interpretar (en esos casos se mantiene el valor anterior).
+    """
+    celdas = {}
+    cambios = []
+    avisos = []
+
+    def actual(campo):
+        value = row_data.get(campo)
+        return '' if value is None else value
+
+    # --- Ubicación y conversión de coordenadas (DMS a DD) ---
+    ubicacion_sonda = valores['ubicacion_sonda']
+    if ubicacion_sonda.strip() != actual('ubicacion_sonda').strip():
+        if ubicacion_sonda.strip():
+            lat_parts = ubicacion_sonda.split()
+            if len(lat_parts) >= 2:
+                try:
+                    latitud_dd = dms_to_dd(lat_parts[0])
+                    longitud_dd = dms_to_dd(lat_parts[1])
+                    celdas['ubicacion_sonda'] = ubicacion_sonda
+                    celdas['latitud_sonda'] = f"{latitud_dd:.8f}".replace(".", ",")
+                    celdas['longitud_sonda'] = f"{longitud_dd:.8f}".replace(".", ",")
+                    cambios.append("Ubicación sonda actualizada")
+                except Exception as e:
+                    avisos.append(f"Error al convertir la ubicación: {str(e)}; se mantendrá el valor anterior.")
+        else:
+            celdas['ubicacion_sonda'] = ""
+            celdas['latitud_sonda'] = ""
+            celdas['longitud_sonda'] = ""
+            cambios.append("Ubicación sonda actualizada")
+
+    # --- Actualización de textos ---
+    if valores['cultivo'].strip() != actual('cultivo').strip():
+        celdas['cultivo'] = valores['cultivo']
+        cambios.append("Cultivo actualizado")
+
+    if valores['variedad'].strip() != actual('variedad').strip():
+        celdas['variedad'] = valores['variedad']
+        cambios.append("Variedad actualizada")
+
+    # --- Año de plantación: eliminar comilla y convertir a número ---
+    cleaned_ano = valores['ano_plantacion'].strip().lstrip("'")
+    if cleaned_ano:
+        try:
+            ano_val = int(cleaned_ano)
+        except Exception:
+            ano_val = cleaned_ano
+    else:
+        ano_val = ""
+    if str(ano_val) != actual('ano_plantacion').strip().lstrip("'"):
+        celdas['ano_plantacion'] = ano_val
+        cambios.append("Año plantación actualizado")
+
+    # --- N° plantas y N° emisores (total) ---
+    plantas_cleaned = valores['plantas_total'].strip().lstrip("'").replace(",", "")
+    emisores_cleaned = valores['emisores_total'].strip().lstrip("'").replace(",", "")
+
+    if plantas_cleaned != actual('plantas_total').strip():
+        celdas['plantas_total'] = plantas_cleaned if plantas_cleaned else ""
+        cambios.append("N° plantas actualizado")
+
+    if emisores_cleaned != actual('emisores_total').strip():
+        celdas['emisores_total'] = emisores_cleaned if emisores_cleaned else ""
+        cambios.append("N° emisores actualizado")
+
+    # --- Superficie (ha) y Superficie (m2) ---
+    superficie_val = _to_float(valores['superficie_ha'])
+    if superficie_val != _to_float(actual('superficie_ha')):
+        if superficie_val != "":
+            try:
+                superficie_m2 = float(superficie_val) * 10000
+                celdas['superficie_ha'] = superficie_val
+                celdas['superficie_m2'] = superficie_m2
+                cambios.append("Superficie actualizada")
+            except Exception as e:
+                avisos.append(f"Error al procesar superficie: {str(e)}; se mantendrá el valor anterior.")
+        else:
+            celdas['superficie_ha'] = ""
+            celdas['superficie_m2'] = ""
+            cambios.append("Superficie actualizada")
+
+    # --- Densidades N° plantas/ha y N° emisores/ha ---
+    # Solo se calculan si hay superficie y los valores correspondientes
+    if (plantas_cleaned or emisores_cleaned) and superficie_val not in ["", None, 0]:
+        try:
+            if plantas_cleaned:
+                celdas['plantas_ha'] = math.ceil(int(plantas_cleaned) / float(superficie_val))
+                cambios.append("Densidad plantas/ha actualizada")
+            if emisores_cleaned:
+                celdas['emisores_ha'] = math.ceil(int(emisores_cleaned) / float(superficie_val))
+                cambios.append("Densidad emisores/ha actualizada")
+        except Exception as e:
+            avisos.append(f"Error al calcular densidades: {str(e)}")
+    elif not superficie_val or superficie_val in ["", None, 0]:
+        # Sin superficie se limpian los campos de densidad
+        celdas['plantas_ha'] = ""
+        celdas['emisores_ha'] = ""
+        cambios.append("Densidades limpiadas (falta superficie)")
+
+    # --- Caudal teórico (m3/h) ---
+    caudal_val = _to_float(valores['caudal_teorico'])
+    if caudal_val != _to_float(actual('caudal_teorico')):
+        celdas['caudal_teorico'] = caudal_val
+        cambios.append("Caudal teórico actualizado")
+
+    # --- PPeq [mm/h] ---
+    ppeq_val = _to_float(valores['ppeq_mm_h'])
+    if ppeq_val != _to_float(actual('ppeq_mm_h')):
+        celdas['ppeq_mm_h'] = ppeq_val
+        cambios.append("PPeq actualizado")
+
+    # --- Comentarios de selección rápida ---
+    if valores.get('comentarios'):
+        nuevo_comentario = ", ".join(valores['comentarios'])
+        if nuevo_comentario != actual('comentario').strip():
+            celdas['comentario'] = nuevo_comentario
+            cambios.append("Comentarios actualizados (checkboxes)")
+
+    return celdas, cambios, avisos
+
+
+def touched_fields(base_row, valores):
+    """Campos ingresados que el usuario cambió respecto de la fila que tenía a la vista."""
+    celdas, _, _ = compute_row_changes(base_row, valores)
+    return [campo for campo in CAMPOS_INGRESADOS if campo in celdas]
+
+
+def _own_value(campo, valores):
+    if campo == 'comentario':
+        return ", ".join(valores.get('comentarios') or [])
+    return valores[campo]
+
+
+def conflicting_fields(base_row, remote_row, valores):
+    """
+    Campos que el usuario cambió y que otra persona también cambió en la planilla,
+    con un valor distinto: `{campo: (original, planilla, propio)}`.
+    """
+    conflictos = {}
+    for campo in touched_fields(base_row, valores):
+        original = (base_row.get(campo) or '').strip()
+        remoto = (remote_row.get(campo) or '').strip()
+        propio = str(_own_value(campo, valores)).strip()
+        if remoto != original and remoto != propio:
+            conflictos[campo] = (original, remoto, propio)
+    return conflictos
+
+
+def merge_row_changes(base_row, remote_row, valores, keep_remote=()):
+    """
+    Fusión a tres bandas de un guardado: aplica sobre la fila actual de la planilla
+    (`remote_row`) solo los campos que el usuario cambió respecto de la fila que tenía
+    a la vista (`base_row`), salvo los de `keep_remote`. Los campos derivados se
+    recalculan con el resultado. Retorna `(celdas, cambios, avisos)` como `compute_row_changes`.
+    """
+    touched = set(touched_fields(base_row, valores)) - set(keep_remote)
+    merged = {
+        campo: valores[campo] if campo in touched else remote_row.get(campo) or ''
+        for campo in CAMPOS_FORMULARIO
+    }
+    if 'comentario' in touched:
+        merged['comentarios'] = valores.get('comentarios') or []
+    return compute_row_changes(remote_row, merged)
+
+
+def is_noop(current, value, decimal_comma=None):
+    """
+    Indica si escribir `value` sobre una celda con el texto `current` la dejaría igual
+    (mismo texto o, en campos numéricos, el mismo número).
+    """
+    new_text = format_cell(value)
+    if new_text == current.strip():
+        return True
+    if decimal_comma is None:
+        return False
+    new_number = parse_number(new_text, decimal_comma)
+    return not math.isnan(new_number) and new_number == parse_number(current, decimal_comma)
+
+
+def edit_changes(row_data, valores, numeric_fields, comentarios=(), comentarios_modo=COMENTARIOS_SIN_CAMBIOS):
+    """
+    Aplica a una fila solo los campos indicados en `valores`, con las reglas de
+    `compute_row_changes`: el resto conserva el valor actual, de modo que los campos
+    derivados se recalculan con los datos propios de la fila. Omite las celdas que
+    no cambian. Retorna `(celdas, avisos)` con las celdas `{campo: valor}`.
+    """
+    valores_fila = {campo: valores.get(campo, row_data.get(campo) or '') for campo in CAMPOS_FORMULARIO}
+    if comentarios_modo == COMENTARIOS_REEMPLAZAR:
+        valores_fila['comentarios'] = list(comentarios)
+    elif comentarios_modo == COMENTARIOS_AGREGAR:
+        actuales = split_comments(row_data.get('comentario') or '')
+        valores_fila['comentarios'] = actuales + [c for c in comentarios if c not in actuales]
+    celdas, _, avisos = compute_row_changes(row_data, valores_fila)
+    celdas = {
+        field: value for field, value in celdas.items()
+        if not is_noop(row_data.get(field) or '', value, numeric_fields.get(field))
+    }
+    return celdas, avisos
+
+
+def bulk_changes(table, row_numbers, valores, comentarios=(), comentarios_modo=COMENTARIOS_SIN_CAMBIOS):
+    """
+    Aplica los mismos valores a varias filas con `edit_changes`. Retorna `(celdas, avisos)`:
+    las celdas `{(fila, campo): valor}` y los avisos por fila.
+    """
+    celdas = {}
+    avisos = {}
+    for row_number in row_numbers:
+        celdas_fila, avisos_fila = edit_changes(
+            table.row(row_number), valores, table.numeric_fields, comentarios, comentarios_modo
+        )
+        for field, value in celdas_fila.items():
+            celdas[(row_number, field)] = value
+        if avisos_fila:
+            avisos[row_number] = avisos_fila
+    return celdas, avisos
+
+
+def normalize_comment(comment):
+    """Comentario con sus partes sin espacios ni comas sobrantes ni partes vacías, separadas por ", "."""
+    parts = (part.strip(" ,") for part in split_comments(comment.strip()))
+    return ", ".join(part for part in parts if part)
+
+
+def cell_changes(table, edits):
+    """
+    Celdas a escribir para ediciones sueltas de celdas `{(fila, campo): texto}` en
+    campos de CAMPOS_INGRESADOS (p. ej. la vista de tabla). Cada fila pasa por
+    `edit_changes` solo con sus campos editados, así que los campos derivados se
+    recalculan con los datos actuales de la fila y las filas sin ediciones no se
+    procesan. El comentario se escribe tal cual, normalizado. Retorna `(celdas,
+    avisos)` como `bulk_changes`; las filas que ya no existen se informan como aviso.
+    """
+    by_row = {}
+    for (row_number, field), text in edits.items():
+        by_row.setdefault(row_number, {})[field] = text
+    celdas = {}
+    avisos = {}
+    for row_number, valores in by_row.items():
+        if row_number not in table:
+            avisos[row_number] = ["La fila ya no existe en la planilla; no se guardó."]
+            continue
+        row_data = table.row(row_number)
+        comentario = valores.pop('comentario', None)
+        celdas_fila, avisos_fila = edit_changes(row_data, valores, table.numeric_fields) if valores else ({}, [])
+        if comentario is not None:
+            comentario = normalize_comment(comentario)
+            if comentario != (row_data.get('comentario') or '').strip():
+                celdas_fila['comentario'] = comentario
+        for field, value in celdas_fila.items():
+            celdas[(row_number, field)] = value
+        if avisos_fila:
+            avisos[row_number] = avisos_fila
+    return celdas, avisos
@@ -0,0 +1,46 @@
+"""
+Estructura de la planilla: columnas que usa la aplicación y cómo interpretar los
+campos numéricos. Se comparte entre la interfaz (`code.py`) y los scripts que
+se ejecutan sin Streamlit.
+"""
+
+# Mapeo de nombres de campo a índices de columna (base 0)
+COLUMNAS = {
+    'cuenta_id': 0,            # A
+    'cuenta_nombre': 1,        # B
+    'campo_id': 2,             # C
+    'campo_nombre': 3,         # D
+    'sonda_id': 11,            # L
+    'sonda_nombre': 10,        # K
+    'ubicacion_sonda': 12,     # M
+    'latitud_sonda': 13,       # N
+    'longitud_sonda': 14,      # O
+    'cultivo': 17,             # R
+    'variedad': 18,            # S
+    'ano_plantacion': 20,      # U
+    'plantas_ha': 22,          # W
+    'plantas_total': 23,       # X
+    'emisores_ha': 24,         # Y
+    'emisores_total': 25,      # Z
+    'superficie_ha': 31,       # AF
+    'superficie_m2': 32,       # AG
+    'caudal_teorico': 33,      # AH
+    'ppeq_mm_h': 34,           # AI
+    'comentario': 41,          # AP
+}
+
+# Campos numéricos que se interpretan una sola vez al cargar el snapshot
+# (True: la coma es separador decimal; False: la coma es separador de miles)
+CAMPOS_NUMERICOS = {
+    'latitud_sonda': True,
+    'longitud_sonda': True,
+    'ano_plantacion': True,
+    'plantas_ha': False,
+    'plantas_total': False,
+    'emisores_ha': False,
+    'emisores_total': False,
+    'superficie_ha': True,
+    'superficie_m2': True,
+    'caudal_teorico': True,
+    'ppeq_mm_h': True,
+}
@@ -0,0 +1,337 @@
+"""
+Índice de búsqueda de filas.
+
+Se construye una vez por versión del snapshot y se comparte entre sesiones. Los
+valores se normalizan sin mayúsculas ni tildes ("Ñuble" == "nuble") y, por cada
+columna, los valores distintos se concatenan en un único texto con sus offsets
+ordenados: una búsqueda de subcadena es un `str.find` sobre ese texto más una
+búsqueda binaria para saber a qué valor pertenece cada coincidencia, sin recorrer
+las filas. Admite términos con campo, p. ej. `cuenta:123`, `sonda:"norte 2"`,
+`fuente:maule` o `fila:250` (número de fila exacto en su hoja, en cualquier fuente). Cuando el snapshot informa qué filas
+cambiaron, el índice se actualiza solo para esas filas.
+
+Como con las etiquetas del selector (`row_label`), un número solo también busca
+ese número de fila, y se puede pegar una etiqueta (o parte de ella) como consulta:
+"Fila 152" equivale a `fila:152`, "Cuenta: Agrícola" a `cuenta:agricola` y los
+separadores de la etiqueta ("-", "(ID:", paréntesis) se ignoran.
+
+Los resultados se ordenan por relevancia (valor idéntico al término, término al
+inicio de una palabra o dentro de ella) y el selector los muestra por páginas
+de PAGE_SIZE filas.
+"""
+import bisect
+import functools
+import re
+import threading
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from table import ROW_BLOCK, row_id, split_row_id
+
+# Prefijos de búsqueda por campo y las columnas de COLUMNAS que abarcan
+SEARCH_FIELDS = {
+    'cuenta': ('cuenta_nombre', 'cuenta_id'),
+    'campo': ('campo_nombre', 'campo_id'),
+    'sonda': ('sonda_nombre', 'sonda_id'),
+    'cultivo': ('cultivo',),
+    'variedad': ('variedad',),
+    'fuente': ('fuente',),
+    'fila': (),
+}
+
+# Calidad de una coincidencia para ordenar resultados: valor idéntico al término,
+# término al inicio del valor o de una palabra, o término dentro de una palabra
+EXACT = 3
+PREFIX = 2
+SUBSTRING = 1
+
+# Resultados por página en el selector de filas
+PAGE_SIZE = 50
+
+# Separador entre valores en el texto concatenado; no puede aparecer en una consulta
+_SEPARATOR = "\x1f"
+_QUERY_TERM = re.compile(r'(?:(\w+):)?(?:"([^"]*)"|(\S+))')
+# Palabras de las etiquetas de `row_label` que no son datos de la fila
+_LABEL_NOISE = {"-", "·", "id:"}
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def normalize(text):
+    """Normaliza un texto para búsqueda: sin tildes ni diacríticos, en minúsculas y sin espacios extremos."""
+    text = str(text)
+    if text.isascii():
+        return text.casefold().strip()
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold().strip()
+
+
+def parse_query(query):
+    """
+    Separa una consulta en términos `(campo, texto)`; campo es None si el término no lo
+    indica. Los títulos de una etiqueta copiada ("Cuenta:", "Fila") acotan el término
+    siguiente a ese campo.
+    """
+    terms = []
+    scoped = None
+    for field, quoted, bare in _QUERY_TERM.findall(query):
+        text = normalize(quoted if quoted else bare).replace(_SEPARATOR, "")
+        field = normalize(field) if field else None
+        if field is not None and field not in SEARCH_FIELDS:
+            # Prefijo desconocido: se busca el término completo, incluidos los dos puntos
+            text = normalize(f"{field}:{quoted or bare}")
+            field = None
+        if field is None and not quoted:
+            text = text.strip("()")
+            if text in _LABEL_NOISE:
+                continue
+            if text == "fila" or text.endswith(":") and text[:-1] in SEARCH_FIELDS:
+                scoped = text.rstrip(":")
+                continue
+        if scoped is not None:
+            if field is None and (scoped != 'fila' or text.isdigit()):
+                field = scoped
+            elif scoped == 'fila':
+                terms.append((None, 'fila'))
+            scoped = None
+        if text:
+            terms.append((field, text))
+    if scoped == 'fila':
+        # "fila" sin número a continuación es una palabra más
+        terms.append((None, 'fila'))
+    return terms
+
+
+def row_label(row_number, row):
+    """Texto descriptivo de una fila para el selector."""
+    def value(field):
+        return row.get(field) or ''
+    _, sheet_row = split_row_id(row_number)
+    fuente = f"{row['fuente']} · " if row.get('fuente') else ''
+    return f"{fuente}Fila {sheet_row} - Cuenta: {value('cuenta_nombre')} (ID: {value('cuenta_id')}) - Campo: {value('campo_nombre')} (ID: {value('campo_id')}) - Sonda: {value('sonda_nombre')} (ID: {value('sonda_id')})"
+
+
+class _ColumnIndex:
+    """Valores normalizados distintos de una columna, con las filas que los contienen."""
+
+    def __init__(self):
+        self.rows_by_value = {}
+        self._haystack = None
+
+    def add(self, text, row_number):
+        rows = self.rows_by_value.get(text)
+        if rows is None:
+            rows = self.rows_by_value[text] = set()
+            self._haystack = None
+        rows.add(row_number)
+
+    def remove(self, text, row_number):
+        rows = self.rows_by_value.get(text)
+        if rows is None:
+            return
+        rows.discard(row_number)
+        if not rows:
+            del self.rows_by_value[text]
+            self._haystack = None
+
+    def _build_haystack(self):
+        values = list(self.rows_by_value)
+        offsets = []
+        position = 0
+        for value in values:
+            offsets.append(position)
+            position += len(value) + 1
+        self._haystack = (_SEPARATOR.join(values), offsets, values)
+        return self._haystack
+
+    def matches(self, term):
+        """Retorna pares `(valor, calidad)` de los valores que contienen el término (EXACT, PREFIX o SUBSTRING)."""
+        haystack, offsets, values = self._haystack or self._build_haystack()
+        found = []
+        position = haystack.find(term)
+        while position != -1:
+            k = bisect.bisect_right(offsets, position) - 1
+            value = values[k]
+            if value == term:
+                quality = EXACT
+            elif position == offsets[k] or haystack[position - 1] == " ":
+                quality = PREFIX
+            else:
+                quality = SUBSTRING
+            found.append((value, quality))
+            # Continuar en el valor siguiente: basta una coincidencia por valor
+            if k + 1 >= len(offsets):
+                break
+            position = haystack.find(term, offsets[k + 1])
+        return found
+
+
+class SearchIndex:
+    """Índice compartido de las filas del snapshot, sincronizado por versión."""
+
+    def __init__(self, label):
+        self._columns = [column for columns in SEARCH_FIELDS.values() for column in columns]
+        self._label = label
+        self._lock = threading.Lock()
+        self.version = None
+        self._clear()
+
+    def _clear(self):
+        self._column_indexes = {column: _ColumnIndex() for column in self._columns}
+        self._table = None
+        self._labels = {}
+        self._row_numbers = range(0)
+        self._sources = 1
+
+    # --- Construcción y actualización ---
+    def sync(self, snap):
+        """Pone el índice al día con el snapshot, de forma incremental si es posible."""
+        with self._lock:
+            # Un fragmento puede llegar con un snapshot anterior al ya indexado
+            if self.version is not None and snap.version <= self.version:
+                return
+            # Filas que cambiaron desde la versión indexada (aunque se haya saltado varias)
+            changed = snap.changes_since(self.version)
+            table = snap.table
+            if changed is not None:
+                metrics.increment("search_index_syncs_total", mode="incremental")
+                for row_number in changed:
+                    self._remove_row(row_number)
+                    if row_number in table:
+                        self._add_row(row_number, table)
+                    self._labels.pop(row_number, None)
+            else:
+                metrics.increment("search_index_syncs_total", mode="full")
+                with metrics.timer("search_index_build_seconds"):
+                    self._build(table)
+            self._table = table
+            self._row_numbers = table.row_numbers()
+            self._sources = int(table.row_number_array()[-1]) // ROW_BLOCK + 1 if len(table) else 1
+            self.version = snap.version
+
+    def _build(self, table):
+        """Construye el índice completo columna por columna, normalizando cada valor distinto una sola vez."""
+        self._clear()
+        for column in self._columns:
+            if column not in table.fields:
+                continue
+            codes, uniques = pd.factorize(table.frame[column])
+            order = table.row_number_array()[np.argsort(codes, kind="stable")]
+            bounds = np.cumsum(np.bincount(codes[codes >= 0], minlength=len(uniques)))
+            rows_by_value = self._column_indexes[column].rows_by_value
+            start = 0
+            for value, end in zip(uniques, bounds.tolist()):
+                text = normalize(value)
+                if text:
+                    row_numbers = order[start:end].tolist()
+                    existing = rows_by_value.get(text)
+                    if existing is None:
+                        rows_by_value[text] = set(row_numbers)
+                    else:
+                        existing.update(row_numbers)
+                start = end
+
+    def _add_row(self, row_number, table):
+        for column in self._columns:
+            if column not in table.fields:
+                continue
+            text = normalize(table.value(row_number, column))
+            if text:
+                self._column_indexes[column].add(text, row_number)
+
+    def _remove_row(self, row_number):
+        if self._table is None or row_number not in self._table:
+            return
+        for column in self._columns:
+            if column not in self._table.fields:
+                continue
+            text = normalize(self._table.value(row_number, column))
+            if text:
+                self._column_indexes[column].remove(text, row_number)
+
+    # --- Consultas ---
+    def label(self, row_number):
+        """Texto descriptivo de la fila para la interfaz (se genera una vez por fila y versión)."""
+        label = self._labels.get(row_number)
+        if label is None:
+            if self._table is None or row_number not in self._table:
+                return f"Fila {row_number}"
+            label = self._labels[row_number] = self._label(row_number, self._table.row(row_number))
+        return label
+
+    def row_numbers(self):
+        """Todos los números de fila indexados, en orden."""
+        return self._row_numbers
+
+    def _sheet_rows(self, text):
+        """Filas con ese número en su hoja, una por fuente que la tenga."""
+        if not text.isdigit() or self._table is None:
+            return []
+        return [row_id(n, int(text)) for n in range(self._sources) if row_id(n, int(text)) in self._table]
+
+    def _term_rows(self, field, text):
+        if field == 'fila':
+            return set(self._sheet_rows(text))
+        # Un número solo también es el número de fila (como en las etiquetas del selector)
+        rows = set(self._sheet_rows(text)) if field is None else set()
+        for column in (SEARCH_FIELDS[field] if field else self._columns):
+            column_index = self._column_indexes[column]
+            for value, _ in column_index.matches(text):
+                rows |= column_index.rows_by_value[value]
+        return rows
+
+    def _term_scores(self, field, text):
+        """Filas que contienen el término con la mejor calidad de coincidencia de cada una."""
+        if field == 'fila':
+            return dict.fromkeys(self._sheet_rows(text), EXACT)
+        scores = dict.fromkeys(self._sheet_rows(text), EXACT) if field is None else {}
+        for column in (SEARCH_FIELDS[field] if field else self._columns):
+            column_index = self._column_indexes[column]
+            for value, quality in column_index.matches(text):
+                for row_number in column_index.rows_by_value[value]:
+                    if scores.get(row_number, 0) < quality:
+                        scores[row_number] = quality
+        return scores
+
+    def ranked(self, query):
+        """
+        Filas que cumplen todos los términos, de la más a la menos relevante (suma de
+        la calidad de coincidencia de cada término; a igual relevancia, por número de
+        fila). Sin términos retorna todas las filas en orden.
+        """
+        terms = parse_query(query or "")
+        with self._lock:
+            if not terms:
+                return self._row_numbers
+            scores = None
+            for field, text in terms:
+                term_scores = self._term_scores(field, text)
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {row: score + term_scores[row] for row, score in scores.items() if row in term_scores}
+                if not scores:
+                    return []
+            return sorted(scores, key=lambda row: (-scores[row], row))
+
+    def search(self, query):
+        """Retorna los números de fila (ordenados) que cumplen todos los términos de la consulta."""
+        terms = parse_query(query or "")
+        with self._lock:
+            if not terms:
+                return list(self._row_numbers)
+            result = None
+            for field, text in terms:
+                rows = self._term_rows(field, text)
+                result = rows if result is None else result & rows
+                if not result:
+                    return []
+            return sorted(result)
+
+
+def page_of(rows, position, page_size=PAGE_SIZE):
+    """Retorna `(inicio, filas)` de la página de resultados que contiene la posición indicada."""
+    start = position // page_size * page_size
+    return start, list(rows[start:start + page_size])
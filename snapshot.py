@@ -0,0 +1,493 @@
+"""
+Snapshot compartido de la planilla.
+
+Todas las sesiones de Streamlit del proceso leen la misma copia inmutable de la
+planilla. Un único hilo la refresca mientras haya sesiones vivas, y las
+descargas concurrentes se agrupan en una sola petición (single-flight).
+
+La sincronización es incremental: antes de descargar se consulta la revisión de
+la planilla (hora de modificación en Drive) y, si no cambió, se renueva el
+snapshot sin leer celdas. Cuando sí cambió, la nueva versión informa qué filas
+difieren de la anterior para que los índices derivados se actualicen por partes.
+El almacén conserva además las filas cambiadas de las últimas CHANGE_LOG_VERSIONS
+versiones, así que un índice que se saltó varias versiones (p. ej. una relectura
+de fila y un guardado seguidos, o guardados de otras sesiones entre dos reruns)
+también se actualiza por partes con la unión de esos cambios.
+
+Costo conocido: la revisión no distingue quién modificó la planilla, y los
+`batch_update` de la propia cola de escritura también la cambian. Por eso el
+primer refresco después de cada guardado vuelve a descargar las columnas de la
+hoja escrita (con varias fuentes, solo las hojas cuya planilla cambió; ver
+`sources`), aunque nadie más la haya editado. Lo que se evita es el resto: la
+nueva tabla se compara con la anterior y los índices se actualizan solo con las
+filas que difieren. No se da por propia la revisión leída tras un guardado porque
+una edición externa hecha en el mismo intervalo quedaría oculta hasta el próximo
+cambio de la planilla. Con guardados frecuentes, el costo es a lo sumo una
+descarga por TTL (`DEFAULT_TTL`), como sin sincronización incremental.
+
+Los datos se guardan en una `table.SheetTable` columnar de solo lectura. Con
+`build`, la tabla se arma a partir de lo que retorna `fetch` (p. ej. las hojas de
+varias fuentes, ver `sources`) en lugar de interpretarlo como filas de una hoja.
+
+Con `cache_path`, cada descarga se guarda en disco (`snapshot_cache`) y, tras un
+reinicio, el primer acceso parte de esa copia en lugar de esperar la descarga:
+se sirve de inmediato aunque esté vencida y se revalida en segundo plano
+(stale-while-revalidate).
+
+Las escrituras locales (ver `write_queue`) se aplican de inmediato sobre el
+snapshot vigente y se mantienen como una capa superpuesta hasta que la planilla
+las confirma, de modo que un refresco intermedio no las deshace.
+"""
+import collections
+import logging
+import threading
+import time
+
+import metrics
+import quota
+import snapshot_cache
+from table import SheetTable
+
+logger = logging.getLogger(__name__)
+
+# Segundos que un snapshot se considera vigente
+DEFAULT_TTL = 120
+# Segundos sin actividad tras los cuales una sesión se considera cerrada
+SESSION_TIMEOUT = 600
+# Versiones recientes cuyas filas cambiadas se conservan para las actualizaciones por partes
+CHANGE_LOG_VERSIONS = 256
+
+
+class ChangeLog:
+    """Filas que cambiaron en cada una de las últimas versiones del snapshot (acotado a `limit` versiones)."""
+
+    def __init__(self, limit=CHANGE_LOG_VERSIONS):
+        self.limit = limit
+        self._lock = threading.Lock()
+        # versión -> (versión base, filas cambiadas o None)
+        self._entries = collections.OrderedDict()
+
+    def record(self, version, base_version, changed_rows):
+        with self._lock:
+            self._entries[version] = (base_version, changed_rows)
+            while len(self._entries) > self.limit:
+                self._entries.popitem(last=False)
+
+    def since(self, version, until):
+        """
+        Unión de las filas que cambiaron después de `version` y hasta `until`; None si
+        algún tramo no se conoce (carga completa o versión ya descartada del registro).
+        """
+        rows = set()
+        with self._lock:
+            current = until
+            while current != version:
+                entry = self._entries.get(current)
+                if entry is None or entry[0] is None or entry[1] is None or entry[0] < version:
+                    return None
+                current, changed = entry
+                rows.update(changed)
+        return frozenset(rows)
+
+
+class Snapshot:
+    """
+    Copia inmutable de la planilla: tabla columnar, versión y hora de descarga.
+
+    `changed_rows` contiene los números de fila (base 1) que difieren respecto de
+    `base_version`; es None cuando el snapshot proviene de una carga completa sin base.
+    `log` es el registro de cambios del almacén (ver `changes_since`).
+    """
+
+    __slots__ = ("table", "version", "fetched_at", "revision", "base_version", "changed_rows", "log")
+
+    def __init__(self, table, version, fetched_at, revision=None, base_version=None, changed_rows=None, log=None):
+        self.table = table
+        self.version = version
+        self.fetched_at = fetched_at
+        self.revision = revision
+        self.base_version = base_version
+        self.changed_rows = changed_rows
+        self.log = log
+
+    def changes_since(self, version):
+        """
+        Filas que cambiaron desde la versión indicada hasta esta; None si no se sabe
+        (sin versión previa, carga completa o cambios ya descartados del registro), en
+        cuyo caso los índices derivados se recalculan completos.
+        """
+        if version is None:
+            return None
+        if version == self.base_version:
+            return self.changed_rows
+        if self.log is None:
+            return None
+        return self.log.since(version, self.version)
+
+    def age(self):
+        """Segundos transcurridos desde la descarga."""
+        return time.time() - self.fetched_at
+
+
+class _Flight:
+    """Descarga en curso a la que pueden esperar varios hilos."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SnapshotStore:
+    """Almacén de proceso del snapshot con TTL, refresco single-flight y un refrescador por proceso."""
+
+    def __init__(self, fetch, columnas, numeric_fields=None, ttl=DEFAULT_TTL,
+                 session_timeout=SESSION_TIMEOUT, probe=None, cache_path=None, build=None):
+        self._fetch = fetch
+        self._build = build
+        self._probe = probe
+        self.cache_path = cache_path
+        self.columnas = columnas
+        self.numeric_fields = numeric_fields
+        self.ttl = ttl
+        self.session_timeout = session_timeout
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = 0
+        self._flight = None
+        self._sessions = {}
+        self._refresher = None
+        self._closed = threading.Event()
+        self._derived = {}
+        self._overlay = {}
+        self._changes = ChangeLog()
+        self._memory_usage = None
+        self._cache_lock = threading.Lock()
+        self._cache_checked = cache_path is None
+        self._from_cache = False
+        self._revalidating = False
+        self.last_error = None
+
+    def current(self):
+        """Retorna el último snapshot disponible (o None) sin hacer peticiones."""
+        return self._snapshot
+
+    def derived(self, name, factory):
+        """Retorna un objeto derivado del snapshot (índices, agregados) compartido por el proceso, creándolo una sola vez."""
+        with self._lock:
+            obj = self._derived.get(name)
+            if obj is None:
+                obj = self._derived[name] = factory()
+            return obj
+
+    def get(self):
+        """
+        Retorna el snapshot vigente, descargándolo solo si no existe o expiró el TTL. La
+        copia leída de la caché en disco se retorna de inmediato (aunque esté vencida)
+        y se revalida una vez en segundo plano.
+        """
+        snap = self._snapshot
+        if snap is None and not self._cache_checked:
+            snap = self._load_cache()
+        if snap is not None and self._from_cache:
+            self._revalidate_in_background()
+            metrics.increment("snapshot_requests_total", result="hit" if snap.age() < self.ttl else "stale")
+            return snap
+        if snap is not None and snap.age() < self.ttl:
+            metrics.increment("snapshot_requests_total", result="hit")
+            return snap
+        return self.refresh()
+
+    @property
+    def from_cache(self):
+        """Indica si el snapshot vigente es la copia en disco y aún no se verificó contra la planilla."""
+        return self._from_cache
+
+    def _load_cache(self):
+        """Publica como snapshot inicial la copia guardada en disco, si existe (una sola vez)."""
+        with self._cache_lock:
+            if not self._cache_checked:
+                self._cache_checked = True
+                cached = snapshot_cache.load(self.cache_path, self.columnas, self.numeric_fields)
+                if cached is not None:
+                    table, fetched_at, revision = cached
+                    with self._lock:
+                        if self._snapshot is None:
+                            self._version += 1
+                            self._changes.record(self._version, None, None)
+                            self._snapshot = Snapshot(table, self._version, fetched_at, revision, log=self._changes)
+                            self._from_cache = True
+        return self._snapshot
+
+    def _revalidate_in_background(self):
+        """Lanza (si no hay otra en curso) una sincronización de fondo del snapshot leído de disco."""
+        with self._lock:
+            if self._revalidating:
+                return
+            self._revalidating = True
+
+        def run():
+            try:
+                with quota.priority(quota.BACKGROUND):
+                    self.refresh()
+            except Exception as e:
+                logger.warning("No se pudo revalidar el snapshot leído de disco: %s", e)
+            finally:
+                with self._lock:
+                    self._revalidating = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _save_cache(self, table, fetched_at, revision):
+        """Guarda en disco (en segundo plano) la tabla tal como se descargó, sin escrituras locales."""
+        def run():
+            with self._cache_lock:
+                snapshot_cache.save(self.cache_path, table, fetched_at, revision, self.columnas)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def refresh(self):
+        """Sincroniza con la planilla; si ya hay una sincronización en curso, espera su resultado en vez de repetirla."""
+        with self._lock:
+            flight = self._flight
+            leader = flight is None
+            if leader:
+                flight = self._flight = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            snap = self._sync()
+            with self._lock:
+                flight.result = snap
+            self.last_error = None
+            return flight.result
+        except Exception as e:
+            flight.error = self.last_error = e
+            raise
+        finally:
+            with self._lock:
+                self._flight = None
+            flight.done.set()
+
+    def _probe_revision(self):
+        """Consulta la revisión actual de la planilla; None si no hay sonda configurada o falla."""
+        if self._probe is None:
+            return None
+        try:
+            return self._probe()
+        except Exception as e:
+            logger.warning("No se pudo consultar la revisión de la planilla: %s", e)
+            return None
+
+    def _sync(self):
+        """Publica el siguiente snapshot, descargando celdas solo si la revisión cambió."""
+        revision = self._probe_revision()
+        previous = self._snapshot
+        table = None
+        if previous is None or revision is None or revision != previous.revision:
+            metrics.increment("snapshot_requests_total", result="fetch")
+            with metrics.timer("snapshot_fetch_seconds"):
+                rows = self._fetch()
+            with metrics.timer("snapshot_build_seconds"):
+                if self._build is not None:
+                    table = self._build(rows)
+                else:
+                    table = SheetTable.from_rows(rows, self.columnas, self.numeric_fields)
+            if self.cache_path:
+                self._save_cache(table, time.time(), revision)
+        else:
+            metrics.increment("snapshot_requests_total", result="not_modified")
+
+        with self._lock:
+            now = time.time()
+            self._from_cache = False
+            current = self._snapshot
+            if table is not None and self._overlay:
+                table = table.with_values(self._overlay)
+            changed = table.diff(current.table) if table is not None and current is not None else None
+            if current is not None and (table is None or not changed):
+                snap = Snapshot(current.table, current.version, now, revision,
+                                current.base_version, current.changed_rows, self._changes)
+            else:
+                self._version += 1
+                base_version = current.version if current is not None else None
+                self._changes.record(self._version, base_version, changed)
+                snap = Snapshot(table, self._version, now, revision, base_version, changed, self._changes)
+            self._snapshot = snap
+            return snap
+
+    def patch(self, cells):
+        """
+        Aplica escrituras locales `{(fila, campo): texto}` sobre el snapshot vigente
+        (lectura de lo escrito sin esperar a la planilla) y las mantiene superpuestas
+        hasta que se confirmen con `acknowledge()` o se descarten con `discard()`.
+        """
+        with self._lock:
+            self._overlay.update(cells)
+            current = self._snapshot
+            if current is None:
+                return None
+            table = current.table.with_values(cells)
+            self._version += 1
+            rows = frozenset(row_number for row_number, _ in cells)
+            self._changes.record(self._version, current.version, rows)
+            self._snapshot = Snapshot(table, self._version, current.fetched_at, current.revision,
+                                      current.version, rows, self._changes)
+            return self._snapshot
+
+    def pending(self, row_number):
+        """Escrituras locales de una fila que la planilla aún no confirmó: `{campo: texto}`."""
+        with self._lock:
+            return {field: value for (row, field), value in self._overlay.items() if row == row_number}
+
+    def apply_remote(self, cells):
+        """
+        Publica en el snapshot celdas leídas directamente de la planilla `{(fila, campo): texto}`
+        (p. ej. la relectura de una fila antes de guardarla) sin esperar al próximo
+        refresco. Las escrituras locales pendientes siguen teniendo prioridad.
+        """
+        with self._lock:
+            current = self._snapshot
+            if current is None:
+                return None
+            table = current.table
+            cells = {
+                (row_number, field): value for (row_number, field), value in cells.items()
+                if (row_number, field) not in self._overlay and row_number in table
+                and table.value(row_number, field) != value
+            }
+            if not cells:
+                return current
+            self._version += 1
+            rows = frozenset(row_number for row_number, _ in cells)
+            self._changes.record(self._version, current.version, rows)
+            self._snapshot = Snapshot(table.with_values(cells), self._version, current.fetched_at,
+                                      current.revision, current.version, rows, self._changes)
+            return self._snapshot
+
+    def acknowledge(self, cells):
+        """Retira de la capa superpuesta las escrituras que la planilla ya confirmó."""
+        with self._lock:
+            for key, value in cells.items():
+                if self._overlay.get(key) == value:
+                    del self._overlay[key]
+
+    def discard(self, cells):
+        """
+        Retira escrituras que no pudieron guardarse y marca el snapshot como vencido
+        para que el próximo acceso vuelva a leer la planilla.
+        """
+        with self._lock:
+            for key, value in cells.items():
+                if self._overlay.get(key) == value:
+                    del self._overlay[key]
+            current = self._snapshot
+            if current is not None:
+                self._snapshot = Snapshot(current.table, current.version, 0, None,
+                                          current.base_version, current.changed_rows, self._changes)
+
+    def memory_usage(self):
+        """Bytes ocupados por la tabla del snapshot vigente (se calcula una vez por tabla)."""
+        snap = self._snapshot
+        if snap is None:
+            return 0
+        cached = self._memory_usage
+        if cached is None or cached[0] is not snap.table:
+            cached = self._memory_usage = (snap.table, snap.table.memory_usage())
+        return cached[1]
+
+    def collect_metrics(self, key):
+        """Actualiza los indicadores del snapshot (filas, bytes, versión, antigüedad y sesiones)."""
+        snap = self._snapshot
+        if snap is None:
+            return
+        metrics.set_gauge("snapshot_rows", len(snap.table), store=key)
+        metrics.set_gauge("snapshot_bytes", self.memory_usage(), store=key)
+        metrics.set_gauge("snapshot_version", snap.version, store=key)
+        metrics.set_gauge("snapshot_age_seconds", round(snap.age(), 1), store=key)
+        metrics.set_gauge("snapshot_overlay_cells", len(self._overlay), store=key)
+        with self._lock:
+            metrics.set_gauge("active_sessions", self._prune_sessions(), store=key)
+
+    def touch(self, session_id):
+        """Registra actividad de una sesión y arranca el refrescador si no está corriendo."""
+        with self._lock:
+            self._sessions[session_id] = time.time()
+            if self._refresher is None and not self._closed.is_set():
+                self._refresher = threading.Thread(target=self._run_refresher, daemon=True)
+                self._refresher.start()
+
+    def _prune_sessions(self):
+        """Elimina las sesiones inactivas y retorna cuántas siguen vivas. Requiere `self._lock`."""
+        limit = time.time() - self.session_timeout
+        for session_id, last_seen in list(self._sessions.items()):
+            if last_seen < limit:
+                del self._sessions[session_id]
+        return len(self._sessions)
+
+    def _run_refresher(self):
+        """Refresca el snapshot al vencer el TTL mientras quede al menos una sesión viva."""
+        while True:
+            snap = self._snapshot
+            wait = self.ttl - snap.age() if snap is not None else 0
+            if wait > 0 and self._closed.wait(wait):
+                break
+            with self._lock:
+                if self._closed.is_set() or self._prune_sessions() == 0:
+                    self._refresher = None
+                    return
+            snap = self._snapshot
+            if snap is not None and snap.age() < self.ttl:
+                continue
+            try:
+                # Los refrescos de fondo ceden la cuota a las acciones interactivas
+                with quota.priority(quota.BACKGROUND):
+                    self.refresh()
+            except Exception as e:
+                logger.warning("Error en la actualización automática de datos: %s", e)
+                if self._closed.wait(self.ttl):
+                    break
+        with self._lock:
+            self._refresher = None
+
+    def close(self):
+        """Detiene el refrescador (p. ej. al reemplazar el almacén); el snapshot vigente sigue disponible."""
+        self._closed.set()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(key, fetch, columnas, numeric_fields=None, ttl=DEFAULT_TTL, probe=None, cache_path=None, build=None):
+    """Retorna el almacén de snapshot del proceso asociado a `key`, creándolo si no existe."""
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = SnapshotStore(fetch, columnas, numeric_fields, ttl=ttl, probe=probe, cache_path=cache_path,
+                                  build=build)
+            _stores[key] = store
+        return store
+
+
+def close_store(key):
+    """Retira y detiene el almacén asociado a `key`, si existe."""
+    with _stores_lock:
+        store = _stores.pop(key, None)
+    if store is not None:
+        store.close()
+
+
+def _collect_stores():
+    with _stores_lock:
+        stores = list(_stores.values())
+    for number, store in enumerate(stores):
+        store.collect_metrics(str(number))
+
+
+metrics.registry.register_collector(_collect_stores)
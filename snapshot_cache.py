@@ -0,0 +1,108 @@
+"""
+Caché en disco del último snapshot descargado.
+
+Al reiniciar el servidor, la primera sesión no espera a descargar la planilla
+completa: el almacén parte del snapshot guardado en disco (con su hora de
+descarga y su revisión) y lo revalida en segundo plano. Si la revisión de la
+planilla no cambió, la revalidación ni siquiera descarga celdas.
+
+El archivo es una tabla Arrow en formato IPC sin comprimir (Feather v2), que se
+lee con memory-map: las columnas del snapshot y, en los metadatos del esquema,
+la hora de descarga, la revisión y el mapeo de columnas con que se generó (si el
+mapeo cambió, el archivo se descarta). Se escribe en un archivo temporal y se
+reemplaza de forma atómica, así que un proceso que se interrumpe nunca deja un
+archivo a medias. Requiere pyarrow (dependencia de Streamlit); sin él la caché
+queda desactivada.
+"""
+import hashlib
+import json
+import logging
+import os
+
+import metrics
+from table import SheetTable
+
+logger = logging.getLogger(__name__)
+
+# Directorio de la caché (vacío para desactivarla)
+CACHE_DIR = os.environ.get("SHEETS_CACHE_DIR", ".cache")
+# Versión del formato del archivo; los archivos de otra versión se ignoran
+FORMAT_VERSION = 1
+_METADATA_KEY = b"snapshot_cache"
+
+_warned = False
+
+
+def cache_path(spreadsheet_url, directory=None):
+    """Archivo de caché asociado a una planilla (None si la caché está desactivada)."""
+    directory = CACHE_DIR if directory is None else directory
+    if not directory:
+        return None
+    digest = hashlib.sha1(spreadsheet_url.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(directory, f"snapshot-{digest}.arrow")
+
+
+def save(path, table, fetched_at, revision, columnas):
+    """Guarda la tabla con su hora de descarga y revisión. Retorna False si no se pudo."""
+    global _warned
+    try:
+        import pyarrow as pa
+    except ImportError:
+        if not _warned:
+            _warned = True
+            logger.warning("pyarrow no está disponible; la caché del snapshot en disco queda desactivada.")
+        return False
+    try:
+        with metrics.timer("snapshot_cache_seconds", operation="save"):
+            data = pa.Table.from_pandas(table.frame, preserve_index=True)
+            info = {
+                "formato": FORMAT_VERSION,
+                "fetched_at": fetched_at,
+                "revision": revision,
+                "columnas": columnas,
+            }
+            data = data.replace_schema_metadata({
+                **(data.schema.metadata or {}),
+                _METADATA_KEY: json.dumps(info, ensure_ascii=False).encode("utf-8"),
+            })
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, data.schema) as writer:
+                writer.write_table(data)
+            os.replace(tmp, path)
+        return True
+    except Exception as e:
+        logger.warning("No se pudo guardar la caché del snapshot en %s: %s", path, e)
+        return False
+
+
+def load(path, columnas, numeric_fields=None):
+    """
+    Lee la caché y retorna `(tabla, fetched_at, revision)`, o None si no existe, es de
+    otro formato o de otro mapeo de columnas, o no se puede leer.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return None
+    try:
+        with metrics.timer("snapshot_cache_seconds", operation="load"):
+            with pa.memory_map(path, "r") as source:
+                data = pa.ipc.open_file(source).read_all()
+            info = json.loads((data.schema.metadata or {}).get(_METADATA_KEY, b"{}"))
+            if info.get("formato") != FORMAT_VERSION or info.get("columnas") != dict(columnas):
+                logger.info("Se descarta la caché del snapshot %s (formato o columnas distintos).", path)
+                return None
+            frame = data.to_pandas()
+            if list(frame.columns) != list(columnas) or not len(frame):
+                return None
+            table = SheetTable.from_frame(frame, numeric_fields)
+        return table, float(info["fetched_at"]), info.get("revision")
+    except Exception as e:
+        logger.warning("No se pudo leer la caché del snapshot en %s: %s", path, e)
+        return None
+
+
+metrics.registry.describe("snapshot_cache_seconds", "Lectura y escritura de la caché del snapshot en disco.")
@@ -0,0 +1,362 @@
+"""
+Fuentes de datos: varias planillas y hojas unidas en un solo snapshot.
+
+Los datos pueden estar repartidos en pestañas (por región o temporada) y en
+varias planillas. `fuentes.toml` (o el archivo de `SHEETS_SOURCES`) enumera las
+hojas, cada una con su propio mapeo de columnas:
+
+    [[fuente]]
+    nombre = "Maule 2024"
+    planilla = "https://docs.google.com/spreadsheets/d/..."
+    hoja = "Maule"              # opcional; por omisión, la primera hoja
+
+    [fuente.columnas]           # opcional; por omisión, schema.COLUMNAS
+    cuenta_id = "A"             # letra de columna o índice base 0
+    cuenta_nombre = "B"
+
+Sin ese archivo se usa una sola fuente: la planilla de `spreadsheet_url` con el
+mapeo de `schema.COLUMNAS`, y la tabla es la misma de siempre. Los campos que una
+fuente no mapea quedan vacíos en sus filas y no se escriben.
+
+Las hojas se descargan en paralelo en un pool de hilos acotado (cada una pasa
+por el limitador de cuota compartido), de modo que la carga tarda lo que la hoja
+más lenta y no la suma. Una fuente cuya planilla no cambió de revisión reutiliza
+su última descarga. La tabla unificada numera las filas por bloques
+(`table.row_id`): la fila `f` de la fuente `n` es `n * ROW_BLOCK + f`, así que la
+primera fuente conserva sus números de fila; la columna `fuente` indica de qué
+hoja viene cada fila y se puede buscar (`fuente:maule`).
+"""
+import concurrent.futures
+import logging
+import os
+import threading
+import tomllib
+
+import numpy as np
+import pandas as pd
+
+import connection
+import metrics
+import quota
+import schema
+import snapshot
+from table import SheetTable, column_number, compact_column, row_id, split_row_id
+from write_queue import cells_to_ranges
+
+logger = logging.getLogger(__name__)
+
+# Archivo de configuración de las fuentes
+SOURCES_PATH = os.environ.get("SHEETS_SOURCES", "fuentes.toml")
+# Descargas simultáneas como máximo
+MAX_WORKERS = 8
+# Campo que identifica la fuente de cada fila cuando hay más de una
+SOURCE_FIELD = 'fuente'
+
+
+def column_index(value):
+    """Índice de columna (base 0) a partir de una letra ("AF") o de un índice."""
+    if isinstance(value, int):
+        return value
+    return column_number(str(value)) - 1
+
+
+def load_config(path=SOURCES_PATH):
+    """
+    Lee la configuración de fuentes: lista de `{nombre, planilla, hoja, columnas}`,
+    o None si el archivo no existe. Lanza ValueError si la configuración no es válida.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        entries = tomllib.load(f).get("fuente", [])
+    if not entries:
+        raise ValueError(f"{path} no define ninguna [[fuente]].")
+    config, names = [], set()
+    for number, entry in enumerate(entries, 1):
+        if not entry.get("planilla"):
+            raise ValueError(f"La fuente {number} de {path} no indica la planilla.")
+        nombre = str(entry.get("nombre") or entry.get("hoja") or f"Fuente {number}")
+        if nombre in names:
+            raise ValueError(f"Hay dos fuentes llamadas {nombre!r} en {path}.")
+        names.add(nombre)
+        columnas = entry.get("columnas")
+        if columnas is None:
+            columnas = dict(schema.COLUMNAS)
+        else:
+            unknown = sorted(set(columnas) - set(schema.COLUMNAS))
+            if unknown:
+                raise ValueError(f"La fuente {nombre!r} mapea campos desconocidos: {', '.join(unknown)}.")
+            columnas = {field: column_index(columnas[field]) for field in schema.COLUMNAS if field in columnas}
+        config.append({
+            "nombre": nombre,
+            "planilla": entry["planilla"],
+            "hoja": entry.get("hoja"),
+            "columnas": columnas,
+        })
+    return config
+
+
+class Source:
+    """Una hoja de una planilla, con su conexión y su mapeo de columnas."""
+
+    def __init__(self, number, nombre, client, columnas):
+        self.number = number
+        self.nombre = nombre
+        self.client = client
+        self.columnas = columnas
+
+    @property
+    def url(self):
+        return self.client.spreadsheet_url
+
+
+class SourceSet:
+    """Fuentes configuradas: descarga paralela, tabla unificada y reparto de escrituras y lecturas."""
+
+    def __init__(self, sources, numeric_fields=None, max_workers=MAX_WORKERS):
+        self.sources = list(sources)
+        self.numeric_fields = numeric_fields or {}
+        self.multiple = len(self.sources) > 1
+        self.data_fields = list(schema.COLUMNAS)
+        self.fields = self.data_fields + [SOURCE_FIELD] if self.multiple else self.data_fields
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(self.sources))), thread_name_prefix="fuentes"
+        )
+        self._lock = threading.Lock()
+        self._revisions = [None] * len(self.sources)
+        self._fetched = [None] * len(self.sources)
+
+    # --- Identificación ---
+    def layout(self):
+        """
+        Descripción de las columnas de la tabla unificada (el mapeo con que se valida la
+        caché en disco): con una sola fuente, su mapeo; con varias, las columnas de cada campo por fuente.
+        """
+        if not self.multiple:
+            return {field: self.sources[0].columnas.get(field) for field in self.data_fields}
+        layout = {
+            field: {source.nombre: source.columnas[field] for source in self.sources if field in source.columnas}
+            for field in self.data_fields
+        }
+        layout[SOURCE_FIELD] = {source.nombre: source.number for source in self.sources}
+        return layout
+
+    def close(self):
+        """Libera el pool de descarga (al reemplazar las fuentes por un cambio de configuración)."""
+        self._pool.shutdown(wait=False)
+
+    def cache_key(self):
+        """Texto que identifica el conjunto de hojas (para el archivo de caché)."""
+        if not self.multiple:
+            return self.sources[0].url
+        return "\n".join(f"{source.url}#{source.client.worksheet_name or ''}" for source in self.sources)
+
+    def source_of(self, row_number):
+        """Fuente de una fila de la tabla unificada."""
+        return self.sources[split_row_id(row_number)[0]]
+
+    def row_name(self, row_number):
+        """Nombre de una fila para los mensajes: su número en la hoja y, con varias fuentes, la fuente."""
+        number, sheet_row = split_row_id(row_number)
+        if not self.multiple:
+            return str(sheet_row)
+        return f"{sheet_row} ({self.sources[number].nombre})"
+
+    # --- Carga ---
+    def _map(self, fn, items=None):
+        """
+        Aplica `fn` a cada fuente (o a `items`) en el pool y retorna los resultados en
+        orden; los hilos del pool usan la prioridad de cuota del hilo que los invoca.
+        """
+        level, max_wait = quota.current_priority()
+
+        def run(item):
+            with quota.priority(level, max_wait):
+                return fn(item)
+        return list(self._pool.map(run, self.sources if items is None else items))
+
+    def probe(self):
+        """
+        Revisión de las fuentes (una consulta por planilla, en paralelo): con una sola
+        fuente, la de su planilla; con varias, la lista. Falla si alguna consulta falla.
+        """
+        with self._lock:
+            # Si la consulta falla, ninguna fuente reutiliza su descarga anterior
+            self._revisions = [None] * len(self.sources)
+        by_url = {}
+        for source in self.sources:
+            by_url.setdefault(source.url, source)
+        revisions = dict(zip(by_url, self._map(lambda source: source.client.modified_time(), by_url.values())))
+        result = [revisions[source.url] for source in self.sources]
+        with self._lock:
+            self._revisions = list(result)
+        return result if self.multiple else result[0]
+
+    def _fetch_source(self, source):
+        with self._lock:
+            revision = self._revisions[source.number]
+            fetched = self._fetched[source.number]
+        if fetched is not None and revision is not None and fetched[0] == revision:
+            metrics.increment("source_fetches_total", fuente=source.nombre, result="reused")
+            return fetched[1]
+        metrics.increment("source_fetches_total", fuente=source.nombre, result="fetch")
+        with metrics.timer("source_fetch_seconds", fuente=source.nombre):
+            rows = source.client.get_columns(source.columnas.values())
+            table = self._complete(SheetTable.from_rows(rows, source.columnas, self.numeric_fields))
+        if self.multiple:
+            with self._lock:
+                self._fetched[source.number] = (revision, table)
+        return table
+
+    def _complete(self, table):
+        """Agrega como columnas vacías los campos que la fuente no mapea."""
+        missing = [field for field in self.data_fields if field not in table.fields]
+        if not missing:
+            return table
+        frame = table.frame.copy(deep=False)
+        for field in missing:
+            frame[field] = pd.Categorical.from_codes(np.zeros(len(frame), dtype=np.int8), categories=[''])
+        return SheetTable.from_frame(frame[self.data_fields], self.numeric_fields)
+
+    def fetch(self):
+        """Descarga todas las fuentes en paralelo; retorna una tabla por fuente."""
+        return self._map(self._fetch_source)
+
+    def build(self, tables):
+        """Une las tablas de cada fuente en la tabla del snapshot (con una sola fuente, la misma tabla)."""
+        if not self.multiple:
+            return tables[0]
+        index = pd.Index(
+            np.concatenate([table.row_number_array() + row_id(n, 0) for n, table in enumerate(tables)]),
+            name="fila"
+        )
+        columns = {}
+        for field in self.data_fields:
+            parts = [table.frame[field].array for table in tables]
+            if all(isinstance(part, pd.Categorical) for part in parts):
+                columns[field] = pd.api.types.union_categoricals(parts, ignore_order=True)
+            else:
+                columns[field] = compact_column(np.concatenate([np.asarray(part, dtype=object) for part in parts]))
+        columns[SOURCE_FIELD] = pd.Categorical.from_codes(
+            np.repeat(np.arange(len(tables)), [len(table) for table in tables]),
+            categories=[source.nombre for source in self.sources]
+        )
+        frame = pd.DataFrame(columns, index=index)
+        numeric = pd.DataFrame(
+            {
+                field: np.concatenate([table.numeric[field].to_numpy() for table in tables])
+                for field in self.numeric_fields
+            },
+            index=index
+        )
+        return SheetTable(frame, numeric, self.numeric_fields)
+
+    # --- Escritura y lectura de filas ---
+    def route(self, cells):
+        """
+        Reparte celdas `{(fila, campo): valor}` de la tabla unificada entre las hojas:
+        retorna `[(batch_update, rangos, celdas)]`, una petición por fuente (ver `write_queue`).
+        Las celdas de campos que su fuente no mapea no se pueden escribir: van en una
+        petición `(None, error, celdas)` para que la cola las dé por rechazadas.
+        """
+        by_source = {}
+        for (row_number, field), value in cells.items():
+            by_source.setdefault(split_row_id(row_number)[0], {})[(row_number, field)] = value
+        requests = []
+        for number, group in sorted(by_source.items()):
+            source = self.sources[number]
+            mapped, unmapped, sheet_cells = {}, {}, {}
+            for (row_number, field), value in group.items():
+                if field in source.columnas:
+                    mapped[(row_number, field)] = value
+                    sheet_cells[(split_row_id(row_number)[1], field)] = value
+                else:
+                    unmapped[(row_number, field)] = value
+            if mapped:
+                requests.append((source.client.batch_update, cells_to_ranges(sheet_cells, source.columnas), mapped))
+            if unmapped:
+                fields = sorted({field for _, field in unmapped})
+                logger.warning("La fuente %s no tiene las columnas %s; no se escriben.", source.nombre, ", ".join(fields))
+                error = ValueError(f"La hoja {source.nombre} no tiene la columna {', '.join(fields)}.")
+                requests.append((None, error, unmapped))
+        return requests
+
+    def get_row(self, row_number):
+        """Relee una fila desde su hoja (una petición) y retorna `{campo: texto}` con los campos de la tabla."""
+        number, sheet_row = split_row_id(row_number)
+        source = self.sources[number]
+        values = source.client.get_row(sheet_row, source.columnas.values())
+        row = {
+            field: values.get(source.columnas[field], '') if field in source.columnas else ''
+            for field in self.data_fields
+        }
+        if self.multiple:
+            row[SOURCE_FIELD] = source.nombre
+        return row
+
+
+_source_sets = {}
+_source_sets_lock = threading.Lock()
+# Clave de las fuentes vigentes por (cuenta, archivo de configuración)
+_active = {}
+# Configuración leída de cada archivo: path -> (fecha de modificación, configuración, su repr)
+_configs = {}
+
+
+def _file_version(path):
+    """Fecha de modificación del archivo (ns), o None si no existe."""
+    if not path:
+        return None
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_source_set(credentials_info, spreadsheet_url=None, numeric_fields=None, path=SOURCES_PATH):
+    """
+    Retorna las fuentes compartidas del proceso según `path`; sin ese archivo, una
+    sola fuente con la planilla `spreadsheet_url` y el mapeo de `schema.COLUMNAS`.
+    Se llama varias veces por rerun: el archivo solo se vuelve a leer si cambió su
+    fecha de modificación (si su contenido es el mismo, se conservan las fuentes).
+    Si cambió, las fuentes anteriores se detienen: su almacén de snapshot deja de
+    refrescarse y se cierra su pool de descarga.
+    """
+    version = _file_version(path)
+    cached = _configs.get(path)
+    if cached is None or cached[0] != version:
+        config = load_config(path) if version is not None else None
+        cached = _configs[path] = (version, config, repr(config))
+    _, config, config_key = cached
+    if config is None:
+        config = [{"nombre": "Planilla", "planilla": spreadsheet_url, "hoja": None, "columnas": dict(schema.COLUMNAS)}]
+        config_key = ("planilla", spreadsheet_url)
+    key = (credentials_info.get("client_email"), config_key)
+    replaced = None
+    with _source_sets_lock:
+        source_set = _source_sets.get(key)
+        if source_set is None:
+            source_set = SourceSet(
+                [
+                    Source(number, entry["nombre"],
+                           connection.get_connection(credentials_info, entry["planilla"], entry["hoja"]),
+                           entry["columnas"])
+                    for number, entry in enumerate(config)
+                ],
+                numeric_fields
+            )
+            _source_sets[key] = source_set
+        slot = (credentials_info.get("client_email"), path)
+        previous, _active[slot] = _active.get(slot), key
+        if previous is not None and previous != key:
+            replaced = _source_sets.pop(previous, None)
+    if replaced is not None:
+        # La configuración cambió: el almacén y el pool de las fuentes anteriores no se vuelven a usar
+        logger.info("La configuración de fuentes cambió; se detienen las fuentes anteriores.")
+        snapshot.close_store(replaced)
+        replaced.close()
+    return source_set
+
+
+metrics.registry.describe("source_fetch_seconds", "Descarga de cada fuente (hoja) del snapshot.")
+metrics.registry.describe("source_fetches_total", "Descargas por fuente: fetch, o reused si su planilla no cambió de revisión.")
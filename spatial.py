@@ -0,0 +1,222 @@
+"""
+Índice espacial de las coordenadas de las sondas.
+
+Las coordenadas en grados decimales (`latitud_sonda`/`longitud_sonda`, que el
+snapshot interpreta una sola vez al cargar) se ubican en una grilla de celdas de
+CELL_M metros ordenada por celda. Las celdas de una misma columna de la grilla
+quedan contiguas, así que buscar las sondas a menos de X metros de un punto es
+una búsqueda binaria por columna de celdas más la distancia exacta (haversine)
+de los candidatos, sin recorrer la planilla.
+
+La revisión de toda la planilla es vectorizada y no compara todos los pares:
+
+- Duplicados: sondas distintas a menos de DUPLICATE_M metros entre sí (p. ej. el
+  mismo punto copiado en dos sondas). Se comparan solo los puntos de celdas
+  vecinas de una grilla del tamaño de la tolerancia.
+- Fuera de su campo: sondas a más de OUTLIER_M metros de la mediana de las
+  coordenadas de su campo (solo en campos con al menos MIN_CAMPO_SONDAS sondas
+  ubicadas), típicamente un error al tipear la ubicación.
+
+Como los demás índices, se comparte entre sesiones y se sincroniza por versión
+del snapshot. Los guardados que no tocan coordenadas no reconstruyen la grilla.
+"""
+import math
+import threading
+
+import numpy as np
+import pandas as pd
+
+import metrics
+
+EARTH_RADIUS_M = 6_371_000
+# Metros por grado de latitud
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+# Lado de las celdas de la grilla de búsqueda
+CELL_M = 500
+# Distancia bajo la cual dos sondas se consideran en el mismo punto
+DUPLICATE_M = 5
+# Distancia a la mediana de su campo sobre la cual una sonda se considera fuera de él
+OUTLIER_M = 5000
+# Sondas ubicadas que necesita un campo para estimar su centro
+MIN_CAMPO_SONDAS = 3
+# Columnas de la grilla por fila de celdas (claves de celda `columna * _SPAN + fila`)
+_SPAN = 1 << 32
+
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """Distancia en metros sobre la superficie terrestre (haversine); admite arreglos."""
+    lat1, lon1, lat2, lon2 = (np.radians(value) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _grid(lat, lon, cell_m):
+    """
+    Tamaño de celda en grados `(latitud, longitud)` y celda `(columna, fila)` de cada
+    punto. Las celdas miden al menos `cell_m` en ambos sentidos en todos los puntos.
+    """
+    cell_lat = cell_m / METERS_PER_DEGREE
+    max_lat = min(float(np.max(np.abs(lat))) if len(lat) else 0.0, 89.0)
+    cell_lon = cell_lat / math.cos(math.radians(max_lat))
+    return (cell_lat, cell_lon), np.floor(lon / cell_lon).astype(np.int64), np.floor(lat / cell_lat).astype(np.int64)
+
+
+def coordinates(table):
+    """Números de fila, latitud y longitud de las filas con coordenadas válidas."""
+    lat = table.numeric['latitud_sonda'].to_numpy()
+    lon = table.numeric['longitud_sonda'].to_numpy()
+    valid = ~np.isnan(lat) & ~np.isnan(lon) & (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+    return table.row_number_array()[valid], lat[valid], lon[valid]
+
+
+def close_pairs(lat, lon, tolerance_m):
+    """
+    Pares de posiciones `(i, j)` con i < j a menos de `tolerance_m` metros y su distancia.
+    Solo compara puntos de celdas vecinas de una grilla del tamaño de la tolerancia.
+    """
+    _, columns, rows = _grid(lat, lon, tolerance_m)
+    cells = pd.DataFrame({'columna': columns, 'fila': rows, 'i': np.arange(len(lat))})
+    pairs = []
+    # Media vecindad (la celda, derecha, arriba y las dos diagonales superiores): cada par se ve una vez
+    for d_column, d_row in ((0, 0), (1, 0), (0, 1), (1, 1), (1, -1)):
+        neighbours = cells.assign(columna=cells['columna'] - d_column, fila=cells['fila'] - d_row)
+        joined = cells.merge(neighbours, on=['columna', 'fila'], suffixes=('', '_j'))
+        if (d_column, d_row) == (0, 0):
+            joined = joined[joined['i'] < joined['i_j']]
+        pairs.append(joined[['i', 'i_j']].to_numpy())
+    pairs = np.concatenate(pairs) if pairs else np.empty((0, 2), dtype=np.int64)
+    first, second = np.minimum(pairs[:, 0], pairs[:, 1]), np.maximum(pairs[:, 0], pairs[:, 1])
+    distances = distance_m(lat[first], lon[first], lat[second], lon[second])
+    close = distances <= tolerance_m
+    return first[close], second[close], distances[close]
+
+
+class SpatialIndex:
+    """Grilla de las coordenadas del snapshot, sincronizada por versión."""
+
+    def __init__(self, cell_m=CELL_M):
+        self._lock = threading.Lock()
+        self.cell_m = cell_m
+        self.version = None
+        self._table = None
+        self._row_numbers = np.empty(0, dtype=np.int64)
+        self._lat = np.empty(0)
+        self._lon = np.empty(0)
+        self._keys = np.empty(0, dtype=np.int64)
+        self._cell = (0.0, 0.0)
+        self._positions = {}
+        self._views = {}
+
+    def sync(self, snap):
+        """Pone el índice al día con el snapshot; si las filas que cambiaron conservan sus coordenadas, no lo reconstruye."""
+        with self._lock:
+            if self.version is not None and snap.version <= self.version:
+                return
+            table = snap.table
+            changed = snap.changes_since(self.version)
+            if changed is not None and self._same_coordinates(table, changed):
+                metrics.increment("spatial_index_syncs_total", mode="sin_cambios")
+            else:
+                metrics.increment("spatial_index_syncs_total", mode="full")
+                with metrics.timer("spatial_index_build_seconds"):
+                    self._build(table)
+            self._views = {}
+            self._table = table
+            self.version = snap.version
+
+    def _same_coordinates(self, table, changed_rows):
+        changed = [row_number for row_number in changed_rows if row_number in table]
+        if len(changed) != len(changed_rows):
+            return False
+        row_numbers, lat, lon = coordinates(table.take(changed))
+        if set(row_numbers.tolist()) != {row_number for row_number in changed if row_number in self._positions}:
+            return False
+        positions = [self._positions[row_number] for row_number in row_numbers.tolist()]
+        return bool(np.array_equal(self._lat[positions], lat) and np.array_equal(self._lon[positions], lon))
+
+    def _build(self, table):
+        row_numbers, lat, lon = coordinates(table)
+        self._cell, columns, rows = _grid(lat, lon, self.cell_m)
+        keys = columns * _SPAN + rows
+        order = np.argsort(keys, kind="stable")
+        self._row_numbers, self._lat, self._lon, self._keys = row_numbers[order], lat[order], lon[order], keys[order]
+        self._positions = dict(zip(self._row_numbers.tolist(), range(len(order))))
+
+    def __len__(self):
+        return len(self._row_numbers)
+
+    def location(self, row_number):
+        """Coordenadas `(latitud, longitud)` de la fila, o None si no tiene."""
+        position = self._positions.get(row_number)
+        return None if position is None else (float(self._lat[position]), float(self._lon[position]))
+
+    def near(self, lat, lon, radius_m):
+        """Filas a menos de `radius_m` metros del punto: lista de `(fila, distancia)` ordenada por distancia."""
+        with self._lock:
+            if not len(self._keys):
+                return []
+            cell_lat, cell_lon = self._cell
+            d_lat = radius_m / METERS_PER_DEGREE
+            d_lon = d_lat / max(math.cos(math.radians(min(abs(lat) + d_lat, 89.0))), 1e-6)
+            first_row = math.floor((lat - d_lat) / cell_lat)
+            last_row = math.floor((lat + d_lat) / cell_lat)
+            # Por cada columna de celdas, las filas de celdas del rango son claves contiguas
+            candidates = []
+            for column in range(math.floor((lon - d_lon) / cell_lon), math.floor((lon + d_lon) / cell_lon) + 1):
+                start = np.searchsorted(self._keys, column * _SPAN + first_row, side="left")
+                end = np.searchsorted(self._keys, column * _SPAN + last_row, side="right")
+                if start < end:
+                    candidates.append(np.arange(start, end))
+            if not candidates:
+                return []
+            candidates = np.concatenate(candidates)
+            distances = distance_m(lat, lon, self._lat[candidates], self._lon[candidates])
+            inside = distances <= radius_m
+            order = np.argsort(distances[inside], kind="stable")
+            return list(zip(self._row_numbers[candidates[inside]][order].tolist(), distances[inside][order].tolist()))
+
+    def neighbours(self, row_number, radius_m):
+        """Otras filas a menos de `radius_m` metros de la fila indicada (vacío si no tiene coordenadas)."""
+        location = self.location(row_number)
+        if location is None:
+            return []
+        return [(other, distance) for other, distance in self.near(*location, radius_m) if other != row_number]
+
+    def _view(self, key, compute):
+        with self._lock:
+            view = self._views.get(key)
+            if view is None:
+                view = self._views[key] = compute()
+            return view
+
+    def duplicates(self, tolerance_m=DUPLICATE_M):
+        """
+        Pares de sondas distintas a menos de `tolerance_m` metros: DataFrame con
+        `fila`, `fila_2` y `distancia_m`, ordenado por fila.
+        """
+        def compute():
+            first, second, distances = close_pairs(self._lat, self._lon, tolerance_m)
+            rows = np.sort(np.stack([self._row_numbers[first], self._row_numbers[second]], axis=1), axis=1)
+            pairs = pd.DataFrame({'fila': rows[:, 0], 'fila_2': rows[:, 1], 'distancia_m': distances})
+            return pairs.sort_values(['fila', 'fila_2'], ignore_index=True)
+        return self._view(("duplicados", tolerance_m), compute)
+
+    def outliers(self, campo_field='campo_id', threshold_m=OUTLIER_M, min_sondas=MIN_CAMPO_SONDAS):
+        """
+        Sondas a más de `threshold_m` metros de la mediana de las coordenadas de su
+        campo: DataFrame con `fila`, `campo` y `distancia_m`, de mayor a menor distancia.
+        """
+        def compute():
+            campos = self._table.take(self._row_numbers.tolist()).frame[campo_field].astype(str).to_numpy()
+            points = pd.DataFrame({'fila': self._row_numbers, 'campo': campos, 'lat': self._lat, 'lon': self._lon})
+            groups = points.groupby('campo', sort=False)
+            sizes = groups['fila'].transform('size').to_numpy()
+            center_lat = groups['lat'].transform('median').to_numpy()
+            center_lon = groups['lon'].transform('median').to_numpy()
+            points['distancia_m'] = distance_m(points['lat'].to_numpy(), points['lon'].to_numpy(), center_lat, center_lon)
+            far = points[(sizes >= min_sondas) & (points['distancia_m'].to_numpy() > threshold_m)]
+            return far[['fila', 'campo', 'distancia_m']].sort_values('distancia_m', ascending=False, ignore_index=True)
+        return self._view(("fuera_de_campo", campo_field, threshold_m, min_sondas), compute)
+
+
+metrics.registry.describe("spatial_index_build_seconds", "Construcción de la grilla de coordenadas de las sondas.")
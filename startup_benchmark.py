@@ -0,0 +1,198 @@
+"""
+Benchmark del arranque de la aplicación (cada medición en un proceso nuevo).
+
+Mide lo que paga un servidor recién iniciado antes de mostrar la primera pantalla:
+
+- importacion_modulos: importar los módulos que importa `code.py` (leídos de su
+  código), e informa cuáles de los módulos pesados que solo hacen falta para hablar
+  con la API (HEAVY_MODULES) quedaron cargados.
+- primer_render_desde_cache: primera ejecución de `code.py` (con el probador de
+  Streamlit y la planilla falsa de `load_test`) cuando existe la copia del
+  snapshot en disco; no debería depender de la latencia de la planilla.
+- primer_render_sin_cache: lo mismo sin copia en disco (descarga la planilla).
+- rerun: la ejecución siguiente de la misma sesión.
+
+Como `benchmark.py`, escribe los resultados en JSON y con `--baseline` los compara
+con una ejecución anterior (código de salida 1 si alguna etapa empeoró).
+
+    python startup_benchmark.py --repeat 5 --rows 10000 --latency 0.3
+    python startup_benchmark.py --baseline arranque.json
+"""
+import argparse
+import ast
+import importlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code.py")
+DEFAULT_REPEAT = 5
+DEFAULT_ROWS = 10000
+DEFAULT_LATENCY = 0.3
+# Módulos que solo hacen falta para llamar a la API; no deberían cargarse para mostrar la primera pantalla
+HEAVY_MODULES = ["gspread", "google.auth", "requests"]
+# Segundos máximos que se espera a que la primera ejecución deje la copia del snapshot en disco
+CACHE_WAIT = 30
+STAGES = ["importacion_modulos", "primer_render_desde_cache", "primer_render_sin_cache", "rerun"]
+
+
+def app_imports(path=APP_PATH):
+    """Módulos que importa el script en su nivel superior, en orden."""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+
+# --- Mediciones (se ejecutan en el proceso hijo) ---
+def measure_imports():
+    start = time.perf_counter()
+    for module in app_imports():
+        importlib.import_module(module)
+    elapsed = time.perf_counter() - start
+    return {"segundos": elapsed, "modulos_pesados": [name for name in HEAVY_MODULES if name in sys.modules]}
+
+
+def _app(n_rows, latency):
+    import load_test
+    from streamlit.testing.v1 import AppTest
+    load_test.install_backend(n_rows, latency)
+    return AppTest.from_file(APP_PATH, default_timeout=load_test.RERUN_TIMEOUT)
+
+
+def measure_first_render(n_rows, latency):
+    app = _app(n_rows, latency)
+    start = time.perf_counter()
+    app.run()
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    app.run()
+    rerun = time.perf_counter() - start
+    if app.exception:
+        raise RuntimeError(app.exception[0].message)
+    return {"segundos": first, "rerun_segundos": rerun}
+
+
+def prepare_cache(n_rows):
+    """Ejecuta la aplicación una vez y espera a que guarde la copia del snapshot en disco."""
+    import load_test
+    import snapshot_cache
+    path = snapshot_cache.cache_path(load_test.SPREADSHEET_URL)
+    _app(n_rows, 0.0).run()
+    deadline = time.monotonic() + CACHE_WAIT
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise RuntimeError("La aplicación no guardó la copia del snapshot en disco (¿falta pyarrow?).")
+        time.sleep(0.1)
+    return {"archivo": path}
+
+
+def child(args):
+    if args.child == "importacion_modulos":
+        result = measure_imports()
+    elif args.child == "preparar_cache":
+        result = prepare_cache(args.rows)
+    else:
+        result = measure_first_render(args.rows, args.latency)
+    print(json.dumps(result))
+    return 0
+
+
+# --- Proceso principal ---
+def run_child(stage, n_rows, latency, cache_dir):
+    """Ejecuta una medición en un proceso nuevo y retorna su resultado."""
+    env = dict(os.environ, SHEETS_CACHE_DIR=cache_dir, SHEETS_JOURNAL_DIR="", SHEETS_SOURCES="")
+    command = [sys.executable, os.path.abspath(__file__), "--child", stage,
+               "--rows", str(n_rows), "--latency", str(latency)]
+    output = subprocess.run(command, env=env, capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(APP_PATH)).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_startup_benchmark(repeat=DEFAULT_REPEAT, n_rows=DEFAULT_ROWS, latency=DEFAULT_LATENCY, log=print):
+    """Mide cada etapa `repeat` veces y retorna la lista de resultados (mismo formato que `benchmark.py`)."""
+    with tempfile.TemporaryDirectory(prefix="arranque-") as cache_dir:
+        run_child("preparar_cache", n_rows, 0.0, cache_dir)
+        times = {stage: [] for stage in STAGES}
+        heavy = []
+        for _ in range(repeat):
+            imports = run_child("importacion_modulos", n_rows, latency, "")
+            times["importacion_modulos"].append(imports["segundos"])
+            heavy = imports["modulos_pesados"]
+            cached = run_child("primer_render_desde_cache", n_rows, latency, cache_dir)
+            times["primer_render_desde_cache"].append(cached["segundos"])
+            times["rerun"].append(cached["rerun_segundos"])
+            times["primer_render_sin_cache"].append(run_child("primer_render_sin_cache", n_rows, latency, "")["segundos"])
+    results = []
+    for stage in STAGES:
+        result = {
+            "filas": n_rows,
+            "etapa": stage,
+            "mediana_s": round(statistics.median(times[stage]), 6),
+            "minimo_s": round(min(times[stage]), 6),
+            "repeticiones": repeat,
+        }
+        if stage == "importacion_modulos":
+            result["modulos_pesados"] = heavy
+        results.append(result)
+        log(f"{stage:<26} {result['mediana_s'] * 1000:10.1f} ms"
+            + (f"  cargados: {', '.join(heavy) or 'ninguno'}" if stage == "importacion_modulos" else ""))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del arranque de la aplicación.")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="procesos por etapa")
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help="filas de la planilla falsa")
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY,
+                        help="latencia simulada por llamada a la API (s)")
+    parser.add_argument("--output", help="archivo JSON de resultados (por omisión, salida estándar)")
+    parser.add_argument("--baseline", help="resultados anteriores con los que comparar")
+    parser.add_argument("--tolerance", type=float, help="empeoramiento relativo tolerado (el de benchmark.py)")
+    parser.add_argument("--child", choices=STAGES[:3] + ["preparar_cache"], help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        return child(args)
+    # Solo en el proceso principal: benchmark importa la planilla falsa y con ella gspread
+    import benchmark
+
+    results = run_startup_benchmark(args.repeat, args.rows, args.latency, log=lambda m: print(m, file=sys.stderr))
+    report = {
+        "entorno": {
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "filas": args.rows,
+            "latencia_s": args.latency,
+            "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "resultados": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = benchmark.compare(results, json.load(f), args.tolerance or benchmark.TOLERANCE)
+        for n_rows, stage, previous, now in regressions:
+            print(f"Regresión: {stage} pasó de {previous * 1000:.1f} ms a {now * 1000:.1f} ms", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
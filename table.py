@@ -0,0 +1,288 @@
+"""
+Representación columnar del snapshot.
+
+En lugar de una lista de filas con un objeto `str` por celda, el snapshot guarda
+solo los campos de COLUMNAS, una columna por campo: categórica cuando los valores
+se repiten (cuenta, campo, cultivo, variedad...) y arreglo de objetos cuando son
+mayoritariamente únicos. Los campos numéricos se interpretan una sola vez al
+cargar y quedan como arreglos `float64` (NaN si la celda está vacía o no es un
+número). La tabla es de solo lectura y se comparte entre todas las sesiones.
+
+El índice es el número de fila: contiguo cuando la tabla proviene de una sola
+hoja y, cuando une varias fuentes (`sources`), con un bloque de números por fuente.
+"""
+import hashlib
+import math
+
+import numpy as np
+import pandas as pd
+
+# Proporción máxima de valores distintos para guardar una columna como categórica
+CATEGORICAL_RATIO = 0.5
+# Números de fila reservados por fuente en una tabla que une varias hojas: la fila
+# `f` de la fuente `n` es `n * ROW_BLOCK + f` (una hoja admite menos de 10 millones de filas)
+ROW_BLOCK = 10_000_000
+
+
+def row_id(source_number, sheet_row):
+    """Número de fila en la tabla unificada de la fila `sheet_row` de la fuente `source_number`."""
+    return source_number * ROW_BLOCK + sheet_row
+
+
+def split_row_id(row_number):
+    """Retorna `(fuente, fila en su hoja)` de un número de fila de la tabla unificada."""
+    return divmod(row_number, ROW_BLOCK)
+
+
+def column_letters(col):
+    """Letras de una columna (base 1), p. ej. 32 -> 'AF'."""
+    letters = ""
+    while col > 0:
+        col, rest = divmod(col - 1, 26)
+        letters = chr(ord("A") + rest) + letters
+    return letters
+
+
+def a1(row, col):
+    """Referencia A1 de una celda (fila y columna base 1), p. ej. (2, 32) -> 'AF2'."""
+    return f"{column_letters(col)}{row}"
+
+
+def column_number(letters):
+    """Número de columna (base 1) a partir de sus letras, p. ej. 'AF' -> 32."""
+    col = 0
+    for letter in letters.strip().upper():
+        if not "A" <= letter <= "Z":
+            raise ValueError(f"Columna inválida: {letters!r}")
+        col = col * 26 + ord(letter) - ord("A") + 1
+    if not col:
+        raise ValueError(f"Columna inválida: {letters!r}")
+    return col
+
+
+def parse_number(value, decimal_comma=True):
+    """
+    Interpreta un número de la planilla: quita la comilla inicial y trata la coma
+    como separador decimal (o de miles si `decimal_comma` es False). NaN si no es numérico.
+    """
+    text = str(value).strip().lstrip("'")
+    text = text.replace(",", ".") if decimal_comma else text.replace(",", "")
+    if not text:
+        return math.nan
+    try:
+        return float(text)
+    except ValueError:
+        return math.nan
+
+
+def format_cell(value):
+    """
+    Texto con el que la planilla mostrará un valor escrito por la aplicación
+    (coma decimal, enteros sin decimales); se usa para reflejar localmente las
+    escrituras antes de que la planilla las confirme.
+    """
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return repr(value).replace(".", ",")
+    return str(value)
+
+
+def row_fingerprint(row, fields):
+    """
+    Huella de los textos de una fila `{campo: texto}` en los campos indicados: cambia
+    si cambia cualquiera de ellos. Sirve para saber si alguien modificó la fila en la
+    planilla sin comparar campo por campo.
+    """
+    text = "\x1f".join('' if row.get(field) is None else str(row.get(field)) for field in fields)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def compact_column(values):
+    """Columna de texto compacta: categórica si hay muchos valores repetidos, de objetos si no."""
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    if len(uniques) <= CATEGORICAL_RATIO * max(len(values), 1):
+        return pd.Categorical.from_codes(codes, categories=pd.Index(uniques, dtype=object))
+    return np.asarray(values, dtype=object)
+
+
+def _parse_column(column, decimal_comma):
+    """Interpreta una columna numérica evaluando cada valor distinto una sola vez."""
+    codes, uniques = pd.factorize(column)
+    parsed = np.array([parse_number(u, decimal_comma) for u in uniques] + [math.nan], dtype=np.float64)
+    return parsed[codes]
+
+
+class SheetTable:
+    """Tabla columnar de solo lectura con los campos de COLUMNAS, indexada por número de fila."""
+
+    def __init__(self, frame, numeric, numeric_fields=None):
+        self.frame = frame
+        self.numeric = numeric
+        self.numeric_fields = numeric_fields or {}
+        self.fields = list(frame.columns)
+        self.first_row = int(frame.index[0]) if len(frame) else 2
+        index = frame.index
+        self.contiguous = isinstance(index, pd.RangeIndex) and index.step == 1 or len(index) <= 1
+        self._positions = None
+        self._arrays = {field: frame[field].array for field in self.fields}
+
+    @classmethod
+    def from_rows(cls, rows, columnas, numeric_fields=None, first_row=2):
+        """
+        Construye la tabla a partir de filas con el formato de `get_all_values()`,
+        omitiendo las filas anteriores a `first_row` (encabezados).
+        """
+        data_rows = rows[first_row - 1:]
+        index = pd.RangeIndex(first_row, first_row + len(data_rows), name="fila")
+        columns = {}
+        for field, col_idx in columnas.items():
+            values = [row[col_idx] if len(row) > col_idx else '' for row in data_rows]
+            columns[field] = compact_column(values)
+        return cls.from_frame(pd.DataFrame(columns, index=index), numeric_fields)
+
+    @classmethod
+    def from_frame(cls, frame, numeric_fields=None):
+        """Construye la tabla a partir de las columnas de texto ya compactadas (p. ej. leídas de la caché en disco)."""
+        numeric = pd.DataFrame(
+            {
+                field: _parse_column(frame[field], decimal_comma)
+                for field, decimal_comma in (numeric_fields or {}).items() if field in frame.columns
+            },
+            index=frame.index
+        )
+        return cls(frame, numeric, numeric_fields)
+
+    def __len__(self):
+        return len(self.frame)
+
+    def _lookup(self):
+        """Posición de cada número de fila cuando el índice no es contiguo (se arma una sola vez)."""
+        if self._positions is None:
+            self._positions = {row_number: position for position, row_number in enumerate(self.frame.index.tolist())}
+        return self._positions
+
+    def position(self, row_number):
+        """Posición (base 0) de una fila en las columnas."""
+        if self.contiguous:
+            return row_number - self.first_row
+        return self._lookup()[row_number]
+
+    def row_numbers(self):
+        """Números de fila de la tabla, en orden."""
+        if self.contiguous:
+            return range(self.first_row, self.first_row + len(self))
+        return list(self._lookup())
+
+    def row_number_array(self):
+        """Números de fila como arreglo, alineado con las columnas (para operaciones vectorizadas)."""
+        return self.frame.index.to_numpy()
+
+    def __contains__(self, row_number):
+        if self.contiguous:
+            return self.first_row <= row_number < self.first_row + len(self)
+        return row_number in self._lookup()
+
+    def row(self, row_number):
+        """Valores de texto de una fila como diccionario {campo: valor}, en O(1)."""
+        position = self.position(row_number)
+        return {field: array[position] for field, array in self._arrays.items()}
+
+    def fingerprint(self, row_number):
+        """Huella de los textos de una fila (ver `row_fingerprint`)."""
+        return row_fingerprint(self.row(row_number), self.fields)
+
+    def value(self, row_number, field):
+        """Valor de texto de una celda."""
+        return self._arrays[field][self.position(row_number)]
+
+    def number(self, row_number, field):
+        """Valor numérico ya interpretado de una celda (NaN si no es un número)."""
+        return self.numeric[field].iat[self.position(row_number)]
+
+    def take(self, row_numbers):
+        """Tabla nueva con solo las filas indicadas (p. ej. para recalcular algo sobre las filas que cambiaron)."""
+        positions = [self.position(row_number) for row_number in row_numbers]
+        return SheetTable(self.frame.iloc[positions], self.numeric.iloc[positions], self.numeric_fields)
+
+    def with_values(self, cells):
+        """
+        Retorna una tabla nueva con las celdas `{(fila, campo): texto}` reemplazadas;
+        la tabla original no se modifica. Las celdas fuera de la tabla se ignoran.
+        """
+        by_field = {}
+        for (row_number, field), value in cells.items():
+            if row_number in self and field in self._arrays:
+                by_field.setdefault(field, {})[self.position(row_number)] = value
+        if not by_field:
+            return self
+
+        columns = {}
+        for field in self.fields:
+            array = self._arrays[field]
+            updates = by_field.get(field)
+            if updates is None:
+                columns[field] = array
+                continue
+            positions = list(updates)
+            values = list(updates.values())
+            if isinstance(array, pd.Categorical):
+                missing = [v for v in dict.fromkeys(values) if v not in array.categories]
+                array = array.add_categories(missing) if missing else array.copy()
+            else:
+                array = np.array(array, dtype=object)
+            array[positions] = values
+            columns[field] = array
+        frame = pd.DataFrame(columns, index=self.frame.index)
+
+        numeric = self.numeric
+        numeric_updates = [field for field in by_field if field in self.numeric_fields]
+        if numeric_updates:
+            numeric = numeric.copy()
+            for field in numeric_updates:
+                decimal_comma = self.numeric_fields[field]
+                parsed = numeric[field].to_numpy(copy=True)
+                for position, value in by_field[field].items():
+                    parsed[position] = parse_number(value, decimal_comma)
+                numeric[field] = parsed
+        table = SheetTable(frame, numeric, self.numeric_fields)
+        table._positions = self._positions
+        return table
+
+    def diff(self, previous):
+        """Números de fila cuyo contenido difiere respecto de otra tabla (incluye filas agregadas o eliminadas)."""
+        if not (self.contiguous and previous.contiguous and self.first_row == previous.first_row):
+            return self._diff_by_index(previous)
+        common = min(len(self), len(previous))
+        mask = np.zeros(common, dtype=bool)
+        for field in self.fields:
+            current = np.asarray(self._arrays[field][:common], dtype=object)
+            if field not in previous._arrays:
+                mask[:] = True
+                break
+            before = np.asarray(previous._arrays[field][:common], dtype=object)
+            mask |= current != before
+        changed = {self.first_row + int(i) for i in np.flatnonzero(mask)}
+        changed.update(range(self.first_row + common, self.first_row + max(len(self), len(previous))))
+        return frozenset(changed)
+
+    def _diff_by_index(self, previous):
+        """`diff` para índices no contiguos: compara las filas comunes por número de fila."""
+        index, before_index = self.frame.index, previous.frame.index
+        common = index.intersection(before_index)
+        mine, theirs = index.get_indexer(common), before_index.get_indexer(common)
+        mask = np.zeros(len(common), dtype=bool)
+        for field in self.fields:
+            if field not in previous._arrays:
+                mask[:] = True
+                break
+            current = np.asarray(self._arrays[field], dtype=object)[mine]
+            before = np.asarray(previous._arrays[field], dtype=object)[theirs]
+            mask |= current != before
+        changed = set(common[mask].tolist())
+        changed.update(index.symmetric_difference(before_index).tolist())
+        return frozenset(int(row_number) for row_number in changed)
+
+    def memory_usage(self):
+        """Bytes ocupados por la tabla (texto y números), contando el contenido de las cadenas."""
+        return int(self.frame.memory_usage(deep=True).sum() + self.numeric.memory_usage(deep=True).sum())
@@ -0,0 +1,59 @@
+"""
+Pruebas del diario local de escrituras al reabrirlo (como tras reiniciar el servidor).
+
+    python -m unittest test_journal
+"""
+import os
+import tempfile
+import unittest
+
+from journal import Journal
+
+
+class JournalRestartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "diario.jsonl")
+
+    def reopen(self, journal):
+        if journal._file is not None:
+            journal._file.close()
+        return Journal(self.path)
+
+    def test_partial_acknowledge_survives_restart(self):
+        journal = Journal(self.path)
+        first = journal.append({(5, "cultivo"): "viejo", (5, "variedad"): "A"})
+        second = journal.append({(5, "cultivo"): "nuevo"})
+        journal.sync()
+        journal.acknowledge({(5, "cultivo"): second})
+
+        reopened = self.reopen(journal)
+        # La celda confirmada no se reenvía con el valor reemplazado; la otra sigue pendiente
+        self.assertEqual(reopened.pending(), {(5, "variedad"): ("A", first)})
+        self.assertEqual(reopened.pending_entries(), 1)
+
+    def test_acknowledge_completing_entries_survives_restart(self):
+        journal = Journal(self.path)
+        first = journal.append({(5, "cultivo"): "viejo"})
+        second = journal.append({(5, "cultivo"): "nuevo"})
+        journal.sync()
+        journal.acknowledge({(5, "cultivo"): second})
+
+        reopened = self.reopen(journal)
+        self.assertEqual(reopened.pending(), {})
+        self.assertGreater(reopened._next_id, max(first, second))
+
+    def test_unacknowledged_entries_replay_last_value(self):
+        journal = Journal(self.path)
+        journal.append({(5, "cultivo"): "viejo", (5, "variedad"): "A"})
+        second = journal.append({(5, "cultivo"): "nuevo"})
+        journal.sync()
+
+        reopened = self.reopen(journal)
+        self.assertEqual(reopened.pending()[(5, "cultivo")], ("nuevo", second))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,386 @@
+"""
+Cola de escritura diferida (write-behind) hacia Google Sheets.
+
+Guardar una fila ya no espera a la red: las celdas se aplican de inmediato sobre
+el snapshot compartido (lectura de lo escrito) y se encolan. Un único hilo por
+proceso espera una ventana corta, combina las escrituras pendientes de todas las
+sesiones (la última escritura de cada celda gana) y las envía en un solo
+`batch_update`, dividido en bloques si supera el límite de rangos por petición
+(las celdas contiguas de una fila viajan como un solo rango).
+Los errores se reintentan con espera exponencial y, si persisten, quedan
+registrados por fila para mostrarlos en la interfaz.
+
+Cuando el snapshot une varias hojas (`sources`), `route` reparte cada bloque entre
+ellas: cada hoja recibe su propio `batch_update` y confirma o falla por separado.
+Las celdas que una hoja no puede recibir (un campo sin columna en ella) fallan
+sin enviarse.
+
+Los errores permanentes (p. ej. un rango inválido o sin permiso) no se reintentan:
+la escritura se da por fallida de inmediato.
+
+Con un diario local (`journal`), cada escritura queda en disco antes de enviarse y
+una escritura que agota los reintentos por un error transitorio (red, cuota o
+servidor) no se descarta: se conserva en el snapshot local y se vuelve a intentar
+una vez cada REPLAY_INTERVAL segundos, o apenas otro envío tenga éxito, hasta que
+la planilla la confirme. Las rechazadas con un error permanente quedan anotadas
+en el diario para que no se reenvíen. Al crear la cola se reenvía lo
+que el diario tenga sin confirmar (p. ej. de antes de reiniciar el servidor).
+"""
+import logging
+import random
+import threading
+import time
+
+import metrics
+import quota
+from table import a1, format_cell
+
+logger = logging.getLogger(__name__)
+
+# Segundos que se esperan para agrupar escrituras antes de enviarlas
+FLUSH_INTERVAL = 1.0
+# Rangos máximos por petición `batch_update`
+MAX_RANGES_PER_REQUEST = 500
+# Reintentos antes de dar una escritura por fallida
+MAX_RETRIES = 5
+# Espera base y máxima (segundos) entre reintentos
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 60.0
+# Segundos entre reenvíos de las escrituras que agotaron los reintentos (con diario)
+REPLAY_INTERVAL = 60.0
+
+PENDING = "pendiente"
+RETRYING = "reintentando"
+FAILED = "error"
+JOURNALED = "en diario"
+
+
+def _range_data(row_number, first_col, values):
+    start = a1(row_number, first_col + 1)
+    if len(values) > 1:
+        start += ":" + a1(row_number, first_col + len(values))
+    return {"range": start, "values": [values]}
+
+
+def cells_to_ranges(cells, columnas):
+    """
+    Agrupa celdas `{(fila, campo): valor}` en rangos para `batch_update`: las celdas
+    de una misma fila en columnas consecutivas se envían como un solo rango.
+    """
+    by_row = {}
+    for (row_number, field), value in cells.items():
+        by_row.setdefault(row_number, {})[columnas[field]] = value
+    data = []
+    for row_number, by_col in by_row.items():
+        run = []
+        for col in sorted(by_col):
+            if run and col != run[0] + len(run):
+                data.append(_range_data(row_number, run[0], [by_col[c] for c in run]))
+                run = []
+            run.append(col)
+        data.append(_range_data(row_number, run[0], [by_col[c] for c in run]))
+    return data
+
+
+class RowStatus:
+    """Estado de guardado de una fila."""
+
+    __slots__ = ("state", "message", "updated_at")
+
+    def __init__(self, state, message=""):
+        self.state = state
+        self.message = message
+        self.updated_at = time.time()
+
+
+def is_transient(error):
+    """Indica si vale la pena reintentar una escritura: cuota, servidor, red (`quota.is_retryable`) o E/S local."""
+    return isinstance(error, OSError) or quota.is_retryable(error)
+
+
+def backoff_delay(attempt):
+    """Espera exponencial con jitter para el intento indicado (1, 2, ...)."""
+    delay = min(BACKOFF_BASE * 2 ** (attempt - 1), BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.0)
+
+
+class WriteQueue:
+    """Cola de proceso que combina y envía escrituras de celdas `{(fila, campo): valor}`."""
+
+    def __init__(self, send, columnas, store=None, flush_interval=FLUSH_INTERVAL,
+                 max_retries=MAX_RETRIES, chunk_size=MAX_RANGES_PER_REQUEST, route=None, journal=None,
+                 replay_interval=REPLAY_INTERVAL):
+        self._send = send
+        self.columnas = columnas
+        self._route = route
+        self.store = store
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.chunk_size = chunk_size
+        self.journal = journal
+        self.replay_interval = replay_interval
+        self._cond = threading.Condition()
+        self._pending = {}
+        # Entrada del diario de la que proviene el valor pendiente de cada celda
+        self._origins = {}
+        # Escrituras que agotaron los reintentos y esperan a que vuelva la conexión (con diario)
+        self._parked = {}
+        self._replay_at = None
+        self._sending = {}
+        self._attempts = {}
+        self._status = {}
+        self._in_flight = 0
+        self._retry_at = 0.0
+        self._worker = None
+
+    def enqueue(self, cells, author=None):
+        """
+        Aplica las celdas sobre el snapshot local y las deja pendientes de envío.
+        Una celda que ya estaba pendiente se reemplaza por el valor más reciente.
+        Con diario, antes se registran en él junto con `author` (quién escribe).
+        """
+        if not cells:
+            return
+        origin = self.journal.append(cells, author) if self.journal is not None else None
+        self._enqueue(cells, dict.fromkeys(cells, origin))
+
+    def replay(self):
+        """Vuelve a encolar, combinadas y en orden, las escrituras del diario que la planilla no confirmó."""
+        if self.journal is None:
+            return 0
+        pending = self.journal.pending()
+        if pending:
+            logger.info("Reenviando %d celdas sin confirmar del diario local.", len(pending))
+            metrics.increment("write_queue_replayed_cells_total", len(pending))
+            self._enqueue({key: value for key, (value, _) in pending.items()},
+                          {key: origin for key, (_, origin) in pending.items()})
+        return len(pending)
+
+    def _enqueue(self, cells, origins):
+        if self.store is not None:
+            self.store.patch({key: format_cell(value) for key, value in cells.items()})
+        with self._cond:
+            self._pending.update(cells)
+            self._origins.update(origins)
+            for key in cells:
+                self._attempts.pop(key, None)
+                self._parked.pop(key, None)
+            for row_number in {row_number for row_number, _ in cells}:
+                self._status[row_number] = RowStatus(PENDING)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+            self._cond.notify_all()
+
+    # --- Estado ---
+    def status(self, row_number):
+        """Estado de guardado de la fila, o None si no tiene escrituras sin confirmar ni fallidas."""
+        return self._status.get(row_number)
+
+    def failed_rows(self):
+        """Filas cuyas escrituras fallaron definitivamente, con el mensaje de error."""
+        return {row: status.message for row, status in list(self._status.items()) if status.state == FAILED}
+
+    def journaled_rows(self):
+        """Filas con escrituras que agotaron los reintentos y esperan en el diario a que vuelva la conexión."""
+        return {row: status.message for row, status in list(self._status.items()) if status.state == JOURNALED}
+
+    def pending_count(self):
+        """Cantidad de celdas pendientes o en envío."""
+        return len(self._pending) + self._in_flight
+
+    def journaled_count(self):
+        """Cantidad de celdas en espera de reenvío desde el diario."""
+        return len(self._parked)
+
+    def flush(self, timeout=None):
+        """Espera a que no queden escrituras pendientes ni en envío; retorna False si vence el plazo."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    # --- Envío ---
+    def _run(self):
+        """Hilo de envío: espera la ventana de agrupación y envía todo lo pendiente."""
+        while True:
+            with self._cond:
+                while not self._pending:
+                    if self._replay_at is not None and time.time() >= self._replay_at:
+                        self._unpark()
+                        continue
+                    self._cond.wait(None if self._replay_at is None else self._replay_at - time.time())
+            time.sleep(max(self.flush_interval, self._retry_at - time.time()))
+            with self._cond:
+                batch, self._pending = self._pending, {}
+                self._sending = {key: self._origins.pop(key, None) for key in batch}
+                self._in_flight = len(batch)
+            try:
+                self._send_batch(batch)
+            except Exception as e:
+                # Un error inesperado (p. ej. del disco) no termina el hilo: el lote se reintenta
+                logger.exception("Error inesperado al enviar %d celdas", len(batch))
+                try:
+                    self._on_failure(batch, e)
+                except Exception:
+                    logger.exception("No se pudo reprogramar el envío de %d celdas", len(batch))
+            finally:
+                with self._cond:
+                    self._in_flight = 0
+                    self._cond.notify_all()
+
+    def _send_batch(self, batch):
+        if self.journal is not None:
+            # Un solo fsync por envío cubre todas las escrituras agrupadas en la ventana
+            self.journal.sync()
+        items = list(batch.items())
+        for start in range(0, len(items), self.chunk_size):
+            chunk = dict(items[start:start + self.chunk_size])
+            try:
+                self._send_chunk(chunk)
+            except Exception as e:
+                # Errores fuera del envío (reparto entre hojas, confirmación): el bloque se reintenta
+                logger.exception("Error inesperado al enviar %d celdas", len(chunk))
+                self._on_failure(chunk, e)
+
+    def _requests(self, cells):
+        """
+        Peticiones `(send, rangos, celdas)` para un bloque: una por hoja de destino. Una
+        petición sin `send` trae, en lugar de rangos, el error por el que sus celdas no se pueden escribir.
+        """
+        if self._route is None:
+            return [(self._send, cells_to_ranges(cells, self.columnas), cells)]
+        return self._route(cells)
+
+    def _send_chunk(self, cells):
+        for send, data, group in self._requests(cells):
+            if send is None:
+                logger.warning("No se pueden guardar %d celdas: %s", len(group), data)
+                metrics.increment("write_queue_cells_total", len(group), result="error")
+                self._on_failure(group, data)
+                continue
+            try:
+                with metrics.timer("write_queue_send_seconds"):
+                    if data:
+                        send(data)
+            except Exception as e:
+                logger.warning("Error al guardar %d celdas: %s", len(group), e)
+                metrics.increment("write_queue_cells_total", len(group), result="error")
+                self._on_failure(group, e)
+            else:
+                metrics.increment("write_queue_cells_total", len(group), result="saved")
+                self._on_success(group)
+
+    def _unpark(self):
+        """Devuelve a la cola las escrituras en espera de reenvío (se llama con `_cond` tomado)."""
+        self._replay_at = None
+        if not self._parked:
+            return
+        metrics.increment("write_queue_replayed_cells_total", len(self._parked))
+        for key, value in self._parked.items():
+            if key not in self._pending:
+                self._pending[key] = value
+                # Un solo intento: si sigue sin conexión, vuelve a quedar en espera
+                self._attempts[key] = self.max_retries
+        for row_number in {row_number for row_number, _ in self._parked}:
+            self._status[row_number] = RowStatus(RETRYING, "Reenviando desde el diario local.")
+        self._parked = {}
+        self._cond.notify_all()
+
+    def _on_success(self, cells):
+        if self.store is not None:
+            self.store.acknowledge({key: format_cell(value) for key, value in cells.items()})
+        with self._cond:
+            origins = {}
+            for key in cells:
+                self._attempts.pop(key, None)
+                origin = self._sending.get(key)
+                if origin is not None:
+                    origins[key] = origin
+            pending_rows = {row_number for row_number, _ in self._pending}
+            # Una fila guardada deja de tener estado: `_status` es del proceso (todas las
+            # sesiones) y solo conserva filas pendientes, en reintento, en diario o fallidas
+            for row_number in {row_number for row_number, _ in cells}:
+                if row_number not in pending_rows:
+                    self._status.pop(row_number, None)
+            # La planilla respondió: las escrituras en espera ya pueden reenviarse
+            self._unpark()
+        if origins:
+            self.journal.acknowledge(origins)
+
+    def _on_failure(self, cells, error):
+        retry, give_up, retry_rows = {}, {}, {}
+        transient = is_transient(error)
+        with self._cond:
+            for key, value in cells.items():
+                if key in self._pending:
+                    # Ya hay un valor más reciente para la celda; ese es el que se enviará
+                    continue
+                attempt = self._attempts.get(key, 0) + 1
+                if not transient or attempt > self.max_retries:
+                    give_up[key] = value
+                    self._attempts.pop(key, None)
+                else:
+                    retry[key] = value
+                    self._attempts[key] = attempt
+                    retry_rows[key[0]] = max(retry_rows.get(key[0], 0), attempt)
+            self._pending.update(retry)
+            for key in retry:
+                self._origins[key] = self._sending.get(key)
+            if retry_rows:
+                self._retry_at = time.time() + backoff_delay(max(retry_rows.values()))
+            for row_number, attempt in retry_rows.items():
+                self._status[row_number] = RowStatus(RETRYING, f"Intento {attempt} de {self.max_retries}: {error}")
+            rejected = {key: self._sending.get(key) for key in give_up} if not transient else {}
+            if give_up and transient and self.journal is not None:
+                # Quedan en el diario y en el snapshot local hasta que vuelva la conexión
+                self._parked.update(give_up)
+                for key in give_up:
+                    self._origins[key] = self._sending.get(key)
+                self._replay_at = time.time() + self.replay_interval
+                for row_number in {row_number for row_number, _ in give_up}:
+                    self._status[row_number] = RowStatus(JOURNALED, str(error))
+                give_up = {}
+            for row_number in {row_number for row_number, _ in give_up}:
+                self._status[row_number] = RowStatus(FAILED, str(error))
+        if give_up and self.store is not None:
+            self.store.discard({key: format_cell(value) for key, value in give_up.items()})
+        rejected = {key: origin for key, origin in rejected.items() if origin is not None}
+        if rejected and self.journal is not None:
+            self.journal.reject(rejected, error)
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(key, send, columnas, store=None, route=None, journal=None):
+    """
+    Retorna la cola de escritura del proceso asociada a `key`, creándola si no existe.
+    Al crearla con diario, reenvía lo que haya quedado sin confirmar en él.
+    """
+    with _queues_lock:
+        queue = _queues.get(key)
+        if queue is None:
+            queue = WriteQueue(send, columnas, store=store, route=route, journal=journal)
+            _queues[key] = queue
+            queue.replay()
+        return queue
+
+
+def _collect_queues():
+    with _queues_lock:
+        queues = list(_queues.values())
+    for number, queue in enumerate(queues):
+        metrics.set_gauge("write_queue_pending_cells", queue.pending_count(), queue=str(number))
+        metrics.set_gauge("write_queue_failed_rows", len(queue.failed_rows()), queue=str(number))
+        metrics.set_gauge("write_queue_journaled_cells", queue.journaled_count(), queue=str(number))
+
+
+metrics.registry.register_collector(_collect_queues)
+metrics.registry.describe("write_queue_journaled_cells", "Celdas que agotaron los reintentos y esperan en el diario local a que vuelva la conexión.")
+metrics.registry.describe("write_queue_replayed_cells_total", "Celdas reenviadas desde el diario local (al iniciar o al volver la conexión).")